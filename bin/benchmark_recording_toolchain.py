@@ -0,0 +1,15 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import os
+import sys
+
+os.environ["KIVY_NO_ARGS"] = "1"  # Important to bypass Kivy CLI system, since Kivy gets imported by sensors
+
+from wacomponents.recording_benchmark import main
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    main()
@@ -12,6 +12,7 @@ from kivy.uix.settings import SettingsWithSpinner
 from kivymd.app import MDApp
 
 from wacomponents.application._common_runtime_support import WaRuntimeSupportMixin
+from wacomponents.devices.device_inventory import get_device_inventory
 from wacomponents.utilities import MONOTHREAD_POOL_EXECUTOR
 from wacomponents.widgets.layout_components import SettingStringTruncated
 from wacomponents.widgets.popups import safe_catch_unhandled_exception_and_display_popup
@@ -54,6 +55,17 @@ class WaGenericGui(WaRuntimeSupportMixin, MDApp):
         # self.theme_cls.theme_style = "Dark"  # or "Light"
         self.theme_cls.primary_hue = "900"  # "500"
 
+    def on_start(self):
+        device_inventory = get_device_inventory()
+        if not device_inventory.is_running:
+            device_inventory.start()  # Screens and checkers then read cached devices, refreshed on hotplug
+
+    def on_stop(self):
+        device_inventory = get_device_inventory()
+        if device_inventory.is_running:
+            device_inventory.stop()
+            device_inventory.join()
+
     def on_pause(self):
         """Enables the user to switch to another application, causing the app to wait
         until the user switches back to it eventually.
@@ -70,6 +70,7 @@ class WaRecorderGui(WaGenericGui):  # FIXME WaGui instead?
         initialization (after build() has been called) but before the
         application has started running the events loop.
         """
+        super().on_start()
         self.service_controller = ServiceController()
 
         # Redirect root logger traffic to GUI console widget if wanted
@@ -91,6 +92,7 @@ class WaRecorderGui(WaGenericGui):  # FIXME WaGui instead?
         closed).
         """
         atexit.unregister(self.on_stop)  # Not needed anymore
+        super().on_stop()
         if not self.should_daemonize_service():
             self.service_controller.stop_service()  # Will wait for termination, then kill it
 
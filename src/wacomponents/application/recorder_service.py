@@ -2,6 +2,7 @@
 # SPDX-FileCopyrightText: Copyright Prolifik SARL
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import hashlib
 import logging
 import os
 from configparser import ConfigParser, Error as ConfigParserError
@@ -14,6 +15,7 @@ from wacomponents.logging.handlers import safe_catch_unhandled_exception
 from wacomponents.recording_toolchain import start_recording_toolchain, stop_recording_toolchain
 from wacomponents.service_control import get_osc_server, get_osc_client
 from wacomponents.utilities import InterruptableEvent, MONOTHREAD_POOL_EXECUTOR
+from wacryptolib.utilities import dump_to_json_bytes
 
 # os.environ["KIVY_NO_CONSOLELOG"] = "1"  # IMPORTANT
 
@@ -46,10 +48,16 @@ class WaRecorderService(WaRuntimeSupportMixin):
     It must be stopped gracefully with a call to "/stop_server", so that current recordings can be properly stored.
 
     While the server is alive, recordings can be started and stopped several times without problem.
+
+    The recording toolchain is kept between recordings, and only rebuilt when the config it was built
+    from changes, or when it's explicitly invalidated (e.g. after keystores were imported).
     """
 
     _sock = None
     _recording_toolchain = None
+    _recording_toolchain_config_fingerprint = None  # Fingerprint of the config sources of current toolchain
+    _last_recording_startup_report = None  # As returned by start_recording_toolchain()
+    _last_recording_stop_report = None  # As returned by stop_recording_toolchain()
     _status_change_in_progress = False  # Set to True while recording is starting/stopping
 
     def __init__(self):
@@ -85,6 +93,37 @@ class WaRecorderService(WaRuntimeSupportMixin):
         """Return a valid recording toolchain"""
         raise NotImplementedError("_build_recording_toolchain()")
 
+    def _get_recording_toolchain_config_sources(self) -> dict:
+        """
+        Return the (json-serializable) config data which the recording toolchain is built from.
+
+        By default, it's all config sections; subclasses may add other sources which could change between
+        recordings. Changes to inputs not covered here must be signaled via invalidate_recording_toolchain().
+        """
+        return {section: dict(self.config.items(section)) for section in self.config.sections()}
+
+    def _compute_recording_toolchain_config_fingerprint(self) -> str:
+        config_sources = self._get_recording_toolchain_config_sources()
+        return hashlib.sha256(dump_to_json_bytes(config_sources, sort_keys=True)).hexdigest()
+
+    def _get_up_to_date_recording_toolchain(self):
+        """Return the current recording toolchain, or a new one if it's missing or outdated."""
+        config_fingerprint = self._compute_recording_toolchain_config_fingerprint()
+
+        if self._recording_toolchain and config_fingerprint == self._recording_toolchain_config_fingerprint:
+            logger.info("Reusing existing recording toolchain, since its config didn't change")
+            return self._recording_toolchain
+
+        logger.info("Building new recording toolchain")
+        toolchain = self._build_recording_toolchain()
+        self._recording_toolchain_config_fingerprint = config_fingerprint
+        return toolchain
+
+    def _invalidate_recording_toolchain(self):
+        """Force a full rebuild of the recording toolchain, on next recording."""
+        self._recording_toolchain = None
+        self._recording_toolchain_config_fingerprint = None
+
     def reload_config(self, filename=None):  # FIXME move to generic app ?
 
         # FIXME always parse default values too, in case service gets restarted alone after upgrade of python packages??
@@ -158,14 +197,20 @@ class WaRecorderService(WaRuntimeSupportMixin):
                 return
             logger.info("Service offloaded-starting recording")
 
-            if not self._recording_toolchain:
+            try:
                 self._recording_toolchain = (
-                    self._build_recording_toolchain()
+                    self._get_up_to_date_recording_toolchain()
                 )  # FIXME handle exceptions instead of None!
+            except Exception:
+                self._invalidate_recording_toolchain()
+                raise
 
             assert self._recording_toolchain
-            start_recording_toolchain(self._recording_toolchain)
-            logger.info("Service successfully offloaded-started recording")
+            self._last_recording_startup_report = start_recording_toolchain(self._recording_toolchain)
+            logger.info(
+                "Service successfully offloaded-started recording (sensor startup latencies: %s)",
+                self._last_recording_startup_report["sensor_startup_latencies"],
+            )
 
             if IS_ANDROID:
                 from wacomponents.default_settings import ANDROID_CONTEXT
@@ -187,6 +232,20 @@ class WaRecorderService(WaRuntimeSupportMixin):
             self._status_change_in_progress = False
             self.broadcast_recording_state()  # Even on error
 
+    @safe_catch_unhandled_exception
+    def _offloaded_invalidate_recording_toolchain(self):
+        if self.is_recording:
+            self._recording_toolchain_config_fingerprint = None  # Current recording goes on, until next restart
+        else:
+            self._invalidate_recording_toolchain()
+
+    @osc.address_method("/invalidate_recording_toolchain")
+    @safe_catch_unhandled_exception
+    def invalidate_recording_toolchain(self):
+        """Force a rebuild of the recording toolchain on next recording, e.g. when imported keystores changed."""
+        logger.info("Service got command to invalidate the recording toolchain")
+        return self._offload_task(self._offloaded_invalidate_recording_toolchain)
+
     @osc.address_method("/start_recording")
     @safe_catch_unhandled_exception
     def start_recording(self, env=None):
@@ -226,13 +285,21 @@ class WaRecorderService(WaRuntimeSupportMixin):
 
     @safe_catch_unhandled_exception
     def _offloaded_stop_recording(self):
+        toolchain_is_reusable = True
         try:
             if not self.is_recording:
                 # logger.debug("Ignoring redundant call to service.stop_recording()")
                 return
+            toolchain_is_reusable = False  # Until it's properly stopped
             logger.info("Service offloaded-stopping recording")
-            stop_recording_toolchain(self._recording_toolchain)
-            logger.info("Service successfully offloaded-stopped recording")
+            self._last_recording_stop_report = stop_recording_toolchain(self._recording_toolchain)
+            logger.info(
+                "Service successfully offloaded-stopped recording (phase durations: %s, pending operations: %s)",
+                self._last_recording_stop_report["phase_durations_s"],
+                self._last_recording_stop_report["pending_operations"],
+            )
+            # Components still busy in background threads must not be restarted as is
+            toolchain_is_reusable = not self._last_recording_stop_report["pending_operations"]
 
             if IS_ANDROID:
                 from wacomponents.default_settings import ANDROID_CONTEXT
@@ -240,7 +307,8 @@ class WaRecorderService(WaRuntimeSupportMixin):
                 ANDROID_CONTEXT.stopForeground(True)  # Does remove notification
 
         finally:  # Trigger all this even if container flushing failed
-            self._recording_toolchain = None  # Will force a reload of config on next recording
+            if not toolchain_is_reusable:
+                self._invalidate_recording_toolchain()
             self._status_change_in_progress = False
             self.broadcast_recording_state()
 
@@ -0,0 +1,208 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+In-memory inventory of the hardware devices (microphones, cameras, SPI displays, USB authdevices) seen by the app.
+
+Probing devices is costly (pulseaudio connections, vcgencmd subprocesses, partition scans...), so it's done
+once per device category, then only when hotplug events are detected or on a slow timer; the GUI and the
+status checkers read the cached results.
+"""
+
+import copy
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from wacryptolib.sensor import PeriodicTaskHandler
+from wacryptolib.utilities import catch_and_log_exception
+
+logger = logging.getLogger(__name__)
+
+_DEVICE_NODE_PREFIXES = ("video", "spidev", "snd", "sd", "mmcblk", "disk")  # Prefixes of hotpluggable nodes
+
+
+def probe_pulseaudio_microphones() -> list:
+    from wacomponents.sensors.camera.raspberrypi_camera_microphone import list_pulseaudio_microphone_names
+
+    return list_pulseaudio_microphone_names()
+
+
+def probe_legacy_rpi_camera() -> bool:
+    from wacomponents.sensors.camera.raspberrypi_camera_microphone import is_legacy_rpi_camera_enabled
+
+    return is_legacy_rpi_camera_enabled()
+
+
+def probe_video4linux_cameras(sysfs_path=Path("/sys/class/video4linux")) -> list:
+    """Return dicts with "device_path" and "device_name" of V4L2 capture nodes, like /dev/video0."""
+    cameras = []
+    if not sysfs_path.is_dir():
+        return cameras
+    for device_dir in sorted(sysfs_path.iterdir()):
+        if not device_dir.name.startswith("video"):
+            continue
+        try:
+            device_name = device_dir.joinpath("name").read_text().strip()
+        except OSError:
+            device_name = None
+        cameras.append(dict(device_path="/dev/" + device_dir.name, device_name=device_name))
+    return cameras
+
+
+def probe_spi_displays(dev_path=Path("/dev")) -> list:
+    """Return the SPI device nodes (like /dev/spidev0.0) onto which our LCD and E-paper screens can be plugged."""
+    if not dev_path.is_dir():
+        return []
+    return sorted(str(path) for path in dev_path.glob("spidev*"))
+
+
+def probe_authdevices() -> list:
+    from wacryptolib.authdevice import list_available_authdevices
+
+    return list_available_authdevices()
+
+
+DEFAULT_DEVICE_PROBERS = dict(
+    microphones=probe_pulseaudio_microphones,
+    legacy_rpi_camera_enabled=probe_legacy_rpi_camera,
+    cameras=probe_video4linux_cameras,
+    spi_displays=probe_spi_displays,
+    authdevices=probe_authdevices,
+)
+
+
+class DeviceInventory(PeriodicTaskHandler):
+    """
+    Caches the results of device probers (callables mapped to a device category), and refreshes them in
+    background once started.
+
+    Once started, all categories are probed in background, but a category is probed on its first lookup
+    if it wasn't already. Afterwards, all categories are re-probed when the listing of hotpluggable nodes
+    in `dev_path`, or the mounted partitions (USB authdevices get mounted after their node appears), change;
+    this check is cheap, and done every `hotplug_polling_interval_s`. All categories are also re-probed
+    every `refresh_interval_s`, since some devices (e.g. pulseaudio sources) don't show up in `dev_path`.
+
+    A failing prober is logged, and its category then keeps its previous value (or None).
+    """
+
+    def __init__(
+        self,
+        device_probers: Optional[dict] = None,
+        *,
+        hotplug_polling_interval_s: float = 5,
+        refresh_interval_s: float = 10 * 60,
+        dev_path: Path = Path("/dev"),
+        mounts_path: Path = Path("/proc/mounts"),
+    ):
+        super().__init__(interval_s=hotplug_polling_interval_s, runonstart=True)
+        self._device_probers = dict(DEFAULT_DEVICE_PROBERS if device_probers is None else device_probers)
+        self._refresh_interval_s = refresh_interval_s
+        self._dev_path = dev_path
+        self._mounts_path = mounts_path
+
+        self._inventory_lock = threading.Lock()
+        self._probing_lock = threading.Lock()  # Serializes probings, which may be slow
+        self._inventory = {}  # Only contains already probed categories
+        self._last_refresh_timestamp = None  # From time.monotonic()
+        self._device_nodes_fingerprint = self._get_device_nodes_fingerprint()
+        self._refresh_count = 0
+
+    def _get_device_nodes_fingerprint(self) -> tuple:
+        """Return hotpluggable device node names and mount table, each being None if unavailable."""
+        try:
+            entries = os.listdir(self._dev_path)
+            device_nodes = frozenset(entry for entry in entries if entry.startswith(_DEVICE_NODE_PREFIXES))
+        except OSError:
+            device_nodes = None  # E.g. Windows platform
+        try:
+            mounts = self._mounts_path.read_text()
+        except OSError:
+            mounts = None
+        return device_nodes, mounts
+
+    def _probe_category(self, category):
+        device_prober = self._device_probers[category]
+        try:
+            devices = device_prober()
+        except Exception as exc:  # Probers rely on lots of optional tools and libraries
+            logger.warning("Could not probe %r devices: %r", category, exc)
+            with self._inventory_lock:
+                return self._inventory.setdefault(category, None)
+        with self._inventory_lock:
+            was_probed = category in self._inventory
+            previous_devices = self._inventory.get(category)
+            self._inventory[category] = devices
+        if was_probed and devices != previous_devices:
+            logger.info("Inventory of %r devices updated: %s", category, devices)
+        return devices
+
+    def refresh(self, categories: Optional[list] = None):
+        """Probe now the given device categories (by default all of them), and update the cache."""
+        categories = list(self._device_probers) if categories is None else categories
+        with self._probing_lock:
+            for category in categories:
+                self._probe_category(category)
+            if len(categories) == len(self._device_probers):
+                self._last_refresh_timestamp = time.monotonic()
+                with self._inventory_lock:
+                    self._refresh_count += 1
+
+    def get_devices(self, category):
+        """Return a copy of the cached devices of this category, probing them if it never happened."""
+        with self._inventory_lock:
+            if category in self._inventory:
+                return copy.deepcopy(self._inventory[category])
+        if category not in self._device_probers:
+            raise ValueError("Unknown device category %r" % category)
+        with self._probing_lock:
+            with self._inventory_lock:
+                already_probed = category in self._inventory
+            if not already_probed:  # Else a concurrent lookup did the job
+                self._probe_category(category)
+        with self._inventory_lock:
+            return copy.deepcopy(self._inventory[category])
+
+    def get_inventory(self) -> dict:
+        """Return a copy of all cached device categories (not yet probed ones are absent)."""
+        with self._inventory_lock:
+            return copy.deepcopy(self._inventory)
+
+    def get_refresh_count(self) -> int:
+        with self._inventory_lock:
+            return self._refresh_count
+
+    def _check_for_device_changes(self):
+        device_nodes_fingerprint = self._get_device_nodes_fingerprint()
+        hotplug_detected = device_nodes_fingerprint != self._device_nodes_fingerprint
+        self._device_nodes_fingerprint = device_nodes_fingerprint
+
+        refresh_is_due = (
+            self._last_refresh_timestamp is None
+            or time.monotonic() - self._last_refresh_timestamp >= self._refresh_interval_s
+        )
+        if hotplug_detected:
+            logger.info("Device hotplug detected, refreshing device inventory")
+        if hotplug_detected or refresh_is_due:
+            self.refresh()
+
+    def _offloaded_run_task(self):
+        with catch_and_log_exception("DeviceInventory._check_for_device_changes"):
+            self._check_for_device_changes()
+
+
+_device_inventory = None
+_device_inventory_lock = threading.Lock()
+
+
+def get_device_inventory() -> DeviceInventory:
+    """Return the process-wide DeviceInventory, with default probers; it's up to the app to start() it."""
+    global _device_inventory
+    with _device_inventory_lock:
+        if _device_inventory is None:
+            _device_inventory = DeviceInventory()
+        return _device_inventory
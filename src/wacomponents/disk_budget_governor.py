@@ -0,0 +1,244 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import logging
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from wacryptolib.sensor import PeriodicTaskHandler
+from wacryptolib.utilities import catch_and_log_exception
+
+logger = logging.getLogger(__name__)
+
+
+def _get_sensor_label(sensor):
+    return getattr(sensor, "sensor_name", None) or sensor.__class__.__name__
+
+
+class DiskBudgetGovernor(PeriodicTaskHandler):
+    """
+    Periodically samples free space on the partition of `disk_storage_path` (usually the folder of the
+    cryptainer storage), and the amount of data recorded by each sensor, so as to estimate fill rates
+    and project the delay before the disk is full.
+
+    When this time-to-full falls below `degraded_quality_horizon_s`, the sensor with the highest fill rate
+    among those supporting it (see SubprocessStreamRecorderBase.set_recording_quality_level()) is switched
+    to the next degraded recording quality level; quality is restored, step by step, once time-to-full
+    exceeds twice this horizon. Sensors which don't support quality levels are only observed.
+
+    When time-to-full falls below `early_purge_horizon_s`, or free space below `min_free_space`, the oldest
+    finished cryptainers are purged, until free space covers `min_free_space` plus the data expected
+    within `early_purge_horizon_s`.
+
+    Quality changes are separated by at least `quality_adaptation_interval_s`, so that their effects on
+    the fill rate can be observed. Each decision is logged, and the last ones are kept in
+    `get_disk_budget_report()`.
+    """
+
+    MAX_REPORTED_DECISIONS = 20
+
+    def __init__(
+        self,
+        cryptainer_storage,
+        sensors: list,
+        *,
+        disk_storage_path: Path,
+        sampling_interval_s: float = 60,
+        fill_rate_window_s: float = 15 * 60,
+        degraded_quality_horizon_s: float = 24 * 3600,
+        early_purge_horizon_s: float = 3 * 3600,
+        min_free_space: int = 200 * 1024**2,
+        quality_adaptation_interval_s: float = 10 * 60,
+    ):
+        super().__init__(interval_s=sampling_interval_s, runonstart=True)
+        assert 0 < early_purge_horizon_s <= degraded_quality_horizon_s, (
+            early_purge_horizon_s,
+            degraded_quality_horizon_s,
+        )
+        assert fill_rate_window_s > sampling_interval_s, fill_rate_window_s
+        self._cryptainer_storage = cryptainer_storage
+        self._sensors = sensors
+        self._disk_storage_path = disk_storage_path
+        self._fill_rate_window_s = fill_rate_window_s
+        self._degraded_quality_horizon_s = degraded_quality_horizon_s
+        self._early_purge_horizon_s = early_purge_horizon_s
+        self._min_free_space = min_free_space
+        self._quality_adaptation_interval_s = quality_adaptation_interval_s
+
+        self._report_lock = threading.Lock()
+        self._samples = collections.deque()  # Tuples (timestamp, free_space, {sensor_label: recorded_byte_count})
+        self._last_quality_adaptation_timestamp = None  # From time.monotonic()
+        self._decisions = collections.deque(maxlen=self.MAX_REPORTED_DECISIONS)
+        self._disk_budget_report = dict(
+            free_space=None,
+            fill_rate=None,  # Bytes per second
+            sensor_fill_rates={},  # Only for sensors exposing get_stream_statistics()
+            time_to_full_s=None,  # None if disk is not filling up
+            recording_quality_levels={},
+            purged_cryptainer_count=0,
+            purged_size=0,
+            last_decisions=[],
+        )
+
+    def get_disk_budget_report(self) -> dict:
+        """Return a snapshot of the last estimations and decisions of the governor."""
+        with self._report_lock:
+            disk_budget_report = self._disk_budget_report.copy()
+            disk_budget_report["last_decisions"] = list(self._decisions)
+            return disk_budget_report
+
+    def start(self):
+        self._samples.clear()  # Fill rates of a previous recording session are meaningless
+        super().start()
+
+    def _log_decision(self, decision: str):
+        logger.warning("Disk budget governor decision: %s", decision)
+        with self._report_lock:
+            self._decisions.append((time.time(), decision))
+
+    def _get_adaptable_sensors(self):
+        return [sensor for sensor in self._sensors if hasattr(sensor, "set_recording_quality_level")]
+
+    def _sample_disk_usage(self):
+        now = time.monotonic()
+        recorded_byte_counts = {}
+        for sensor in self._sensors:
+            if hasattr(sensor, "get_stream_statistics"):
+                stream_statistics = sensor.get_stream_statistics()
+                recorded_byte_counts[_get_sensor_label(sensor)] = stream_statistics["encrypted_byte_count"]
+        free_space = shutil.disk_usage(self._disk_storage_path).free
+        samples = self._samples
+        samples.append((now, free_space, recorded_byte_counts))
+        while len(samples) > 2 and samples[1][0] <= now - self._fill_rate_window_s:
+            samples.popleft()
+        return free_space
+
+    def _compute_fill_rates(self):
+        """Return the global fill rate of the disk (None if unknown), and the recording rates of sensors."""
+        if len(self._samples) < 2:
+            return None, {}
+        oldest_timestamp, oldest_free_space, oldest_byte_counts = self._samples[0]
+        newest_timestamp, newest_free_space, newest_byte_counts = self._samples[-1]
+        duration_s = newest_timestamp - oldest_timestamp
+        if duration_s <= 0:
+            return None, {}
+        sensor_fill_rates = {
+            label: max(0, byte_count - oldest_byte_counts[label]) / duration_s  # Counters are reset on restart
+            for (label, byte_count) in newest_byte_counts.items()
+            if label in oldest_byte_counts
+        }
+        return (oldest_free_space - newest_free_space) / duration_s, sensor_fill_rates
+
+    def _offloaded_run_task(self):
+        with catch_and_log_exception("DiskBudgetGovernor._offloaded_run_task"):
+            self._govern_disk_budget()
+
+    def _govern_disk_budget(self):
+        free_space = self._sample_disk_usage()
+        fill_rate, sensor_fill_rates = self._compute_fill_rates()
+
+        time_to_full_s = None
+        if fill_rate is not None and fill_rate > 0:
+            time_to_full_s = max(0, free_space - self._min_free_space) / fill_rate
+
+        logger.debug(
+            "Disk budget: %d bytes free, fill rate %s bytes/s, time-to-full %ss", free_space, fill_rate, time_to_full_s
+        )
+
+        if free_space < self._min_free_space or (
+            time_to_full_s is not None and time_to_full_s < self._early_purge_horizon_s
+        ):
+            self._purge_oldest_cryptainers(free_space=free_space, fill_rate=max(0, fill_rate or 0))
+
+        must_degrade = time_to_full_s is not None and time_to_full_s < self._degraded_quality_horizon_s
+        may_restore = fill_rate is not None and (
+            time_to_full_s is None or time_to_full_s > 2 * self._degraded_quality_horizon_s
+        )
+        if must_degrade or may_restore:
+            self._adapt_recording_quality(
+                degrade=must_degrade, sensor_fill_rates=sensor_fill_rates, time_to_full_s=time_to_full_s
+            )
+
+        with self._report_lock:
+            self._disk_budget_report.update(
+                free_space=free_space,
+                fill_rate=fill_rate,
+                sensor_fill_rates=sensor_fill_rates,
+                time_to_full_s=time_to_full_s,
+                recording_quality_levels={
+                    _get_sensor_label(sensor): sensor.recording_quality_level
+                    for sensor in self._get_adaptable_sensors()
+                },
+            )
+
+    def _adapt_recording_quality(self, degrade: bool, sensor_fill_rates: dict, time_to_full_s: Optional[float]):
+        now = time.monotonic()
+        if (
+            self._last_quality_adaptation_timestamp is not None
+            and now - self._last_quality_adaptation_timestamp < self._quality_adaptation_interval_s
+        ):
+            return  # Previous adaptation may not be visible yet in fill rates
+
+        if degrade:
+            candidate_sensors = [
+                sensor
+                for sensor in self._get_adaptable_sensors()
+                if sensor.recording_quality_level < sensor.max_recording_quality_level
+            ]
+            # Biggest consumers of disk space first
+            candidate_sensors.sort(key=lambda sensor: sensor_fill_rates.get(_get_sensor_label(sensor), 0), reverse=True)
+        else:
+            candidate_sensors = [sensor for sensor in self._get_adaptable_sensors() if sensor.recording_quality_level]
+            # Most degraded sensors first
+            candidate_sensors.sort(key=lambda sensor: sensor.recording_quality_level, reverse=True)
+
+        if not candidate_sensors:
+            return
+        sensor = candidate_sensors[0]
+        previous_level = sensor.recording_quality_level
+        new_level = sensor.set_recording_quality_level(previous_level + (1 if degrade else -1))
+        self._last_quality_adaptation_timestamp = now
+        self._log_decision(
+            "%s recording quality of %s sensor from level %d to %d (time-to-full: %s)"
+            % (
+                "degrading" if degrade else "restoring",
+                _get_sensor_label(sensor),
+                previous_level,
+                new_level,
+                "%ds" % time_to_full_s if time_to_full_s is not None else "unbounded",
+            )
+        )
+
+    def _purge_oldest_cryptainers(self, free_space: int, fill_rate: float):
+        target_free_space = self._min_free_space + fill_rate * self._early_purge_horizon_s
+        cryptainer_dicts = self._cryptainer_storage.list_cryptainer_properties(
+            with_size=True, with_age=True, finished=True
+        )
+        cryptainer_dicts.sort(key=lambda x: (x["age"], x["name"]), reverse=True)  # Oldest first
+
+        purged_cryptainer_count = 0
+        purged_size = 0
+        for cryptainer_dict in cryptainer_dicts:
+            if free_space + purged_size >= target_free_space:
+                break
+            self._cryptainer_storage.delete_cryptainer(cryptainer_dict["name"])
+            purged_cryptainer_count += 1
+            purged_size += cryptainer_dict["size"]
+
+        if not purged_cryptainer_count:
+            logger.warning("Disk budget governor found no cryptainer to purge, with %d bytes free", free_space)
+            return
+
+        self._samples.clear()  # Freed space would otherwise look like a negative fill rate
+        with self._report_lock:
+            self._disk_budget_report["purged_cryptainer_count"] += purged_cryptainer_count
+            self._disk_budget_report["purged_size"] += purged_size
+        self._log_decision(
+            "early purge of %d oldest cryptainers (%d bytes), to reach %d bytes free"
+            % (purged_cryptainer_count, purged_size, target_free_space)
+        )
@@ -0,0 +1,371 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+End-to-end benchmark of a complete recording toolchain, built around synthetic sensors, so that releases
+can be compared before rolling them out. Results are emitted as JSON, e.g.:
+
+    python bin/benchmark_recording_toolchain.py --duration 60 --sensor-count 2 --output results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+from wacryptolib.keystore import FilesystemKeystorePool, get_free_keypair_generator_worker
+from wacryptolib.sensor import JsonDataAggregator, PeriodicTaskHandler, TarfileRecordAggregator
+from wacryptolib.utilities import catch_and_log_exception
+
+from wacomponents.recording_toolchain import (
+    ConcurrentSensorManager,
+    start_recording_toolchain,
+    stop_recording_toolchain,
+)
+from wacomponents.sensors.camera._camera_base import ActivityNotificationBus
+from wacomponents.sensors.camera._encryption_process_pool import EncryptionProcessPool
+from wacomponents.sensors.camera.ffmpeg_capabilities import get_ffmpeg_capabilities
+from wacomponents.sensors.camera.synthetic_stream import SyntheticStreamSensor
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        )
+    ]
+)
+
+BENCHMARK_MONITOR_NAME = "benchmark_monitor"
+
+
+def _get_percentiles(values: list) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+    return dict(
+        count=len(values),
+        p50=statistics.median(values),
+        p95=values[min(len(values) - 1, int(0.95 * len(values)))],
+        max=values[-1],
+    )
+
+
+class _BenchmarkSyntheticStreamSensor(SyntheticStreamSensor):
+    """Measures how long each cryptainer takes to be finalized on disk, once its last chunk is captured."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._latency_lock = threading.Lock()
+        self._cryptainer_finalization_latencies_s = []
+
+    def _on_segment_data(self, chunk, segment_offset, segment_state: dict):
+        super()._on_segment_data(chunk, segment_offset, segment_state=segment_state)
+        segment_state["last_data_timestamp"] = time.monotonic()
+
+    def _on_segment_finalized(self, segment_state: dict):
+        super()._on_segment_finalized(segment_state=segment_state)
+        last_data_timestamp = segment_state.get("last_data_timestamp")
+        if last_data_timestamp is not None:  # Else segment was empty
+            with self._latency_lock:
+                self._cryptainer_finalization_latencies_s.append(time.monotonic() - last_data_timestamp)
+
+    def get_cryptainer_finalization_latencies_s(self) -> list:
+        with self._latency_lock:
+            return list(self._cryptainer_finalization_latencies_s)
+
+
+class _MonitorDataAggregator(JsonDataAggregator):
+    """Provides the flush_payload() expected by stop_recording_toolchain(), whatever the wacryptolib version."""
+
+    def flush_payload(self):
+        flush_payload = getattr(super(), "flush_payload", None) or super().flush_dataset  # Older name
+        return flush_payload()
+
+
+def build_benchmark_recording_toolchain(
+    work_dir: Path,
+    sensor_count: int,
+    recording_interval_s: float,
+    sensor_parameters: dict,
+    use_encryption_process_pool: bool,
+    use_free_keys_generator: bool,
+) -> dict:
+    """Build a recording toolchain like those of recorder services, but with synthetic sensors."""
+    keystore_dir = work_dir / "keystores"
+    keystore_dir.mkdir()
+    keystore_pool = FilesystemKeystorePool(keystore_dir)
+    cryptainer_dir = work_dir / "cryptainers"
+    cryptainer_dir.mkdir()
+    cryptainer_storage = CryptainerStorage(
+        cryptainer_dir, keystore_pool=keystore_pool, default_cryptoconf=BENCHMARK_CRYPTOCONF
+    )
+
+    free_keys_generator_worker = None
+    if use_free_keys_generator:
+        free_keys_generator_worker = get_free_keypair_generator_worker(
+            keystore=keystore_pool.get_local_keyfactory(),
+            max_free_keys_per_algo=10,
+            sleep_on_overflow_s=recording_interval_s,
+        )
+
+    tarfile_aggregator = TarfileRecordAggregator(
+        cryptainer_storage=cryptainer_storage, max_duration_s=recording_interval_s
+    )
+    monitor_data_aggregator = _MonitorDataAggregator(
+        tarfile_aggregator=tarfile_aggregator, sensor_name=BENCHMARK_MONITOR_NAME, max_duration_s=recording_interval_s
+    )
+
+    encryption_process_pool = EncryptionProcessPool() if use_encryption_process_pool else None
+    activity_notification_bus = ActivityNotificationBus()
+
+    sensors = [
+        _BenchmarkSyntheticStreamSensor(
+            sensor_name="synthetic_stream_%d" % idx,
+            audio_frequency_hz=440 + 110 * idx,
+            interval_s=recording_interval_s,
+            cryptainer_storage=cryptainer_storage,
+            encryption_process_pool=encryption_process_pool,
+            activity_notification_callback=lambda **kwargs: None,
+            activity_notification_bus=activity_notification_bus,
+            **sensor_parameters
+        )
+        for idx in range(sensor_count)
+    ]
+
+    return dict(
+        sensors_manager=ConcurrentSensorManager(sensors=sensors),
+        data_aggregators=[monitor_data_aggregator],
+        tarfile_aggregators=[tarfile_aggregator],
+        cryptainer_storage=cryptainer_storage,
+        free_keys_generator_worker=free_keys_generator_worker,
+        encryption_process_pool=encryption_process_pool,
+        activity_notification_bus=activity_notification_bus,
+    )
+
+
+class _ToolchainMonitor(PeriodicTaskHandler):
+    """
+    Samples CPU times and RSS of the subprocesses of each sensor, and of the recording process itself
+    (including its encryption workers), and pushes these samples to a data aggregator.
+
+    It should keep running while the toolchain stops, so that this phase is measured too; samples are then
+    only kept in memory, since the data aggregator must be detached before being flushed.
+    """
+
+    def __init__(self, sensors: list, monitor_data_aggregator: JsonDataAggregator, interval_s: float):
+        super().__init__(interval_s=interval_s, runonstart=True)
+        import psutil  # LAZY loaded
+
+        self._psutil = psutil
+        self._current_process = psutil.Process()
+        self._sensors = sensors
+        self._monitor_data_aggregator = monitor_data_aggregator
+        self._lock = threading.Lock()
+        self._process_samples = {}  # Maps pids to (label, cpu_time_s, rss) of their last sample
+        self._max_rss_by_label = {}
+
+    def detach_monitor_data_aggregator(self):
+        """Stop pushing samples to the data aggregator, e.g. before it gets flushed."""
+        with self._lock:
+            self._monitor_data_aggregator = None
+
+    def _sample_process(self, process, label):
+        try:
+            with process.oneshot():
+                cpu_times = process.cpu_times()
+                rss = process.memory_info().rss
+        except self._psutil.Error:
+            return None  # Process has ended
+        self._process_samples[process.pid] = (label, cpu_times.user + cpu_times.system, rss)
+        self._max_rss_by_label[label] = max(self._max_rss_by_label.get(label, 0), rss)
+        return rss
+
+    def _offloaded_run_task(self):
+        with catch_and_log_exception("_ToolchainMonitor._offloaded_run_task"):
+            sample = dict(timestamp=time.time(), rss_by_label={})
+            with self._lock:
+                subprocess_pids = set()
+                for sensor in self._sensors:
+                    subprocess_pid = sensor.get_subprocess_pid()
+                    if subprocess_pid is not None:
+                        subprocess_pids.add(subprocess_pid)
+                        try:
+                            process = self._psutil.Process(subprocess_pid)
+                        except self._psutil.Error:
+                            continue  # Subprocess has just ended
+                        sample["rss_by_label"][sensor.sensor_name] = self._sample_process(process, sensor.sensor_name)
+                sample["rss_by_label"]["recorder"] = self._sample_process(self._current_process, "recorder")
+                for child_process in self._current_process.children(recursive=True):
+                    if child_process.pid not in subprocess_pids:  # E.g. encryption workers
+                        self._sample_process(child_process, "encryption_workers")
+                monitor_data_aggregator = self._monitor_data_aggregator
+            if monitor_data_aggregator is not None:
+                monitor_data_aggregator.add_data(sample)
+
+    def get_resource_usage(self) -> dict:
+        """Return the CPU time and max RSS of each label (sensor name, "recorder" or "encryption_workers")."""
+        with self._lock:
+            cpu_time_by_label = {}
+            for label, cpu_time_s, _rss in self._process_samples.values():
+                cpu_time_by_label[label] = cpu_time_by_label.get(label, 0) + cpu_time_s
+            return {
+                label: dict(cpu_time_s=cpu_time_by_label[label], max_rss=self._max_rss_by_label[label])
+                for label in cpu_time_by_label
+            }
+
+
+def run_recording_toolchain_benchmark(
+    duration_s: float = 60,
+    sensor_count: int = 1,
+    recording_interval_s: float = 10,
+    sensor_parameters: Optional[dict] = None,
+    use_encryption_process_pool: bool = False,
+    use_free_keys_generator: bool = True,
+    monitor_interval_s: float = 1,
+    work_dir: Optional[Path] = None,
+) -> dict:
+    """
+    Record synthetic streams through a complete recording toolchain for `duration_s`, and return a JSON-compatible
+    dict of results: sustained throughputs, cryptainer finalization latencies (from the capture of their last
+    chunk to their dump on disk), CPU and RSS per sensor, toolchain start/stop durations, and gaps between
+    successive subprocesses of sensors.
+
+    `sensor_parameters` are given to each SyntheticStreamSensor. Cryptainers are written to a temporary
+    directory, unless `work_dir` is provided.
+    """
+    sensor_parameters = sensor_parameters or {}
+    benchmark_parameters = dict(
+        duration_s=duration_s,
+        sensor_count=sensor_count,
+        recording_interval_s=recording_interval_s,
+        sensor_parameters=sensor_parameters,
+        use_encryption_process_pool=use_encryption_process_pool,
+        use_free_keys_generator=use_free_keys_generator,
+    )
+
+    with tempfile.TemporaryDirectory(prefix="wa_recording_benchmark_") as temp_dir:
+        work_dir = Path(work_dir or temp_dir)
+        toolchain = build_benchmark_recording_toolchain(
+            work_dir=work_dir,
+            sensor_count=sensor_count,
+            recording_interval_s=recording_interval_s,
+            sensor_parameters=sensor_parameters,
+            use_encryption_process_pool=use_encryption_process_pool,
+            use_free_keys_generator=use_free_keys_generator,
+        )
+        sensors = toolchain["sensors_manager"].sensors
+        cryptainer_storage = toolchain["cryptainer_storage"]
+        toolchain_monitor = _ToolchainMonitor(
+            sensors, monitor_data_aggregator=toolchain["data_aggregators"][0], interval_s=monitor_interval_s
+        )
+
+        recording_start_time = time.monotonic()
+        startup_report = start_recording_toolchain(toolchain)
+        toolchain_monitor.start()
+        time.sleep(max(0, duration_s - (time.monotonic() - recording_start_time)))
+        toolchain_monitor.detach_monitor_data_aggregator()
+        stop_report = stop_recording_toolchain(toolchain)  # Monitored too, e.g. for CPU of last encryptions
+        recording_duration_s = time.monotonic() - recording_start_time
+        toolchain_monitor.stop()
+        toolchain_monitor.join()
+
+        cryptainer_properties = cryptainer_storage.list_cryptainer_properties(with_size=True, finished=True)
+        stored_byte_count = sum(cryptainer_dict["size"] for cryptainer_dict in cryptainer_properties)
+
+    resource_usage = toolchain_monitor.get_resource_usage()
+    sensor_results = {}
+    for sensor in sensors:
+        stream_statistics = sensor.get_stream_statistics()
+        sensor_results[sensor.sensor_name] = dict(
+            encrypted_byte_count=stream_statistics["encrypted_byte_count"],
+            throughput_mb_s=stream_statistics["encrypted_byte_count"] / recording_duration_s / 1e6,
+            encryption_duration_s=stream_statistics["encryption_duration_s"],
+            subprocess_resource_usage=resource_usage.get(sensor.sensor_name),
+            subprocess_handoff_count=stream_statistics["subprocess_handoff_count"],
+            subprocess_handoff_gap_count=stream_statistics["subprocess_handoff_gap_count"],
+            min_subprocess_handoff_overlap_s=stream_statistics["min_subprocess_handoff_overlap_s"],
+            stall_count=stream_statistics["stall_count"],
+        )
+
+    encrypted_byte_count = sum(sensor_result["encrypted_byte_count"] for sensor_result in sensor_results.values())
+    ffmpeg_capabilities = get_ffmpeg_capabilities()
+    return dict(
+        benchmark_parameters=benchmark_parameters,
+        environment=dict(
+            python_version=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            ffmpeg_version=ffmpeg_capabilities["version"] if ffmpeg_capabilities else None,
+        ),
+        results=dict(
+            recording_duration_s=recording_duration_s,
+            encrypted_byte_count=encrypted_byte_count,
+            sustained_throughput_mb_s=encrypted_byte_count / recording_duration_s / 1e6,
+            stored_cryptainer_count=len(cryptainer_properties),
+            stored_byte_count=stored_byte_count,
+            cryptainer_finalization_latency_s=_get_percentiles(
+                [
+                    latency_s
+                    for sensor in sensors
+                    for latency_s in sensor.get_cryptainer_finalization_latencies_s()
+                ]
+            ),
+            toolchain_startup_duration_s=startup_report["toolchain_startup_duration_s"],
+            sensor_startup_latencies=startup_report["sensor_startup_latencies"],
+            toolchain_stop_duration_s=stop_report["toolchain_stop_duration_s"],
+            toolchain_stop_phase_durations_s=stop_report["phase_durations_s"],
+            toolchain_stop_pending_operations=stop_report["pending_operations"],
+            recorder_resource_usage=resource_usage.get("recorder"),
+            encryption_workers_resource_usage=resource_usage.get("encryption_workers"),
+            sensors=sensor_results,
+        ),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a recording toolchain fed by synthetic sensors.")
+    parser.add_argument("--duration", type=float, default=60, help="Recording duration in seconds")
+    parser.add_argument("--sensor-count", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=10, help="Recording interval (rotation) in seconds")
+    parser.add_argument("--video-resolution", default="1280x720")
+    parser.add_argument("--video-bitrate", default="2M")
+    parser.add_argument("--no-realtime", action="store_true", help="Produce data as fast as possible")
+    parser.add_argument("--gapless-rotation", action="store_true")
+    parser.add_argument("--overlapping-rotation-window", type=float, default=None)
+    parser.add_argument("--encryption-process-pool", action="store_true")
+    parser.add_argument("--output", help="JSON output file, else results are printed to stdout")
+    args = parser.parse_args(argv)
+
+    sensor_parameters = dict(
+        video_resolution=args.video_resolution,
+        video_bitrate=args.video_bitrate,
+        realtime=not args.no_realtime,
+        gapless_rotation=args.gapless_rotation,
+        overlapping_rotation_window_s=args.overlapping_rotation_window,
+    )
+    benchmark_result = run_recording_toolchain_benchmark(
+        duration_s=args.duration,
+        sensor_count=args.sensor_count,
+        recording_interval_s=args.interval,
+        sensor_parameters=sensor_parameters,
+        use_encryption_process_pool=args.encryption_process_pool,
+    )
+
+    benchmark_json = json.dumps(benchmark_result, indent=2, sort_keys=True)
+    if args.output:
+        Path(args.output).write_text(benchmark_json)
+    else:
+        print(benchmark_json)
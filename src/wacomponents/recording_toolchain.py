@@ -3,14 +3,84 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as futures_wait
+
+from wacryptolib.sensor import SensorManager
+from wacryptolib.utilities import catch_and_log_exception
 
 logger = logging.getLogger(__name__)
 
+# Must stay below the timeout used by WaRecorderService.stop_server()
+STOP_RECORDING_TOOLCHAIN_DEADLINE_S = 25
+
+
+class ConcurrentSensorManager(SensorManager):
+    """
+    Variant of SensorManager which starts its sensors concurrently (e.g. so that ffmpeg probing,
+    camera warm-ups and PulseAudio connections overlap), and waits until all of them are started.
+
+    After `start()`, `sensor_startup_latencies` maps sensor labels to the delay (in seconds) after which
+    each sensor was ready, or None if it failed to start.
+    """
+
+    def __init__(self, sensors):
+        super().__init__(sensors)
+        self.sensor_startup_latencies = {}
+
+    @property
+    def sensors(self) -> list:
+        return list(self._sensors)
 
-def start_recording_toolchain(toolchain):
+    def _get_sensor_labels(self):
+        labels = []
+        for sensor in self._sensors:
+            label = getattr(sensor, "sensor_name", None) or sensor.__class__.__name__
+            if label in labels:
+                label += "#%d" % len(labels)
+            labels.append(label)
+        return labels
+
+    def start(self):
+        logger.info("Concurrently starting all %d managed sensors", len(self._sensors))
+        super(SensorManager, self).start()  # Bypass the sequential startup of SensorManager
+        start_time = time.monotonic()
+
+        def _start_sensor(sensor):
+            with catch_and_log_exception(f"start of sensor {sensor.__class__.__name__}"):
+                sensor.start()
+                return time.monotonic() - start_time
+            return None  # Exception was logged
+
+        sensor_startup_latencies = {}
+        with ThreadPoolExecutor(
+            max_workers=max(1, len(self._sensors)), thread_name_prefix="sensor_startup"
+        ) as executor:
+            futures = {
+                executor.submit(_start_sensor, sensor): label
+                for (sensor, label) in zip(self._sensors, self._get_sensor_labels())
+            }
+            for future in as_completed(futures):  # Readiness barrier
+                label = futures[future]
+                startup_latency = future.result()
+                sensor_startup_latencies[label] = startup_latency
+                if startup_latency is None:
+                    logger.warning("Sensor %s failed to start", label)
+                else:
+                    logger.info("Sensor %s is ready after %.2fs", label, startup_latency)
+
+        self.sensor_startup_latencies = sensor_startup_latencies
+        return sum(1 for startup_latency in sensor_startup_latencies.values() if startup_latency is not None)
+
+
+def start_recording_toolchain(toolchain) -> dict:
     """
     Start all the sensors, thus ensuring that the toolchain begins to record end-to-end.
+
+    Returns a startup report, with the total startup duration, and the latencies of
+    sensors if the sensors manager is a ConcurrentSensorManager.
     """
+    start_time = time.monotonic()
 
     free_keys_generator_worker = toolchain["free_keys_generator_worker"]
     if free_keys_generator_worker:
@@ -19,20 +89,75 @@ def start_recording_toolchain(toolchain):
     else:
         logger.info("Ignoring the generator of free keys")
 
+    encryption_process_pool = toolchain.get("encryption_process_pool")  # Optional
+    if encryption_process_pool:
+        logger.info("Starting the payload encryption process pool")
+        encryption_process_pool.start()
+
+    activity_notification_bus = toolchain.get("activity_notification_bus")  # Optional
+    if activity_notification_bus:
+        logger.info("Starting the activity notification bus")
+        activity_notification_bus.start()
+
     sensors_manager = toolchain["sensors_manager"]
-    sensors_manager.start()
+    started_sensor_count = sensors_manager.start()
+
+    disk_budget_governor = toolchain.get("disk_budget_governor")  # Optional
+    if disk_budget_governor:
+        logger.info("Starting the disk budget governor")
+        disk_budget_governor.start()
+
+    startup_report = dict(
+        started_sensor_count=started_sensor_count,
+        sensor_startup_latencies=getattr(sensors_manager, "sensor_startup_latencies", None),
+        toolchain_startup_duration_s=time.monotonic() - start_time,
+    )
+    logger.info("Recording toolchain started in %.2fs", startup_report["toolchain_startup_duration_s"])
+    return startup_report
+
 
+def _run_concurrently_until_deadline(operations: dict, deadline: float, prerequisite_futures=()) -> dict:
+    """Run the callables of `operations` (a dict label -> callable) in parallel threads, once all
+    `prerequisite_futures` are done, and return a dict mapping the labels of operations still running
+    (or waiting for their prerequisites) at `deadline` to their futures (they go on in background)."""
+    if not operations:
+        return {}
+    prerequisite_futures = list(prerequisite_futures)
 
-def stop_recording_toolchain(toolchain):
+    def _run_after_prerequisites(label, operation):
+        futures_wait(prerequisite_futures)  # Previous phases might have exceeded the deadline
+        with catch_and_log_exception(f"toolchain stop operation {label}"):
+            operation()
+
+    executor = ThreadPoolExecutor(max_workers=len(operations), thread_name_prefix="toolchain_stop")
+    futures = {
+        executor.submit(_run_after_prerequisites, label, operation): label for (label, operation) in operations.items()
+    }
+    _done, not_done = futures_wait(futures, timeout=max(0, deadline - time.monotonic()))
+    executor.shutdown(wait=False)
+    return {futures[future]: future for future in sorted(not_done, key=futures.get)}
+
+
+def stop_recording_toolchain(toolchain, deadline_s: float = STOP_RECORDING_TOOLCHAIN_DEADLINE_S) -> dict:
     """
     Perform an ordered stop+flush of sensors and miscellaneous layers of aggregator.
 
+    Independent aggregators are flushed concurrently. Once `deadline_s` is exceeded, remaining phases
+    don't wait anymore for their operations, which go on in background threads, each phase still
+    starting only once the previous one is over (e.g. tarfiles are never finalized while
+    data aggregators are still flushing into them).
+
+    Returns a stop report, with the duration of each phase, and the operations still pending at deadline.
+
     All objets remain in a usable state
     """
 
     # TODO push all this to sensor manager!!
 
-    # logger.info("stop_recording_toolchain starts")
+    start_time = time.monotonic()
+    deadline = start_time + deadline_s
+    phase_durations_s = {}
+    pending_operations = []
 
     sensors_manager = toolchain["sensors_manager"]
     data_aggregators = toolchain["data_aggregators"]
@@ -40,6 +165,19 @@ def stop_recording_toolchain(toolchain):
     cryptainer_storage = toolchain["cryptainer_storage"]
     free_keys_generator_worker = toolchain["free_keys_generator_worker"]
 
+    def _end_phase(phase_name, phase_start_time):
+        phase_durations_s[phase_name] = time.monotonic() - phase_start_time
+        logger.info("Toolchain stop phase '%s' took %.2fs", phase_name, phase_durations_s[phase_name])
+        return time.monotonic()
+
+    phase_start_time = time.monotonic()
+
+    disk_budget_governor = toolchain.get("disk_budget_governor")
+    if disk_budget_governor:
+        logger.info("Stopping the disk budget governor")
+        disk_budget_governor.stop()
+        disk_budget_governor.join()  # Must not adapt sensors while they stop
+
     if free_keys_generator_worker:
         logger.info("Stopping the generator of free keys")
         free_keys_generator_worker.stop()
@@ -48,16 +186,74 @@ def stop_recording_toolchain(toolchain):
     sensors_manager.stop()
 
     # logger.info("Joining sensors manager")
-    sensors_manager.join()
+    sensors_manager.join()  # Sensors have their own timeouts when joining subprocesses and threads
+    phase_start_time = _end_phase("stop_sensors", phase_start_time)
 
-    for idx, data_aggregator in enumerate(data_aggregators, start=1):
+    pre_trigger_storage = toolchain.get("pre_trigger_storage")  # Optional
+    if pre_trigger_storage:
+        # Cryptainers of the last trigger are written to disk in background
+        pending_operations += list(
+            _run_concurrently_until_deadline(
+                {"pre-trigger cryptainer persistence": pre_trigger_storage.wait_for_idle_state}, deadline=deadline
+            )
+        )
+        phase_start_time = _end_phase("persist_pre_trigger_cryptainers", phase_start_time)
+
+    data_aggregator_operations = {}
+    for data_aggregator in data_aggregators:
         logger.info("Flushing '%s' data aggregator", data_aggregator.sensor_name)
-        data_aggregator.flush_payload()
+        label = "data aggregator '%s'" % data_aggregator.sensor_name
+        if label in data_aggregator_operations:
+            label += " #%d" % len(data_aggregator_operations)
+        data_aggregator_operations[label] = data_aggregator.flush_payload
+    pending_data_aggregator_futures = _run_concurrently_until_deadline(data_aggregator_operations, deadline=deadline)
+    pending_operations += list(pending_data_aggregator_futures)
+    phase_start_time = _end_phase("flush_data_aggregators", phase_start_time)
 
+    tarfile_aggregator_operations = {}
     for idx, tarfile_aggregator in enumerate(tarfile_aggregators, start=1):
         logger.info("Flushing tarfile builder %s", " #%d" % idx if len(tarfile_aggregators) > 1 else "")
-        tarfile_aggregator.finalize_tarfile()
+        tarfile_aggregator_operations["tarfile aggregator #%d" % idx] = tarfile_aggregator.finalize_tarfile
+    pending_tarfile_aggregator_futures = _run_concurrently_until_deadline(
+        tarfile_aggregator_operations,
+        deadline=deadline,
+        prerequisite_futures=pending_data_aggregator_futures.values(),
+    )
+    pending_operations += list(pending_tarfile_aggregator_futures)
+    phase_start_time = _end_phase("finalize_tarfile_aggregators", phase_start_time)
+
+    # Encryption workers must finish their job (this also purges exceeding cryptainers)
+    pending_operations += list(
+        _run_concurrently_until_deadline(
+            {"cryptainer encryption jobs": cryptainer_storage.wait_for_idle_state},
+            deadline=deadline,
+            prerequisite_futures=pending_tarfile_aggregator_futures.values(),
+        )
+    )
+    phase_start_time = _end_phase("wait_for_encryption", phase_start_time)
+
+    encryption_process_pool = toolchain.get("encryption_process_pool")
+    if encryption_process_pool:
+        logger.info("Stopping the payload encryption process pool")
+        encryption_process_pool.stop()  # All cryptainer streams were finalized when joining sensors
 
-    cryptainer_storage.wait_for_idle_state()  # Encryption workers must finish their job
+    activity_notification_bus = toolchain.get("activity_notification_bus")
+    if activity_notification_bus:
+        logger.info("Stopping the activity notification bus")
+        activity_notification_bus.stop()
+        activity_notification_bus.join()  # Delivers last notifications
+    _end_phase("stop_helpers", phase_start_time)
 
-    # logger.info("stop_recording_toolchain exits")
+    stop_report = dict(
+        phase_durations_s=phase_durations_s,
+        pending_operations=pending_operations,
+        toolchain_stop_duration_s=time.monotonic() - start_time,
+    )
+    if pending_operations:
+        logger.warning(
+            "Recording toolchain stop exceeded its %ss deadline, still pending: %s",
+            deadline_s,
+            ", ".join(pending_operations),
+        )
+    logger.info("Recording toolchain stopped in %.2fs", stop_report["toolchain_stop_duration_s"])
+    return stop_report
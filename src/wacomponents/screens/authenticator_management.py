@@ -18,6 +18,7 @@ from kivymd.uix.filemanager import MDFileManager
 from kivymd.uix.list import IconLeftWidget
 
 from wacomponents.default_settings import INTERNAL_AUTHENTICATOR_DIR, EXTERNAL_APP_ROOT, EXTERNAL_EXPORTS_DIR, IS_MOBILE
+from wacomponents.devices.device_inventory import get_device_inventory
 from wacomponents.i18n import tr
 from wacomponents.screens.base import WAScreenName, WAScreenBase
 from wacomponents.system_permissions import is_folder_readable, is_folder_writable
@@ -39,7 +40,6 @@ from wacomponents.widgets.popups import (
     display_info_toast,
 )
 from wacomponents.widgets.popups import safe_catch_unhandled_exception_and_display_popup
-from wacryptolib.authdevice import list_available_authdevices
 from wacryptolib.authenticator import is_authenticator_initialized
 from wacryptolib.exceptions import KeyLoadingError, SchemaValidationError, KeyDoesNotExist
 from wacryptolib.keygen import load_asymmetric_key_from_pem_bytestring
@@ -114,14 +114,15 @@ class AuthenticatorManagementScreen(LanguageSwitcherScreenMixin, WAScreenBase):
         self.refresh_authenticator_list()  # Refresh translation of Drive etc.
 
     @safe_catch_unhandled_exception_and_display_popup
-    def refresh_authenticator_list(self):
+    def refresh_authenticator_list(self, refresh_devices=False):
 
         logger.debug("Refreshing authenticator list")
 
-        try:
-            authdevice_list = list_available_authdevices()
-        except ModuleNotFoundError:  # probably on android, so no UDEV system
-            authdevice_list = []
+        device_inventory = get_device_inventory()
+        if refresh_devices:  # Explicit user request, so don't wait for the next hotplug polling
+            device_inventory.refresh(["authdevices"])
+        # None if probing failed, e.g. on android, where there is no UDEV system
+        authdevice_list = device_inventory.get_devices("authdevices") or []
 
         authenticator_list_widget = self.ids.authenticator_list
         authenticator_list_widget.clear_widgets()
@@ -12,6 +12,7 @@ from kivy.lang import Builder
 from kivy.properties import ObjectProperty
 from kivymd.uix.button import MDFlatButton
 
+from wacomponents.devices.device_inventory import get_device_inventory
 from wacomponents.i18n import tr
 from wacomponents.screens.base import WAScreenBase
 from wacomponents.utilities import (
@@ -28,7 +29,6 @@ from wacomponents.widgets.popups import (
     dialog_with_close_button,
     safe_catch_unhandled_exception_and_display_popup,
 )
-from wacryptolib.authdevice import list_available_authdevices
 from wacryptolib.authenticator import is_authenticator_initialized
 from wacryptolib.exceptions import SchemaValidationError, ExistenceError, ValidationError
 from wacryptolib.keystore import FilesystemKeystore, KEYSTORE_FORMAT, validate_keystore_tree
@@ -51,10 +51,18 @@ class ForeignKeystoreManagementScreen(WAScreenBase):
         pass
         # print("I am dispatched on_selected_keyguardians_changed", args)
 
+    def _invalidate_recording_toolchain(self):
+        # Imported keystores are not part of the config, so the recorder service must be told to reload them
+        service_controller = getattr(self._app, "service_controller", None)
+        if service_controller:
+            service_controller.invalidate_recording_toolchain()
+
     @staticmethod
     def _check_if_auth_devices_connected_or_initialized():
 
-        authdevices = list_available_authdevices()
+        device_inventory = get_device_inventory()
+        device_inventory.refresh(["authdevices"])  # User is about to import from a key which was just plugged
+        authdevices = device_inventory.get_devices("authdevices")
         # print("DETECTED AUTH DEVICES", authdevices)
 
         close_current_dialog()
@@ -130,6 +138,7 @@ class ForeignKeystoreManagementScreen(WAScreenBase):
         # Autoselect freshly imported keys
         new_keystore_uids = [metadata["keystore_uid"] for metadata in foreign_keystore_metadata]
         self._change_authenticator_selection_status(keystore_uids=new_keystore_uids, is_selected=True)
+        self._invalidate_recording_toolchain()
 
         display_info_toast(msg)
 
@@ -179,6 +188,7 @@ class ForeignKeystoreManagementScreen(WAScreenBase):
         self._change_authenticator_selection_status(
             keystore_uids=keystore_uids, is_selected=False
         )  # Update selection list
+        self._invalidate_recording_toolchain()
 
         msg = "Selected imported authentication devices were deleted"
         display_info_toast(msg)
@@ -403,6 +413,7 @@ class ForeignKeystoreManagementScreen(WAScreenBase):
 
             new_keystore_uids = [keystore_tree["keystore_uid"]]
             self._change_authenticator_selection_status(keystore_uids=new_keystore_uids, is_selected=True)
+            self._invalidate_recording_toolchain()
 
             display_info_toast(msg)
 
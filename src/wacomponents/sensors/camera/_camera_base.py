@@ -2,64 +2,337 @@
 # SPDX-FileCopyrightText: Copyright Prolifik SARL
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import functools
 import logging
+import os
+import subprocess
+import threading
+import time
 from pathlib import Path
 
 from wacomponents.application.recorder_service import ActivityNotificationType
-from wacryptolib.cryptainer import CryptainerEncryptionPipeline
+from wacryptolib.cryptainer import (
+    CryptainerEncryptionPipeline,
+    CryptainerEncryptor,
+    CRYPTAINER_TEMP_SUFFIX,
+    OFFLOADED_PAYLOAD_CIPHERTEXT_MARKER,
+    _get_offloaded_file_path,
+)
+from wacryptolib.sensor import PeriodicTaskHandler
+from wacryptolib.utilities import catch_and_log_exception
 
 logger = logging.getLogger(__name__)
 
 
+class LatestWinsTaskWorker:
+    """
+    Runs submitted callables one at a time, in a background thread.
+
+    A task submitted while another one is still pending REPLACES it, so that the worker never
+    lags behind with outdated work. The thread exits after some idle time, and is respawned on demand.
+    """
+
+    IDLE_TIMEOUT_S = 60
+
+    def __init__(self, name: str):
+        self._name = name
+        self._condition = threading.Condition()
+        self._pending_task = None
+        self._thread = None
+        self.superseded_task_count = 0
+
+    @property
+    def has_pending_task(self):
+        """True if a submitted task is waiting for the previous one to finish."""
+        return self._pending_task is not None
+
+    def submit(self, task):
+        with self._condition:
+            if self._pending_task is not None:
+                self.superseded_task_count += 1
+            self._pending_task = task
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._pending_task is None:
+                    self._condition.wait(timeout=self.IDLE_TIMEOUT_S)
+                    if self._pending_task is None:
+                        self._thread = None
+                        return
+                task, self._pending_task = self._pending_task, None
+            with catch_and_log_exception("LatestWinsTaskWorker._run of %s" % self._name):
+                task()
+
+
 class PreviewImageMixin:
 
     PREVIEW_IMAGE_WIDTH_PX = 140
     PREVIEW_IMAGE_HEIGHT_PX = 104
 
+    # If set, for subprocess-based sensors, preview images are decoded (with ffmpeg) from the beginning
+    # of each recorded segment, which must start with a keyframe, instead of using _do_generate_preview_image()
+    preview_image_stream_format = None  # E.g. "h264" or "mpegts"
+    PREVIEW_IMAGE_STREAM_SAMPLE_SIZE = 512 * 1024  # Enough for a keyframe in usual resolutions
+
     def __init__(self, preview_image_path: Path, **kwargs):
         super().__init__(**kwargs)
         self._preview_image_path = preview_image_path  # Can be empty
+        self._preview_image_worker = LatestWinsTaskWorker(name="%s_preview_image_worker" % self.__class__.__name__)
+        self._preview_image_statistics = dict(
+            generated_count=0,
+            failed_count=0,
+            last_generation_duration_s=None,
+            total_generation_duration_s=0.0,
+        )
+
+    def get_preview_image_statistics(self) -> dict:
+        """Return counters and timings of preview image generations (superseded ones were never run)."""
+        preview_image_statistics = self._preview_image_statistics.copy()
+        preview_image_statistics["superseded_count"] = self._preview_image_worker.superseded_task_count
+        return preview_image_statistics
 
     def _do_generate_preview_image(self, output, width_px, height_px):
         raise NotImplementedError("_generate_preview_image() not implemented")
 
+    def _get_preview_image_ffmpeg_filter(self, width_px, height_px):
+        return "scale=%d:%d" % (width_px, height_px)
+
+    def _do_extract_preview_image_from_stream_sample(self, stream_sample: bytes, output, width_px, height_px):
+        assert isinstance(output, str), output
+        tmp_output = output + ".tmp.jpg"  # Extension is required by ffmpeg
+        extraction_command_line = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            self.preview_image_stream_format,
+            "-i",
+            "pipe:0",
+            "-frames:v",
+            "1",  # First decodable frame
+            "-filter:v",
+            self._get_preview_image_ffmpeg_filter(width_px=width_px, height_px=height_px),
+            "-y",
+            tmp_output,
+        ]
+        logger.debug("Extracting preview image from stream with command: %s", " ".join(extraction_command_line))
+        subprocess.run(
+            extraction_command_line, input=stream_sample, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=20
+        )  # Truncated sample might make ffmpeg return an error code, yet after extracting the image
+        if not os.path.exists(tmp_output):
+            raise RuntimeError("Couldn't extract preview image from %d bytes of stream" % len(stream_sample))
+        os.replace(tmp_output, output)  # Atomic, so that readers never see a partial image
+
+    def _generate_preview_image_and_measure_duration(self, stream_sample=None):
+        start_time = time.monotonic()
+        try:
+            if stream_sample is not None:
+                self._do_extract_preview_image_from_stream_sample(
+                    stream_sample,
+                    str(self._preview_image_path),
+                    width_px=self.PREVIEW_IMAGE_WIDTH_PX,
+                    height_px=self.PREVIEW_IMAGE_HEIGHT_PX,
+                )
+            else:
+                self._do_generate_preview_image(
+                    str(self._preview_image_path),
+                    width_px=self.PREVIEW_IMAGE_WIDTH_PX,
+                    height_px=self.PREVIEW_IMAGE_HEIGHT_PX,
+                )
+        except Exception:
+            self._preview_image_statistics["failed_count"] += 1
+            raise
+        finally:
+            generation_duration_s = time.monotonic() - start_time
+            self._preview_image_statistics["last_generation_duration_s"] = generation_duration_s
+            self._preview_image_statistics["total_generation_duration_s"] += generation_duration_s
+            logger.info("Preview image generation of %s took %.2fs", self.__class__.__name__, generation_duration_s)
+        self._preview_image_statistics["generated_count"] += 1
+
+    def _discard_preview_image(self):
+        try:
+            self._preview_image_path.unlink()  # FIXME use "missing_ok" soon
+        except FileNotFoundError:
+            pass
+
     def _conditionally_regenerate_preview_image(self):
+        """Generation is delegated to a worker thread, and a newer request supersedes a still-pending one."""
         if self._preview_image_path:
             logger.debug("Requesting generation of new preview image to %s", self._preview_image_path)
 
-            # Cleanup potential previous preview image
-            try:
-                self._preview_image_path.unlink()  # FIXME use "missing_ok" soon
-            except FileNotFoundError:
-                pass
+            self._discard_preview_image()  # Cleanup potential previous preview image
 
-            self._do_generate_preview_image(
-                str(self._preview_image_path),
-                width_px=self.PREVIEW_IMAGE_WIDTH_PX,
-                height_px=self.PREVIEW_IMAGE_HEIGHT_PX,
-            )
+            self._preview_image_worker.submit(self._generate_preview_image_and_measure_duration)
+
+    def _submit_preview_image_extraction(self, stream_sample: bytes):
+        logger.debug("Requesting extraction of new preview image to %s", self._preview_image_path)
+        self._preview_image_worker.submit(
+            functools.partial(self._generate_preview_image_and_measure_duration, stream_sample=stream_sample)
+        )
 
     # HOOK for PeriodicSubprocessStreamRecorder-based sensors
     def _launch_and_consume_subprocess(self, *args, **kwargs):
-        self._conditionally_regenerate_preview_image()
+        if self.preview_image_stream_format:
+            if self._preview_image_path:
+                self._discard_preview_image()  # The new one will come from the stream
+        else:
+            self._conditionally_regenerate_preview_image()
         return super()._launch_and_consume_subprocess(*args, **kwargs)
 
+    # HOOK for SubprocessStreamRecorderBase-based sensors
+    def _on_segment_data(self, chunk, segment_offset, segment_state: dict):
+        super()._on_segment_data(chunk, segment_offset, segment_state=segment_state)
+        if not (self._preview_image_path and self.preview_image_stream_format):
+            return
+        stream_sample = segment_state.get("preview_image_stream_sample")
+        if stream_sample is None:
+            stream_sample = segment_state["preview_image_stream_sample"] = bytearray()
+        missing_length = self.PREVIEW_IMAGE_STREAM_SAMPLE_SIZE - len(stream_sample)
+        if missing_length > 0:
+            stream_sample += chunk[:missing_length]  # Copies data, since chunk buffer gets reused
+            if len(stream_sample) == self.PREVIEW_IMAGE_STREAM_SAMPLE_SIZE:
+                self._submit_preview_image_extraction(bytes(stream_sample))
+
+    # HOOK for SubprocessStreamRecorderBase-based sensors
+    def _on_segment_end(self, segment_state: dict):
+        super()._on_segment_end(segment_state=segment_state)
+        stream_sample = segment_state.get("preview_image_stream_sample")
+        if stream_sample and len(stream_sample) < self.PREVIEW_IMAGE_STREAM_SAMPLE_SIZE:
+            self._submit_preview_image_extraction(bytes(stream_sample))  # Short segment
+
+
+class ActivityNotificationBus(PeriodicTaskHandler):
+    """
+    Collects recording-progress updates posted by encryption streams, and delivers them from a background
+    thread, at most once per `dispatch_interval_s` for each source (sensor).
+
+    Posting an update is only a counter increment, so it can be done on the encryption hot path.
+    Remaining updates are delivered on `join()`.
+    """
+
+    def __init__(self, dispatch_interval_s: float = 0.5):
+        super().__init__(interval_s=dispatch_interval_s, runonstart=False)
+        self._bus_lock = threading.Lock()
+        self._recording_progress_callbacks = {}  # Maps source names to callables without arguments
+        self._pending_byte_counts = {}  # Maps source names to bytes recorded since last dispatch
+        self.posted_update_count = 0
+        self.dispatched_notification_count = 0
+
+    def register_recording_progress_source(self, source_name: str, callback):
+        assert callable(callback), callback
+        with self._bus_lock:
+            self._recording_progress_callbacks[source_name] = callback
+
+    def post_recording_progress(self, source_name: str, byte_count: int):
+        with self._bus_lock:
+            self._pending_byte_counts[source_name] = self._pending_byte_counts.get(source_name, 0) + byte_count
+            self.posted_update_count += 1
+
+    def _offloaded_run_task(self):
+        with self._bus_lock:
+            pending_byte_counts, self._pending_byte_counts = self._pending_byte_counts, {}
+        for source_name in pending_byte_counts:
+            callback = self._recording_progress_callbacks.get(source_name)
+            if callback is None:
+                logger.warning("No recording progress callback registered for source %r", source_name)
+                continue
+            with catch_and_log_exception("ActivityNotificationBus._offloaded_run_task"):
+                callback()
+                self.dispatched_notification_count += 1
 
-class CryptainerEncryptionPipelineWithRecordingProgressNotification(CryptainerEncryptionPipeline):
+    def join(self):
+        super().join()
+        self._offloaded_run_task()  # Deliver last updates
+
+
+class OffloadableCryptainerEncryptionPipeline(CryptainerEncryptionPipeline):
+    """
+    If an `encryption_process_pool` is provided, payload encryption (and writing of the offloaded payload file)
+    is delegated to one of its worker processes, else this class behaves like its parent.
+
+    Any object with a compatible `create_payload_encryption_pipeline()` method may be used as `encryption_process_pool`.
+    """
+
+    def __init__(
+        self,
+        cryptainer_filepath: Path,
+        *,
+        cryptoconf: dict,
+        cryptainer_metadata,
+        keystore_pool=None,
+        dump_initial_cryptainer=True,
+        encryption_process_pool=None,
+    ):
+        if encryption_process_pool is None:
+            super().__init__(
+                cryptainer_filepath,
+                cryptoconf=cryptoconf,
+                cryptainer_metadata=cryptainer_metadata,
+                keystore_pool=keystore_pool,
+                dump_initial_cryptainer=dump_initial_cryptainer,
+            )
+            return
+
+        # Mirrors CryptainerEncryptionPipeline.__init__(), except that payload secrets are handed to a worker
+        self._cryptainer_filepath = cryptainer_filepath
+        self._cryptainer_filepath_temp = cryptainer_filepath.with_suffix(
+            cryptainer_filepath.suffix + CRYPTAINER_TEMP_SUFFIX
+        )
+        self._cryptainer_encryptor = CryptainerEncryptor(keystore_pool=keystore_pool)
+        (
+            self._wip_cryptainer,
+            payload_cipher_layer_extracts,
+        ) = self._cryptainer_encryptor._generate_cryptainer_base_and_secrets(
+            cryptoconf=cryptoconf, cryptainer_metadata=cryptainer_metadata
+        )
+        self._wip_cryptainer["payload_ciphertext_struct"] = OFFLOADED_PAYLOAD_CIPHERTEXT_MARKER  # Important
+
+        self._encryption_pipeline = encryption_process_pool.create_payload_encryption_pipeline(
+            _get_offloaded_file_path(cryptainer_filepath), payload_cipher_layer_extracts
+        )
+        self._output_data_stream = self._encryption_pipeline  # Actual file is owned by worker process
+
+        if dump_initial_cryptainer:  # Savegame in case the stream is broken before finalization
+            self._dump_current_cryptainer_to_filesystem(is_temporary=True)
+
+
+class CryptainerEncryptionPipelineWithRecordingProgressNotification(OffloadableCryptainerEncryptionPipeline):
+    """
+    Notifies recording progress either by calling `recording_progress_notification_callback` every
+    PROGRESS_BYTE_THRESHOLD bytes, or by posting each chunk length to `recording_progress_bus`.
+    """
 
     # We send notifications only when a certain amount of bytes was recorded
     PROGRESS_BYTE_THRESHOLD = 100 * 1024
 
-    def __init__(self, *args, recording_progress_notification_callback=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        recording_progress_notification_callback=None,
+        recording_progress_bus: ActivityNotificationBus = None,
+        recording_progress_source_name: str = None,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
         assert recording_progress_notification_callback is None or callable(
             recording_progress_notification_callback
         ), recording_progress_notification_callback
+        assert not recording_progress_bus or recording_progress_source_name, recording_progress_source_name
         self._recording_progress_notification_callback = recording_progress_notification_callback
+        self._recording_progress_bus = recording_progress_bus
+        self._recording_progress_source_name = recording_progress_source_name
         self._pending_byte_count = 0
 
     def encrypt_chunk(self, chunk: bytes, *args, **kwargs):
-        if self._recording_progress_notification_callback:
+        if self._recording_progress_bus:
+            self._recording_progress_bus.post_recording_progress(self._recording_progress_source_name, len(chunk))
+        elif self._recording_progress_notification_callback:
             self._pending_byte_count += len(chunk)
             if self._pending_byte_count > self.PROGRESS_BYTE_THRESHOLD:
                 self._recording_progress_notification_callback()
@@ -68,24 +341,66 @@ class CryptainerEncryptionPipelineWithRecordingProgressNotification(CryptainerEn
         return super().encrypt_chunk(chunk, *args, **kwargs)
 
 
+class EncryptionProcessPoolMixin:
+    """To be used with subclass of PeriodicEncryptionStreamMixin, BEFORE ActivityNotificationMixin in bases.
+
+    If an `encryption_process_pool` is provided, the payload encryption of cryptainers is offloaded to it."""
+
+    def __init__(self, *args, encryption_process_pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encryption_process_pool = encryption_process_pool
+
+    def _get_cryptainer_encryption_stream_creation_kwargs(self) -> dict:
+        creation_kwargs = super()._get_cryptainer_encryption_stream_creation_kwargs()
+        if self._encryption_process_pool:
+            cryptainer_encryption_stream_class = creation_kwargs.setdefault(
+                "cryptainer_encryption_stream_class", OffloadableCryptainerEncryptionPipeline
+            )
+            assert issubclass(
+                cryptainer_encryption_stream_class, OffloadableCryptainerEncryptionPipeline
+            ), cryptainer_encryption_stream_class
+            cryptainer_encryption_stream_extra_kwargs = creation_kwargs.setdefault(
+                "cryptainer_encryption_stream_extra_kwargs", {}
+            )
+            cryptainer_encryption_stream_extra_kwargs["encryption_process_pool"] = self._encryption_process_pool
+        return creation_kwargs
+
+
 class ActivityNotificationMixin:
-    """To be used mainly with subclass of PeriodicEncryptionStreamMixin"""
+    """To be used mainly with subclass of PeriodicEncryptionStreamMixin
+
+    If an `activity_notification_bus` is provided, recording-progress notifications are coalesced by it,
+    instead of being sent synchronously from encryption threads."""
 
     activity_notification_color = None  # RGB tuple, to be overridden in subclass
 
-    def __init__(self, *args, activity_notification_callback, **kwargs):
+    def __init__(
+        self, *args, activity_notification_callback, activity_notification_bus: ActivityNotificationBus = None, **kwargs
+    ):
         super().__init__(*args, **kwargs)
         assert self.activity_notification_color, "missing activity_notification_color"
         self._activity_notification_callback = activity_notification_callback
+        self._activity_notification_bus = activity_notification_bus
 
     def _get_cryptainer_encryption_stream_creation_kwargs(self) -> dict:
         recording_progress_notification_callback = lambda: self._activity_notification_callback(
             notification_type=ActivityNotificationType.RECORDING_PROGRESS,
             notification_color=self.activity_notification_color,
         )
+        if self._activity_notification_bus:
+            # Registered lazily, since sensor_name might be overridden per-instance after __init__()
+            self._activity_notification_bus.register_recording_progress_source(
+                self.sensor_name, callback=recording_progress_notification_callback
+            )
+            cryptainer_encryption_stream_extra_kwargs = {
+                "recording_progress_bus": self._activity_notification_bus,
+                "recording_progress_source_name": self.sensor_name,
+            }
+        else:
+            cryptainer_encryption_stream_extra_kwargs = {
+                "recording_progress_notification_callback": recording_progress_notification_callback
+            }
         return {
             "cryptainer_encryption_stream_class": CryptainerEncryptionPipelineWithRecordingProgressNotification,
-            "cryptainer_encryption_stream_extra_kwargs": {
-                "recording_progress_notification_callback": recording_progress_notification_callback
-            },
+            "cryptainer_encryption_stream_extra_kwargs": cryptainer_encryption_stream_extra_kwargs,
         }
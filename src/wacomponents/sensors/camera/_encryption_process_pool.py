@@ -0,0 +1,385 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Offloading of payload encryption to worker processes, so that several sensors can use several CPU cores
+despite the GIL.
+
+Each cryptainer stream is pinned to a single worker process, which owns its offloaded payload file and
+its cipher states, so that chunks get encrypted and written in submission order. Chunk data is
+transferred through reusable shared-memory buffers, only their names and lengths go through pipes.
+
+Beware, payload symmetric keys are thus sent to worker processes (through local pipes).
+"""
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+
+from wacryptolib.cryptainer import PayloadEncryptionPipeline
+
+logger = logging.getLogger(__name__)
+
+SHARED_MEMORY_BUFFER_ALIGNMENT = 1024**2
+
+_OPEN_COMMAND = "open"
+_ENCRYPT_COMMAND = "encrypt"
+_FINALIZE_COMMAND = "finalize"
+_FORGET_BUFFER_COMMAND = "forget_buffer"
+
+_BUFFER_RELEASED_RESULT = "buffer_released"
+_FINALIZED_RESULT = "finalized"
+_FAILED_RESULT = "failed"
+
+
+def _attach_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _disable_shared_memory_tracking():
+    # Buffers are owned (and unlinked) by the main process, but before python3.13 merely attaching to
+    # them registers them to the resource tracker, which then warns about (or destroys) them
+    from multiprocessing import resource_tracker
+
+    original_register = resource_tracker.register
+
+    def _register(name, rtype):
+        if rtype != "shared_memory":
+            original_register(name, rtype)
+
+    resource_tracker.register = _register
+
+
+def _encryption_worker_main(worker_index, command_queue, result_queue):
+    """Loop of worker processes, until a None command is received."""
+    _disable_shared_memory_tracking()
+    attached_buffers = {}  # Maps buffer names to SharedMemory instances
+    payload_pipelines = {}  # Maps stream ids to (PayloadEncryptionPipeline, output file) tuples
+    stream_errors = {}  # Maps stream ids to the first error they encountered
+
+    def _abort_stream(stream_id, exc):
+        logger.error("Error in payload encryption worker #%d for stream %s: %r", worker_index, stream_id, exc)
+        stream_errors.setdefault(stream_id, repr(exc))
+        payload_pipeline_and_file = payload_pipelines.pop(stream_id, None)
+        if payload_pipeline_and_file:
+            payload_pipeline_and_file[1].close()
+
+    while True:
+        command = command_queue.get()
+        if command is None:
+            break
+        command_type, stream_id, *command_args = command
+
+        if command_type == _OPEN_COMMAND:
+            offloaded_file_path, payload_cipher_layer_extracts = command_args
+            try:
+                output_stream = open(offloaded_file_path, mode="wb")
+                payload_pipelines[stream_id] = (
+                    PayloadEncryptionPipeline(output_stream, payload_cipher_layer_extracts),
+                    output_stream,
+                )
+            except Exception as exc:
+                _abort_stream(stream_id, exc)
+
+        elif command_type == _ENCRYPT_COMMAND:
+            buffer_name, chunk_length = command_args
+            chunk = None
+            try:
+                shm = attached_buffers.get(buffer_name)
+                if shm is None:
+                    shm = attached_buffers[buffer_name] = _attach_shared_memory(buffer_name)
+                chunk = bytes(shm.buf[:chunk_length])  # Copy, so that buffer can be reused at once
+            except Exception as exc:
+                _abort_stream(stream_id, exc)  # A missing chunk would corrupt the whole payload
+            finally:
+                result_queue.put((_BUFFER_RELEASED_RESULT, worker_index, buffer_name))
+            if chunk is not None and stream_id in payload_pipelines:
+                try:
+                    payload_pipelines[stream_id][0].encrypt_chunk(chunk)
+                except Exception as exc:
+                    _abort_stream(stream_id, exc)
+
+        elif command_type == _FINALIZE_COMMAND:
+            payload_integrity_tags = None
+            if stream_id in payload_pipelines:
+                payload_pipeline, output_stream = payload_pipelines.pop(stream_id)
+                try:
+                    payload_pipeline.finalize()
+                    payload_integrity_tags = payload_pipeline.get_payload_integrity_tags()
+                except Exception as exc:
+                    _abort_stream(stream_id, exc)
+                finally:
+                    output_stream.close()
+            if stream_id in stream_errors:
+                result_queue.put((_FAILED_RESULT, stream_id, stream_errors.pop(stream_id)))
+            else:
+                result_queue.put((_FINALIZED_RESULT, stream_id, payload_integrity_tags))
+
+        elif command_type == _FORGET_BUFFER_COMMAND:
+            (buffer_name,) = command_args
+            shm = attached_buffers.pop(buffer_name, None)
+            if shm is not None:
+                shm.close()
+
+        else:
+            raise ValueError("Unknown encryption worker command %r" % command_type)
+
+    for shm in attached_buffers.values():
+        shm.close()
+    for stream_id, (payload_pipeline, output_stream) in payload_pipelines.items():
+        logger.warning("Payload encryption worker #%d exits with unfinalized stream %s", worker_index, stream_id)
+        output_stream.close()
+
+
+class _EncryptionWorkerChannel:
+    """State kept by main process for each worker process."""
+
+    def __init__(self, worker_index, process, command_queue):
+        self.worker_index = worker_index
+        self.process = process
+        self.command_queue = command_queue
+        self.condition = threading.Condition()
+        self.buffers = {}  # Maps names to all SharedMemory buffers of this channel
+        self.free_buffer_names = []
+        self.open_stream_count = 0
+
+
+class PooledPayloadEncryptionPipeline:
+    """
+    Stand-in for PayloadEncryptionPipeline, delegating encryption to a worker process.
+
+    It also mimics the file object API used by CryptainerEncryptionPipeline for its output stream,
+    since the offloaded payload file is owned by the worker process.
+    """
+
+    closed = False
+
+    def __init__(self, encryption_process_pool, channel: _EncryptionWorkerChannel, stream_id: int):
+        self._encryption_process_pool = encryption_process_pool
+        self._channel = channel
+        self._stream_id = stream_id
+        self._payload_integrity_tags = None
+
+    def encrypt_chunk(self, chunk):
+        assert not self.closed
+        chunk_length = len(chunk)
+        if not chunk_length:
+            return
+        shm = self._encryption_process_pool._acquire_buffer(self._channel, chunk_length)
+        shm.buf[:chunk_length] = chunk
+        self._channel.command_queue.put((_ENCRYPT_COMMAND, self._stream_id, shm.name, chunk_length))
+
+    def finalize(self):
+        assert not self.closed
+        self._payload_integrity_tags = self._encryption_process_pool._finalize_stream(self._channel, self._stream_id)
+
+    def get_payload_integrity_tags(self) -> list:
+        assert self._payload_integrity_tags is not None
+        return self._payload_integrity_tags
+
+    def close(self):
+        self.closed = True
+
+
+class EncryptionProcessPool:
+    """
+    Pool of worker processes performing the symmetric encryption of cryptainer payloads.
+
+    Must be started before creating pipelines, and stopped once all of them are finalized.
+
+    Worker processes are not forked by default, since forking a multithreaded process (e.g. with
+    its locks held by other threads) is unsafe; "forkserver" is used if available, else "spawn".
+
+    A dead worker process makes its pinned streams fail, and is replaced by a new one when the next stream is created.
+    """
+
+    FINALIZATION_TIMEOUT_S = 60
+    WORKER_JOIN_TIMEOUT_S = 15
+    WORKER_LIVENESS_CHECK_INTERVAL_S = 2  # While waiting for a free buffer or a finalization
+    RESULT_POLLING_INTERVAL_S = 0.2  # Delay for the result reader thread to notice that pool is stopped
+
+    _channels = ()
+    _result_reader_thread = None
+    _result_reader_stop_event = None
+    _result_queue = None
+
+    def __init__(self, process_count=None, max_buffers_per_process=4, multiprocessing_context=None):
+        self._process_count = process_count or max(1, (multiprocessing.cpu_count() or 1) - 1)
+        assert max_buffers_per_process > 0, max_buffers_per_process
+        self._max_buffers_per_process = max_buffers_per_process
+        if multiprocessing_context is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            multiprocessing_context = multiprocessing.get_context(start_method)
+        self._multiprocessing_context = multiprocessing_context
+        self._stream_ids = itertools.count()
+        self._pending_finalizations = {}  # Maps stream ids to [Event, result type, result] lists
+        self._dead_channels = []  # Replaced channels, whose buffers might still be used by failing streams
+        self._pool_lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return bool(self._channels)
+
+    def start(self):
+        if self._channels:
+            raise RuntimeError("Can't start an already started encryption process pool")
+        logger.info("Starting %d payload encryption worker processes", self._process_count)
+        self._result_queue = self._multiprocessing_context.Queue()
+        self._result_reader_stop_event = threading.Event()
+        self._channels = [self._start_worker(worker_index) for worker_index in range(self._process_count)]
+        self._result_reader_thread = threading.Thread(
+            target=self._read_results, name="payload_encryption_result_reader", daemon=True
+        )
+        self._result_reader_thread.start()
+
+    def stop(self):
+        """Terminate worker processes and release shared memory. Streams must have been finalized beforehand."""
+        if not self._channels:
+            raise RuntimeError("Can't stop an already stopped encryption process pool")
+        logger.info("Stopping %d payload encryption worker processes", len(self._channels))
+        channels, self._channels = self._channels, ()
+        for channel in channels:
+            channel.command_queue.put(None)
+        channels += self._dead_channels
+        self._dead_channels = []
+        for channel in channels:
+            channel.process.join(timeout=self.WORKER_JOIN_TIMEOUT_S)
+            if channel.process.is_alive():
+                logger.critical("Payload encryption worker #%d didn't exit, terminating it", channel.worker_index)
+                channel.process.terminate()
+            for shm in channel.buffers.values():
+                shm.close()
+                shm.unlink()
+        # No sentinel is pushed to the result queue, since a killed worker might have left its write lock acquired
+        self._result_reader_stop_event.set()
+        self._result_reader_thread.join()
+
+    def _start_worker(self, worker_index) -> _EncryptionWorkerChannel:
+        command_queue = self._multiprocessing_context.Queue()
+        process = self._multiprocessing_context.Process(
+            target=_encryption_worker_main,
+            args=(worker_index, command_queue, self._result_queue),
+            name="payload_encryption_worker_%d" % worker_index,
+            daemon=True,
+        )
+        process.start()
+        return _EncryptionWorkerChannel(worker_index, process=process, command_queue=command_queue)
+
+    def _replace_dead_workers(self):
+        """Must be called under the pool lock."""
+        for worker_index, channel in enumerate(self._channels):
+            if not channel.process.is_alive():
+                logger.error(
+                    "Payload encryption worker #%d is dead (exit code %s), respawning it",
+                    worker_index,
+                    channel.process.exitcode,
+                )
+                self._dead_channels.append(channel)
+                self._channels[worker_index] = self._start_worker(worker_index)
+
+    def create_payload_encryption_pipeline(
+        self, offloaded_file_path: Path, payload_cipher_layer_extracts: list
+    ) -> PooledPayloadEncryptionPipeline:
+        """Pin a new stream to the least busy worker, and return its pipeline."""
+        if not self._channels:
+            raise RuntimeError("Encryption process pool is not started")
+        with self._pool_lock:
+            self._replace_dead_workers()
+            channel = min(self._channels, key=lambda _channel: _channel.open_stream_count)
+            channel.open_stream_count += 1
+            stream_id = next(self._stream_ids)
+            self._pending_finalizations[stream_id] = [threading.Event(), None, None]
+        channel.command_queue.put((_OPEN_COMMAND, stream_id, str(offloaded_file_path), payload_cipher_layer_extracts))
+        return PooledPayloadEncryptionPipeline(self, channel=channel, stream_id=stream_id)
+
+    def _acquire_buffer(self, channel, minimum_size):
+        with channel.condition:
+            while True:
+                fitting_buffer_names = [
+                    name for name in channel.free_buffer_names if channel.buffers[name].size >= minimum_size
+                ]
+                if fitting_buffer_names:
+                    buffer_name = min(fitting_buffer_names, key=lambda name: channel.buffers[name].size)
+                    channel.free_buffer_names.remove(buffer_name)
+                    return channel.buffers[buffer_name]
+
+                if len(channel.buffers) < self._max_buffers_per_process:
+                    buffer_size = -(-minimum_size // SHARED_MEMORY_BUFFER_ALIGNMENT) * SHARED_MEMORY_BUFFER_ALIGNMENT
+                    shm = shared_memory.SharedMemory(create=True, size=buffer_size)
+                    channel.buffers[shm.name] = shm
+                    return shm
+
+                if channel.free_buffer_names:  # Free buffers are all too small, replace one of them
+                    buffer_name = channel.free_buffer_names.pop()
+                    shm = channel.buffers.pop(buffer_name)
+                    channel.command_queue.put((_FORGET_BUFFER_COMMAND, None, buffer_name))
+                    shm.close()
+                    shm.unlink()  # Memory is actually freed once worker closes it too
+                    continue
+
+                if not channel.process.is_alive():
+                    raise RuntimeError(
+                        "Payload encryption worker #%d is dead (exit code %s)"
+                        % (channel.worker_index, channel.process.exitcode)
+                    )
+                # Backpressure, until the worker consumes a buffer
+                channel.condition.wait(timeout=self.WORKER_LIVENESS_CHECK_INTERVAL_S)
+
+    def _finalize_stream(self, channel, stream_id):
+        channel.command_queue.put((_FINALIZE_COMMAND, stream_id))
+        finalization_event, _, _ = self._pending_finalizations[stream_id]
+        deadline = time.monotonic() + self.FINALIZATION_TIMEOUT_S
+        worker_is_alive = True
+        while worker_is_alive and time.monotonic() < deadline:
+            worker_is_alive = channel.process.is_alive()  # Checked BEFORE waiting, since result might be in transit
+            if finalization_event.wait(timeout=self.WORKER_LIVENESS_CHECK_INTERVAL_S):
+                break
+        finalized = finalization_event.is_set()
+        with self._pool_lock:
+            _, result_type, result = self._pending_finalizations.pop(stream_id)
+            channel.open_stream_count -= 1
+        if not finalized:
+            if not worker_is_alive:
+                raise RuntimeError(
+                    "Payload encryption worker #%d is dead (exit code %s)"
+                    % (channel.worker_index, channel.process.exitcode)
+                )
+            raise RuntimeError("Payload encryption worker #%d didn't finalize stream in time" % channel.worker_index)
+        if result_type == _FAILED_RESULT:
+            raise RuntimeError("Payload encryption worker #%d failed: %s" % (channel.worker_index, result))
+        return result
+
+    def _read_results(self):
+        while True:
+            try:
+                result = self._result_queue.get(timeout=self.RESULT_POLLING_INTERVAL_S)
+            except queue.Empty:
+                if self._result_reader_stop_event.is_set():
+                    break
+                continue
+            result_type, *result_args = result
+            if result_type == _BUFFER_RELEASED_RESULT:
+                worker_index, buffer_name = result_args
+                channel = self._channels[worker_index] if self._channels else None
+                if channel is not None:
+                    with channel.condition:
+                        if buffer_name in channel.buffers:
+                            channel.free_buffer_names.append(buffer_name)
+                            channel.condition.notify()
+            else:
+                stream_id, stream_result = result_args
+                with self._pool_lock:
+                    pending_finalization = self._pending_finalizations.get(stream_id)
+                if pending_finalization is None:
+                    continue  # Finalization already timed out
+                pending_finalization[1:] = [result_type, stream_result]
+                pending_finalization[0].set()
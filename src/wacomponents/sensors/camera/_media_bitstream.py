@@ -0,0 +1,70 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Lightweight inspection of media bitstreams (MPEG-TS packets...), meant to be used on chunks
+of data flowing from sensor subprocesses, without decoding them.
+"""
+
+from typing import Optional
+
+MPEGTS_PACKET_SIZE = 188
+MPEGTS_SYNC_BYTE = 0x47
+
+_PES_START_CODE_PREFIX = b"\x00\x00\x01"
+_PES_VIDEO_STREAM_IDS = range(0xE0, 0xF0)
+
+
+def get_first_mpegts_packet_offset(buffer_length: int, stream_offset: int) -> Optional[int]:
+    """Return the offset, in a buffer starting at absolute position `stream_offset` of the stream,
+    of the first mpegts packet boundary (or None if the buffer contains none)."""
+    first_packet_offset = (-stream_offset) % MPEGTS_PACKET_SIZE
+    if first_packet_offset >= buffer_length:
+        return None
+    return first_packet_offset
+
+
+def is_mpegts_video_random_access_packet(buffer, packet_offset: int) -> bool:
+    """Return True iff the complete mpegts packet at `packet_offset` starts a video keyframe.
+
+    This relies on the "random access indicator" flag of the adaptation field, and on the
+    stream id of the PES packet starting there (since muxers also flag audio frames this way).
+    """
+    packet = buffer[packet_offset : packet_offset + MPEGTS_PACKET_SIZE]
+    if len(packet) < MPEGTS_PACKET_SIZE or packet[0] != MPEGTS_SYNC_BYTE:
+        return False
+
+    payload_unit_start_indicator = packet[1] & 0x40
+    adaptation_field_control = (packet[3] >> 4) & 0x03
+    if not payload_unit_start_indicator or not (adaptation_field_control & 0x02):
+        return False
+
+    adaptation_field_length = packet[4]
+    if not adaptation_field_length or not (packet[5] & 0x40):  # Random access indicator
+        return False
+
+    pes_offset = 5 + adaptation_field_length
+    pes_header = bytes(packet[pes_offset : pes_offset + 4])
+    return (
+        len(pes_header) == 4
+        and pes_header.startswith(_PES_START_CODE_PREFIX)
+        and pes_header[3] in _PES_VIDEO_STREAM_IDS
+    )
+
+
+def find_mpegts_video_random_access_offset(buffer, stream_offset: int) -> Optional[int]:
+    """Return the offset, in a buffer starting at absolute position `stream_offset` of a mpegts stream,
+    of the first packet which starts a video keyframe (or None if not found).
+
+    Packets are assumed to be aligned on the start of the stream; the search stops at the first loss of sync.
+    """
+    first_packet_offset = get_first_mpegts_packet_offset(len(buffer), stream_offset=stream_offset)
+    if first_packet_offset is None:
+        return None
+    for packet_offset in range(first_packet_offset, len(buffer) - MPEGTS_PACKET_SIZE + 1, MPEGTS_PACKET_SIZE):
+        if buffer[packet_offset] != MPEGTS_SYNC_BYTE:
+            return None  # Stream is corrupted or not mpegts, don't go further
+        if is_mpegts_video_random_access_packet(buffer, packet_offset):
+            return packet_offset
+    return None
@@ -0,0 +1,268 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Pre-trigger recording mode, where encrypted segments (cryptainers) of sensors are kept in a memory ring buffer,
+and only written to the cryptainer storage around events (button press, external signal...).
+"""
+
+import collections
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from wacryptolib.cryptainer import (
+    PAYLOAD_CIPHERTEXT_LOCATIONS,
+    PayloadEncryptionPipeline,
+    dump_cryptainer_to_filesystem,
+)
+from wacryptolib.utilities import catch_and_log_exception
+
+from wacomponents.sensors.camera._camera_base import CryptainerEncryptionPipelineWithRecordingProgressNotification
+
+logger = logging.getLogger(__name__)
+
+
+class _InMemoryPayloadEncryptionPipeline(PayloadEncryptionPipeline):
+    """Payload encryption pipeline which keeps its ciphertext in memory, even once closed."""
+
+    closed = False
+
+    def __init__(self, payload_cipher_layer_extracts: list):
+        self._payload_ciphertext_stream = io.BytesIO()
+        super().__init__(
+            output_stream=self._payload_ciphertext_stream, payload_cipher_layer_extracts=payload_cipher_layer_extracts
+        )
+
+    def close(self):
+        self.closed = True
+
+    def get_payload_ciphertext(self) -> bytes:
+        return self._payload_ciphertext_stream.getvalue()
+
+
+class PreTriggerCryptainerEncryptionPipeline(CryptainerEncryptionPipelineWithRecordingProgressNotification):
+    """
+    Cryptainer encryption stream which encrypts its payload in memory, and hands the finalized cryptainer
+    to a PreTriggerCryptainerStorage instead of dumping it to disk.
+    """
+
+    def __init__(self, *args, pre_trigger_storage: "PreTriggerCryptainerStorage", **kwargs):
+        self._segment_start_timestamp = pre_trigger_storage.get_current_timestamp()
+        kwargs["encryption_process_pool"] = pre_trigger_storage  # Provides in-memory payload encryption pipelines
+        self._pre_trigger_storage = pre_trigger_storage
+        super().__init__(*args, **kwargs)
+
+    def _dump_current_cryptainer_to_filesystem(self, is_temporary):
+        if is_temporary:
+            return  # No savegame, since payload is not on disk anyway
+        self._pre_trigger_storage._add_finalized_segment(
+            cryptainer_filepath=self._cryptainer_filepath,
+            cryptainer=self._wip_cryptainer,
+            payload_ciphertext=self._encryption_pipeline.get_payload_ciphertext(),
+            start_timestamp=self._segment_start_timestamp,
+            end_timestamp=self._pre_trigger_storage.get_current_timestamp(),
+        )
+
+
+class PreTriggerCryptainerStorage:
+    """
+    Stand-in for a CryptainerStorage, to be given to sensors instead of it, so that they record in pre-trigger mode.
+
+    Cryptainers of sensors are fully encrypted in memory, and then kept in a ring buffer covering the last
+    `pre_trigger_duration_s` seconds (and at most `max_buffered_payload_size` bytes). When `trigger()` is called,
+    buffered cryptainers are written to the underlying `cryptainer_storage`, as well as all cryptainers
+    overlapping the next `post_trigger_duration_s` seconds; other cryptainers are discarded.
+
+    Sensors should use short recording intervals in this mode, since whole cryptainers are kept or discarded.
+    Cryptainers still buffered when recording stops are discarded.
+
+    Cryptainers are written to disk by a background worker, which then applies the purge limits (count, age,
+    quota) of the underlying `cryptainer_storage`; `clock` provides all timestamps of this storage.
+    """
+
+    def __init__(
+        self,
+        cryptainer_storage,
+        pre_trigger_duration_s: float,
+        post_trigger_duration_s: float,
+        max_buffered_payload_size: int = 64 * 1024**2,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        assert pre_trigger_duration_s >= 0, pre_trigger_duration_s
+        assert post_trigger_duration_s >= 0, post_trigger_duration_s
+        assert max_buffered_payload_size > 0, max_buffered_payload_size
+        self._cryptainer_storage = cryptainer_storage
+        self._pre_trigger_duration_s = pre_trigger_duration_s
+        self._post_trigger_duration_s = post_trigger_duration_s
+        self._max_buffered_payload_size = max_buffered_payload_size
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._buffered_segments = collections.deque()  # Oldest first
+        self._persist_until_timestamp = None  # From clock, end of post-trigger window
+        self._persistence_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pre_trigger_persistence")
+        self._pending_persistence_futures = []
+        self._statistics = dict(
+            trigger_count=0,
+            buffered_segment_count=0,
+            buffered_payload_size=0,
+            persisted_segment_count=0,
+            persisted_payload_size=0,
+            discarded_segment_count=0,
+            discarded_payload_size=0,
+        )
+
+    def get_current_timestamp(self) -> float:
+        """Return the current time, according to the clock of this storage."""
+        return self._clock()
+
+    def get_pre_trigger_statistics(self) -> dict:
+        """Return a snapshot of counters regarding buffered, persisted and discarded cryptainers."""
+        with self._lock:
+            return self._statistics.copy()
+
+    def create_cryptainer_encryption_stream(
+        self,
+        filename_base,
+        cryptainer_metadata,
+        cryptoconf=None,
+        dump_initial_cryptainer=True,
+        cryptainer_encryption_stream_class=None,
+        cryptainer_encryption_stream_extra_kwargs=None,
+    ):
+        """Same signature as CryptainerStorage.create_cryptainer_encryption_stream()."""
+        if cryptainer_encryption_stream_class and not issubclass(
+            PreTriggerCryptainerEncryptionPipeline, cryptainer_encryption_stream_class
+        ):
+            raise ValueError(
+                "Unsupported cryptainer encryption stream class %s in pre-trigger mode"
+                % cryptainer_encryption_stream_class.__name__
+            )
+        cryptainer_encryption_stream_extra_kwargs = dict(
+            cryptainer_encryption_stream_extra_kwargs or {}, pre_trigger_storage=self
+        )
+        return self._cryptainer_storage.create_cryptainer_encryption_stream(
+            filename_base,
+            cryptainer_metadata=cryptainer_metadata,
+            cryptoconf=cryptoconf,
+            dump_initial_cryptainer=False,
+            cryptainer_encryption_stream_class=PreTriggerCryptainerEncryptionPipeline,
+            cryptainer_encryption_stream_extra_kwargs=cryptainer_encryption_stream_extra_kwargs,
+        )
+
+    def delete_cryptainer(self, cryptainer_name):
+        """Same as CryptainerStorage.delete_cryptainer(), but buffered cryptainers are just forgotten."""
+        with self._lock:
+            for segment in self._buffered_segments:
+                if segment["cryptainer_filepath"].name == cryptainer_name:
+                    self._buffered_segments.remove(segment)
+                    self._statistics["buffered_segment_count"] -= 1
+                    self._statistics["buffered_payload_size"] -= len(segment["payload_ciphertext"])
+                    return
+        self.wait_for_idle_state()  # Cryptainer might be being persisted
+        try:
+            self._cryptainer_storage.delete_cryptainer(cryptainer_name)
+        except FileNotFoundError:
+            pass  # Already discarded from buffer
+
+    def create_payload_encryption_pipeline(self, offloaded_file_path: Path, payload_cipher_layer_extracts: list):
+        """Duck-typed like EncryptionProcessPool.create_payload_encryption_pipeline(), but nothing is written."""
+        return _InMemoryPayloadEncryptionPipeline(payload_cipher_layer_extracts)
+
+    def trigger(self, trigger_timestamp: Optional[float] = None):
+        """
+        Persist the buffered cryptainers, and those overlapping the post-trigger window.
+
+        `trigger_timestamp` defaults to now, else it must come from the clock of this storage.
+        Cryptainers are only enqueued for persistence, see `wait_for_idle_state()`.
+        """
+        if trigger_timestamp is None:
+            trigger_timestamp = self.get_current_timestamp()
+        with self._lock:
+            self._statistics["trigger_count"] += 1
+            persist_until_timestamp = trigger_timestamp + self._post_trigger_duration_s
+            if self._persist_until_timestamp is None or persist_until_timestamp > self._persist_until_timestamp:
+                self._persist_until_timestamp = persist_until_timestamp
+            self._discard_expired_segments(now=trigger_timestamp)
+            segments_to_persist = list(self._buffered_segments)
+            self._buffered_segments.clear()
+            self._statistics["buffered_segment_count"] = 0
+            self._statistics["buffered_payload_size"] = 0
+            logger.info(
+                "Pre-trigger storage got triggered, persisting %d buffered cryptainers", len(segments_to_persist)
+            )
+            for segment in segments_to_persist:
+                self._enqueue_segment_for_persistence(segment)
+
+    def wait_for_idle_state(self):
+        """Wait until all cryptainers enqueued for persistence are written to the underlying cryptainer storage."""
+        with self._lock:
+            pending_persistence_futures = self._pending_persistence_futures
+            self._pending_persistence_futures = []
+        for future in pending_persistence_futures:
+            future.result()  # Never raises, thanks to @catch_and_log_exception
+
+    def _add_finalized_segment(
+        self, cryptainer_filepath, cryptainer, payload_ciphertext, start_timestamp, end_timestamp
+    ):
+        segment = dict(
+            cryptainer_filepath=cryptainer_filepath,
+            cryptainer=cryptainer,
+            payload_ciphertext=payload_ciphertext,
+            start_timestamp=start_timestamp,
+            end_timestamp=end_timestamp,
+        )
+        with self._lock:
+            must_persist = (
+                self._persist_until_timestamp is not None and start_timestamp <= self._persist_until_timestamp
+            )
+            if must_persist:
+                self._enqueue_segment_for_persistence(segment)
+            else:
+                self._buffered_segments.append(segment)
+                self._statistics["buffered_segment_count"] += 1
+                self._statistics["buffered_payload_size"] += len(payload_ciphertext)
+                self._discard_expired_segments(now=end_timestamp)
+
+    def _discard_expired_segments(self, now):
+        """Drop the oldest buffered segments, if they ended before the pre-trigger window or overflow memory limit."""
+        statistics = self._statistics
+        buffered_segments = self._buffered_segments
+        while buffered_segments and (
+            buffered_segments[0]["end_timestamp"] < now - self._pre_trigger_duration_s
+            or statistics["buffered_payload_size"] > self._max_buffered_payload_size
+        ):
+            segment = buffered_segments.popleft()
+            payload_size = len(segment["payload_ciphertext"])
+            statistics["buffered_segment_count"] -= 1
+            statistics["buffered_payload_size"] -= payload_size
+            statistics["discarded_segment_count"] += 1
+            statistics["discarded_payload_size"] += payload_size
+            logger.debug("Discarding pre-trigger cryptainer %s", segment["cryptainer_filepath"].name)
+
+    def _enqueue_segment_for_persistence(self, segment):
+        """Must be called with the lock held, so that segments get persisted in order."""
+        self._pending_persistence_futures = [f for f in self._pending_persistence_futures if not f.done()]
+        future = self._persistence_executor.submit(self._persist_segment, segment)
+        self._pending_persistence_futures.append(future)
+
+    @catch_and_log_exception("PreTriggerCryptainerStorage._persist_segment")
+    def _persist_segment(self, segment):
+        cryptainer_filepath = segment["cryptainer_filepath"]
+        logger.info("Persisting pre-trigger cryptainer %s", cryptainer_filepath.name)
+        cryptainer = segment["cryptainer"].copy()  # Shallow copy, the inline payload is offloaded again on dump
+        cryptainer["payload_ciphertext_struct"] = dict(
+            ciphertext_location=PAYLOAD_CIPHERTEXT_LOCATIONS.INLINE, ciphertext_value=segment["payload_ciphertext"]
+        )
+        dump_cryptainer_to_filesystem(cryptainer_filepath, cryptainer=cryptainer, offload_payload_ciphertext=True)
+        with self._lock:
+            self._statistics["persisted_segment_count"] += 1
+            self._statistics["persisted_payload_size"] += len(segment["payload_ciphertext"])
+        # Like CryptainerStorage does after its own encryption jobs, so that triggers can't exceed storage limits
+        self._cryptainer_storage.purge_exceeding_cryptainers()
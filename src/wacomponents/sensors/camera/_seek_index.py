@@ -0,0 +1,376 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Seek indexes of recorded segments, mapping wall-clock timestamps to byte offsets of keyframes (or audio frames),
+built while data streams from sensor subprocesses to cryptainers, without decoding anything.
+
+A seek index is a JSON-compatible dict like:
+
+    {
+        "cryptainer_name": "20231018105000_rtsp_camera_cryptainer.mpegts.crypt",
+        "media_format": "mpegts",
+        "entry_kind": "keyframe",
+        "start_timestamp": 1697619000.123,  # Epoch seconds, when the first byte of segment was received
+        "payload_size": 1234567,
+        "entries": [[0, 0], [2003, 301048], ...],  # Pairs (milliseconds since start_timestamp, byte offset)
+    }
+
+Timestamps are arrival times of data, interpolated inside each chunk, so they lag behind the capture
+by the encoding latency of the subprocess.
+
+Seek indexes are stored, encrypted, as sidecar cryptainers of a SeekIndexedCryptainerStorage, which hides
+them from listings (and thus from purges), and deletes them along with their indexed cryptainer.
+"""
+
+import bisect
+import re
+from typing import Optional
+
+from wacryptolib.cryptainer import CRYPTAINER_SUFFIX, CRYPTAINER_TEMP_SUFFIX, CryptainerStorage
+from wacryptolib.utilities import dump_to_json_bytes, load_from_json_bytes
+
+from wacomponents.sensors.camera._media_bitstream import (
+    MPEGTS_PACKET_SIZE,
+    MPEGTS_SYNC_BYTE,
+    is_mpegts_video_random_access_packet,
+)
+
+SEEK_INDEX_SUFFIX = ".seekindex"  # Inserted before the CRYPTAINER_SUFFIX of the indexed cryptainer
+
+_H264_START_CODE_REGEX = re.compile(b"\x00\x00\x01(.)", flags=re.DOTALL)
+_H264_NAL_TYPE_IDR_SLICE = 5
+_H264_NAL_TYPE_SPS = 7
+_H264_NAL_TYPES_SLICE = (1, 5)
+
+_MP3_BITRATES_KBPS = {  # Layer III only, indexed by the 4-bits bitrate field
+    "mpeg1": (None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None),
+    "mpeg2": (None, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, None),
+}
+_MP3_SAMPLE_RATES_HZ = {  # Indexed by the 2-bits version field, then by the 2-bits sample rate field
+    0b00: (11025, 12000, 8000),  # MPEG 2.5
+    0b10: (22050, 24000, 16000),  # MPEG 2
+    0b11: (44100, 48000, 32000),  # MPEG 1
+}
+
+
+class SeekIndexBuilderBase:
+    """
+    Accumulates the entries of the seek index of one segment, from the successive pieces of its data.
+
+    Subclasses implement `_find_entry_offsets()` for their media format; entries closer than
+    `min_entry_interval_s` to the previous one are skipped, to keep indexes compact.
+    """
+
+    media_format = None
+    entry_kind = "keyframe"
+    min_entry_interval_s = 0
+
+    def __init__(self):
+        self._start_timestamp = None
+        self._previous_chunk_timestamp = None
+        self._payload_size = 0
+        self._entries = []  # Pairs (timestamp, byte offset)
+
+    def feed(self, chunk, segment_offset: int, timestamp: float):
+        """Index a piece of data, `segment_offset` being its position in the segment, and `timestamp` the
+        epoch time when it was received (i.e. the time of its LAST byte)."""
+        if not chunk:
+            return
+        assert segment_offset == self._payload_size, (segment_offset, self._payload_size)
+        if self._start_timestamp is None:
+            self._start_timestamp = self._previous_chunk_timestamp = timestamp
+        chunk_duration_s = timestamp - self._previous_chunk_timestamp
+        for entry_offset in self._find_entry_offsets(chunk, segment_offset=segment_offset):
+            # Entries starting in previous chunks are clamped to the start of this one
+            position_ratio = max(0, entry_offset - segment_offset) / len(chunk)
+            self._add_entry(self._previous_chunk_timestamp + position_ratio * chunk_duration_s, entry_offset)
+        self._previous_chunk_timestamp = timestamp
+        self._payload_size += len(chunk)
+
+    def _add_entry(self, timestamp, byte_offset):
+        if self._entries and timestamp - self._entries[-1][0] < self.min_entry_interval_s:
+            return
+        self._entries.append((timestamp, byte_offset))
+
+    def truncate(self, payload_size: int):
+        """Forget about data beyond `payload_size`, e.g. if the end of segment was not recorded after all."""
+        self._payload_size = min(self._payload_size, payload_size)
+        self._entries = [entry for entry in self._entries if entry[1] < self._payload_size]
+
+    @property
+    def payload_size(self) -> int:
+        return self._payload_size
+
+    def get_seek_index(self, cryptainer_name: str) -> Optional[dict]:
+        """Return the seek index of data fed so far, or None if no data was fed."""
+        if self._start_timestamp is None:
+            return None
+        start_timestamp = self._start_timestamp
+        return dict(
+            cryptainer_name=cryptainer_name,
+            media_format=self.media_format,
+            entry_kind=self.entry_kind,
+            start_timestamp=start_timestamp,
+            payload_size=self._payload_size,
+            entries=[[round((timestamp - start_timestamp) * 1000), offset] for (timestamp, offset) in self._entries],
+        )
+
+    def _find_entry_offsets(self, chunk, segment_offset: int) -> list:
+        """Return the segment offsets of entries found thanks to this chunk, possibly starting in previous chunks."""
+        raise NotImplementedError("_find_entry_offsets")
+
+
+class MpegtsSeekIndexBuilder(SeekIndexBuilderBase):
+    """Indexes the mpegts packets starting video keyframes; packets are assumed to be aligned on segment start."""
+
+    media_format = "mpegts"
+
+    def __init__(self):
+        super().__init__()
+        self._partial_packet = b""  # End of previous chunk
+
+    def _find_entry_offsets(self, chunk, segment_offset):
+        entry_offsets = []
+        first_packet_offset = (-segment_offset) % MPEGTS_PACKET_SIZE  # Start of first whole packet in chunk
+
+        if self._partial_packet:
+            packet = self._partial_packet + bytes(chunk[:first_packet_offset])
+            if len(packet) < MPEGTS_PACKET_SIZE:
+                self._partial_packet = packet
+                return entry_offsets
+            if is_mpegts_video_random_access_packet(packet, 0):
+                entry_offsets.append(segment_offset - len(self._partial_packet))
+
+        chunk_length = len(chunk)
+        packet_offset = first_packet_offset
+        while packet_offset + MPEGTS_PACKET_SIZE <= chunk_length:
+            if chunk[packet_offset] == MPEGTS_SYNC_BYTE and is_mpegts_video_random_access_packet(chunk, packet_offset):
+                entry_offsets.append(segment_offset + packet_offset)
+            packet_offset += MPEGTS_PACKET_SIZE
+        self._partial_packet = bytes(chunk[packet_offset:])
+        return entry_offsets
+
+
+class H264SeekIndexBuilder(SeekIndexBuilderBase):
+    """Indexes the NAL units starting keyframes of a raw Annex-B h264 stream, i.e. SPS units (repeated before
+    each IDR slice by encoders with inline headers), or else IDR slices."""
+
+    media_format = "h264"
+
+    def __init__(self):
+        super().__init__()
+        self._chunk_tail = b""  # Last bytes of previous chunk, for start codes overlapping chunks
+        self._sps_pending = False  # Keyframe was indexed at its SPS, so skip its IDR slice
+
+    def _register_nal_unit(self, nal_unit_offset, nal_unit_header, entry_offsets):
+        nal_unit_type = nal_unit_header & 0x1F
+        if nal_unit_type == _H264_NAL_TYPE_SPS:
+            entry_offsets.append(nal_unit_offset)
+            self._sps_pending = True
+        elif nal_unit_type == _H264_NAL_TYPE_IDR_SLICE and not self._sps_pending:
+            entry_offsets.append(nal_unit_offset)
+        if nal_unit_type in _H264_NAL_TYPES_SLICE:
+            self._sps_pending = False
+
+    def _find_entry_offsets(self, chunk, segment_offset):
+        entry_offsets = []
+        chunk_tail = self._chunk_tail
+
+        if chunk_tail:  # Only start codes beginning in previous chunk are searched here
+            junction = chunk_tail + bytes(chunk[:3])
+            for match in _H264_START_CODE_REGEX.finditer(junction):
+                if match.start() < len(chunk_tail):
+                    nal_unit_offset = segment_offset - len(chunk_tail) + match.start()
+                    self._register_nal_unit(nal_unit_offset, match.group(1)[0], entry_offsets)
+
+        for match in _H264_START_CODE_REGEX.finditer(chunk):  # Works on memoryviews too
+            self._register_nal_unit(segment_offset + match.start(), match.group(1)[0], entry_offsets)
+
+        self._chunk_tail = (chunk_tail + bytes(chunk[-3:]))[-3:]
+        return entry_offsets
+
+
+class _SequentialUnitSeekIndexBuilder(SeekIndexBuilderBase):
+    """Base for formats made of consecutive units (boxes, frames...) whose header gives their length."""
+
+    unit_header_length = None
+
+    def __init__(self):
+        super().__init__()
+        self._next_unit_offset = 0  # None if indexing had to stop
+        self._unit_header = bytearray()
+
+    def _parse_unit_header(self, unit_header: bytes) -> tuple:
+        """Return the pair (unit length or None to stop indexing, whether unit is an entry)."""
+        raise NotImplementedError("_parse_unit_header")
+
+    def _find_entry_offsets(self, chunk, segment_offset):
+        entry_offsets = []
+        chunk_end = segment_offset + len(chunk)
+        unit_header = self._unit_header
+        while self._next_unit_offset is not None:
+            missing_header_offset = self._next_unit_offset + len(unit_header)
+            if missing_header_offset >= chunk_end:
+                break
+            chunk_position = missing_header_offset - segment_offset
+            unit_header += chunk[chunk_position : chunk_position + self.unit_header_length - len(unit_header)]
+            if len(unit_header) < self.unit_header_length:
+                break  # Rest of header is in next chunk
+            unit_length, is_entry = self._parse_unit_header(bytes(unit_header))
+            if unit_length is not None and unit_length < len(unit_header):
+                del unit_header[:unit_length]  # Next header starts with already received bytes
+            else:
+                unit_header.clear()
+            if is_entry:
+                entry_offsets.append(self._next_unit_offset)
+            self._next_unit_offset = None if unit_length is None else self._next_unit_offset + unit_length
+        return entry_offsets
+
+
+class FragmentedMp4SeekIndexBuilder(_SequentialUnitSeekIndexBuilder):
+    """Indexes the "moof" boxes of fragmented mp4 streams (like ffmpeg's "ismv" output), each fragment
+    starting with a keyframe; playing a fragment also requires the initial "ftyp" and "moov" boxes."""
+
+    media_format = "fmp4"
+    unit_header_length = 16  # Enough for 64-bits box sizes
+
+    def _parse_unit_header(self, unit_header):
+        box_size = int.from_bytes(unit_header[:4], "big")
+        box_type = unit_header[4:8]
+        if box_size == 1:
+            box_size = int.from_bytes(unit_header[8:16], "big")
+        if box_size < 8:  # Including the "box extends to end of stream" case
+            return None, False
+        return box_size, box_type == b"moof"
+
+
+class Mp3SeekIndexBuilder(_SequentialUnitSeekIndexBuilder):
+    """Indexes the frames of mp3 streams, at most one per second; leading ID3v2 tags are skipped, and garbage
+    bytes are crossed until a frame header is found again."""
+
+    media_format = "mp3"
+    entry_kind = "frame"
+    min_entry_interval_s = 1
+    unit_header_length = 10  # Size of ID3v2 headers, frame headers only need 4 bytes
+
+    @staticmethod
+    def get_mp3_frame_length(frame_header: bytes) -> Optional[int]:
+        """Return the length of the MPEG audio Layer III frame starting with this header, or None if invalid."""
+        if frame_header[0] != 0xFF or (frame_header[1] & 0xE0) != 0xE0:
+            return None
+        version_bits = (frame_header[1] >> 3) & 0x03
+        layer_bits = (frame_header[1] >> 1) & 0x03
+        if version_bits not in _MP3_SAMPLE_RATES_HZ or layer_bits != 0b01:  # Layer III only
+            return None
+        bitrate_index = frame_header[2] >> 4
+        sample_rate_index = (frame_header[2] >> 2) & 0x03
+        padding = (frame_header[2] >> 1) & 0x01
+        bitrate_kbps = _MP3_BITRATES_KBPS["mpeg1" if version_bits == 0b11 else "mpeg2"][bitrate_index]
+        if bitrate_kbps is None or sample_rate_index == 3:
+            return None
+        sample_rate_hz = _MP3_SAMPLE_RATES_HZ[version_bits][sample_rate_index]
+        samples_per_frame_by_8 = 144 if version_bits == 0b11 else 72
+        return samples_per_frame_by_8 * bitrate_kbps * 1000 // sample_rate_hz + padding
+
+    def _parse_unit_header(self, unit_header):
+        if unit_header.startswith(b"ID3"):
+            tag_size = 0
+            for byte in unit_header[6:10]:  # "Syncsafe" integer
+                tag_size = (tag_size << 7) | (byte & 0x7F)
+            return 10 + tag_size + (10 if unit_header[5] & 0x10 else 0), False  # Optional footer
+        frame_length = self.get_mp3_frame_length(unit_header)
+        if frame_length is None:
+            return 1, False  # Resynchronize byte per byte
+        return frame_length, True
+
+
+SEEK_INDEX_BUILDER_CLASSES = {  # Indexed by record extension
+    ".mpegts": MpegtsSeekIndexBuilder,
+    ".h264": H264SeekIndexBuilder,
+    ".mp4": FragmentedMp4SeekIndexBuilder,  # Subprocesses can only output fragmented mp4 to pipes
+    ".mp3": Mp3SeekIndexBuilder,
+}
+
+
+def create_seek_index_builder(record_extension: str) -> Optional[SeekIndexBuilderBase]:
+    """Return a seek index builder for this kind of record, or None if unsupported (e.g. for constant-rate
+    formats like wav, where offsets can be computed from timestamps)."""
+    seek_index_builder_class = SEEK_INDEX_BUILDER_CLASSES.get(record_extension)
+    if seek_index_builder_class is None:
+        return None
+    return seek_index_builder_class()
+
+
+def get_seek_index_cryptainer_name(cryptainer_name) -> str:
+    """Return the name of the sidecar cryptainer storing the seek index of `cryptainer_name`."""
+    cryptainer_name = str(cryptainer_name)
+    assert cryptainer_name.endswith(CRYPTAINER_SUFFIX), cryptainer_name
+    return cryptainer_name[: -len(CRYPTAINER_SUFFIX)] + SEEK_INDEX_SUFFIX + CRYPTAINER_SUFFIX
+
+
+class SeekIndexedCryptainerStorage(CryptainerStorage):
+    """
+    Cryptainer storage which can keep a seek index alongside each cryptainer, in an encrypted sidecar cryptainer.
+
+    Sidecars are not listed (so they don't count in purges by count, age or quota, nor in GUI listings),
+    but their size is included in the one of their indexed cryptainer, and they are deleted along with it.
+    """
+
+    def list_cryptainer_names(self, *args, **kwargs):
+        cryptainer_names = super().list_cryptainer_names(*args, **kwargs)
+        sidecar_suffix = SEEK_INDEX_SUFFIX + CRYPTAINER_SUFFIX
+        return [
+            cryptainer_name
+            for cryptainer_name in cryptainer_names
+            if not cryptainer_name.name.endswith((sidecar_suffix, sidecar_suffix + CRYPTAINER_TEMP_SUFFIX))
+        ]
+
+    def enqueue_seek_index_for_encryption(self, cryptainer_name, seek_index: dict):
+        """Enqueue the seek index of `cryptainer_name` for asynchronous encryption into its sidecar."""
+        seek_index_cryptainer_name = get_seek_index_cryptainer_name(cryptainer_name)
+        self.enqueue_file_for_encryption(  # Key generation must not block the caller
+            seek_index_cryptainer_name[: -len(CRYPTAINER_SUFFIX)],
+            payload=dump_to_json_bytes(seek_index),
+            cryptainer_metadata=None,
+        )
+
+    def load_seek_index(self, cryptainer_name) -> Optional[dict]:
+        """Decrypt and return the seek index of `cryptainer_name`, or None if it has none."""
+        seek_index_cryptainer_name = get_seek_index_cryptainer_name(cryptainer_name)
+        if not self.is_valid_cryptainer_name(seek_index_cryptainer_name):
+            return None
+        payload, _error_report = self.decrypt_cryptainer_from_storage(seek_index_cryptainer_name)
+        return None if payload is None else load_from_json_bytes(payload)
+
+    def _get_seek_index_cryptainer_name_if_existing(self, cryptainer_name) -> Optional[str]:
+        if not str(cryptainer_name).endswith(CRYPTAINER_SUFFIX):
+            return None  # E.g. pending cryptainer
+        seek_index_cryptainer_name = get_seek_index_cryptainer_name(cryptainer_name)
+        return seek_index_cryptainer_name if self.is_valid_cryptainer_name(seek_index_cryptainer_name) else None
+
+    def _get_cryptainer_size(self, cryptainer_name):
+        cryptainer_size = super()._get_cryptainer_size(cryptainer_name)
+        seek_index_cryptainer_name = self._get_seek_index_cryptainer_name_if_existing(cryptainer_name)
+        if seek_index_cryptainer_name:
+            cryptainer_size += super()._get_cryptainer_size(seek_index_cryptainer_name)
+        return cryptainer_size
+
+    def _delete_cryptainer(self, cryptainer_name):
+        seek_index_cryptainer_name = self._get_seek_index_cryptainer_name_if_existing(cryptainer_name)
+        super()._delete_cryptainer(cryptainer_name)
+        if seek_index_cryptainer_name:
+            super()._delete_cryptainer(seek_index_cryptainer_name)
+
+
+def find_seek_index_entry(seek_index: dict, timestamp: float) -> Optional[tuple]:
+    """Return the pair (epoch timestamp, byte offset) of the last entry of `seek_index` at or before
+    `timestamp`, or None if there is none."""
+    entries = seek_index["entries"]
+    time_offsets_ms = [entry[0] for entry in entries]
+    position = bisect.bisect_right(time_offsets_ms, (timestamp - seek_index["start_timestamp"]) * 1000)
+    if not position:
+        return None
+    time_offset_ms, byte_offset = entries[position - 1]
+    return seek_index["start_timestamp"] + time_offset_ms / 1000, byte_offset
@@ -0,0 +1,758 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import functools
+import logging
+import queue
+import subprocess
+import threading
+import time
+from typing import Optional
+
+import multitimer
+from wacryptolib.sensor import PeriodicSubprocessStreamRecorder, PeriodicTaskHandler
+from wacryptolib.utilities import catch_and_log_exception, get_utc_now_date
+
+from wacomponents.sensors.camera._seek_index import create_seek_index_builder
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveChunkSizer:
+    """
+    Tracks the observed byte rate of a data stream, and derives from it the size of chunks to read,
+    so that approximately `target_chunks_per_s` chunks get processed each second.
+
+    Public methods of this class are thread-safe.
+    """
+
+    CHUNK_SIZE_ALIGNMENT = 4096  # Keep reads aligned on memory pages
+
+    _byte_rate = None  # Exponential moving average, in bytes per second
+
+    def __init__(
+        self,
+        initial_chunk_size: int,
+        min_chunk_size: int,
+        max_chunk_size: int,
+        target_chunks_per_s: float,
+        smoothing_factor: float = 0.3,
+    ):
+        assert 0 < min_chunk_size <= max_chunk_size, (min_chunk_size, max_chunk_size)
+        assert target_chunks_per_s > 0, target_chunks_per_s
+        assert 0 < smoothing_factor <= 1, smoothing_factor
+        self._min_chunk_size = min_chunk_size
+        self._max_chunk_size = max_chunk_size
+        self._target_chunks_per_s = target_chunks_per_s
+        self._smoothing_factor = smoothing_factor
+        self._chunk_size = self._clamp_chunk_size(initial_chunk_size)
+        self._lock = threading.Lock()
+
+    def _clamp_chunk_size(self, chunk_size):
+        chunk_size = int(chunk_size) // self.CHUNK_SIZE_ALIGNMENT * self.CHUNK_SIZE_ALIGNMENT
+        return max(self._min_chunk_size, min(self._max_chunk_size, chunk_size))
+
+    @property
+    def byte_rate(self):
+        """Smoothed byte rate of the stream, or None if not yet measured."""
+        return self._byte_rate
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def max_chunk_size(self):
+        return self._max_chunk_size
+
+    def register_chunk(self, chunk_length: int, duration_s: float):
+        """Take into account a chunk of data which took `duration_s` to be produced, and retune chunk size."""
+        if duration_s <= 0:
+            return
+        with self._lock:
+            measured_byte_rate = chunk_length / duration_s
+            if self._byte_rate is None:
+                self._byte_rate = measured_byte_rate
+            else:
+                self._byte_rate += self._smoothing_factor * (measured_byte_rate - self._byte_rate)
+            self._chunk_size = self._clamp_chunk_size(self._byte_rate / self._target_chunks_per_s)
+
+
+class SubprocessStreamRecorderBase(PeriodicSubprocessStreamRecorder):
+    """
+    Variant of wacryptolib's PeriodicSubprocessStreamRecorder, which consumes the stdout of
+    its subprocess through overridable hooks.
+
+    Subprocess output is read into a preallocated buffer, reused for each chunk: chunks handed to
+    encryption streams are thus memoryviews, which must NOT be retained after `encrypt_chunk()` returns.
+
+    When `adaptive_chunk_sizing` is enabled, the size of chunks read from subprocess is retuned
+    according to its observed byte rate (see `current_chunk_size`), instead of being a constant.
+
+    When `gapless_rotation` is enabled, the subprocess is kept alive across recording periods,
+    and its output is cut in-process into successive cryptainers (see `_find_segment_cut_offset()`).
+
+    When `stall_watchdog_min_byte_rate` is set, a watchdog kills and restarts the subprocess (and only it)
+    whenever its output byte rate, averaged over `stall_watchdog_window_s`, falls below this floor;
+    stalls are counted in `get_stream_statistics()`.
+
+    When `overlapping_rotation_window_s` is set, rotations which restart the subprocess launch the next
+    subprocess first, wait until it outputs data, keep both running for this window, and only then stop
+    the previous subprocess; this is only suitable for sources which can be opened concurrently (e.g. RTSP
+    streams). Overlaps between the outputs of successive subprocesses (negative values meaning gaps)
+    are measured in `get_stream_statistics()`, whatever the rotation mode.
+
+    When `seek_indexing` is enabled, a seek index of keyframes (or audio frames) is built while data flows through
+    each segment, and then stored, encrypted, as a sidecar of its cryptainer; this requires a cryptainer storage
+    able to handle such sidecars, like SeekIndexedCryptainerStorage (see _seek_index.py). Only record formats listed
+    in SEEK_INDEX_BUILDER_CLASSES are indexed.
+
+    Segments which got no data at all (e.g. when a restarted subprocess is stopped before its first output, or
+    when the stream ends right after a gapless rotation request) are finalized, but then deleted from storage.
+
+    Subclasses able to record with degraded quality (e.g. to save disk space) must set
+    `max_recording_quality_level`, and take `recording_quality_level` into account when building their
+    command line; see `set_recording_quality_level()`.
+    """
+
+    gapless_rotation = False  # Can be overridden per-instance by subclasses
+
+    # Settings for adaptive chunk sizing, if enabled
+    adaptive_chunk_target_chunks_per_s = 2
+    adaptive_chunk_min_size = 32 * 1024
+    adaptive_chunk_max_size = 8 * 1024 ** 2
+
+    # Delay between two checks of the stall watchdog, if enabled
+    stall_watchdog_check_interval_s = 1
+
+    # Max delay for the next subprocess to output data, in overlapping rotations
+    overlapping_rotation_startup_timeout_s = 10
+
+    # Degradation levels of recording quality supported by the subclass, 0 meaning nominal quality only
+    max_recording_quality_level = 0
+    recording_quality_level = 0
+
+    _encryption_stream_switch_queue = None  # Bound to the current subprocess
+    _subprocess_state = None  # Output timestamps of the current subprocess, linked to those of its neighbours
+    _subprocess_start_timestamp = None  # From time.monotonic()
+    _stalled_subprocess_restart_requested = False
+    _recording_quality_change_pending = False  # Current subprocess doesn't use recording_quality_level yet
+
+    # Semaphore-like object possibly shared by several sensors, to cap concurrent encryptions
+    _encryption_throttle = None
+    _encryption_throttle_max_wait_s = None
+
+    def __init__(
+        self,
+        *args,
+        adaptive_chunk_sizing: bool = False,
+        stall_watchdog_min_byte_rate: Optional[float] = None,
+        stall_watchdog_window_s: float = 10,
+        overlapping_rotation_window_s: Optional[float] = None,
+        seek_indexing: bool = False,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        # Periodic rotations can be rephased, so their timers are tagged, to neutralize superseded ones
+        self._periodic_rotation_generation = 0
+        self._superseded_multitimers = []
+        self._multitimer = self._build_periodic_rotation_multitimer()
+        if seek_indexing and not hasattr(self._cryptainer_storage, "enqueue_seek_index_for_encryption"):
+            raise ValueError("Seek indexing is not supported by %s" % self._cryptainer_storage.__class__.__name__)
+        self._seek_indexing = seek_indexing
+        self._seek_index_builders = {}  # Maps encryption streams to the seek index builders of their segments
+        self._non_empty_cryptainer_encryption_streams = set()  # Not finalized yet
+        assert overlapping_rotation_window_s is None or overlapping_rotation_window_s >= 0, overlapping_rotation_window_s
+        self._overlapping_rotation_window_s = overlapping_rotation_window_s
+        self._subprocess_retirement_threads = []  # Stopping previous subprocesses, in overlapping rotations
+        self._subprocess_retirement_hurry_event = threading.Event()  # Set when sensor stops
+        self._subprocess_handoff_lock = threading.Lock()
+        self._stream_statistics = dict(
+            received_byte_count=0,
+            last_received_timestamp=None,  # From time.monotonic()
+            stall_count=0,
+            stall_total_duration_s=0.0,
+            last_stall_duration_s=None,
+            encrypted_byte_count=0,
+            encrypted_chunk_count=0,
+            seek_index_count=0,
+            empty_segment_count=0,
+            encryption_duration_s=0.0,
+            encryption_throttle_wait_s=0.0,
+            encryption_throttle_bypass_count=0,
+            last_chunk_timestamp=None,  # From time.monotonic()
+            subprocess_handoff_count=0,
+            subprocess_handoff_gap_count=0,
+            last_subprocess_handoff_overlap_s=None,  # Negative for a gap
+            min_subprocess_handoff_overlap_s=None,
+        )
+        self._adaptive_chunk_sizer = None
+        if adaptive_chunk_sizing:
+            self._adaptive_chunk_sizer = AdaptiveChunkSizer(
+                initial_chunk_size=self.subprocess_data_chunk_size,
+                min_chunk_size=self.adaptive_chunk_min_size,
+                max_chunk_size=self.adaptive_chunk_max_size,
+                target_chunks_per_s=self.adaptive_chunk_target_chunks_per_s,
+            )
+
+        self._stall_watchdog = None
+        if stall_watchdog_min_byte_rate is not None:
+            assert stall_watchdog_min_byte_rate > 0, stall_watchdog_min_byte_rate
+            assert stall_watchdog_window_s > self.stall_watchdog_check_interval_s, stall_watchdog_window_s
+            self._stall_watchdog_min_byte_rate = stall_watchdog_min_byte_rate
+            self._stall_watchdog_window_s = stall_watchdog_window_s
+            self._stall_watchdog_samples = collections.deque()  # Pairs (timestamp, received_byte_count)
+            self._stall_watchdog = PeriodicTaskHandler(
+                interval_s=self.stall_watchdog_check_interval_s,
+                runonstart=False,
+                task_func=catch_and_log_exception("SubprocessStreamRecorderBase._check_for_subprocess_stall")(
+                    self._check_for_subprocess_stall
+                ),
+            )
+
+    def start(self):
+        self._subprocess_state = None  # No handoff to measure with previous recording session
+        self._subprocess_retirement_hurry_event.clear()
+        super().start()
+        if self._stall_watchdog:
+            self._stall_watchdog_samples.clear()
+            self._stall_watchdog.start()
+
+    def stop(self):
+        if self._stall_watchdog:
+            self._stall_watchdog.stop()
+        self._subprocess_retirement_hurry_event.set()
+        super().stop()
+
+    def join(self):
+        for thread in self._subprocess_retirement_threads:
+            thread.join()  # Subprocess termination has its own timeouts
+        self._subprocess_retirement_threads = []
+        self._join_superseded_multitimers()
+        super().join()
+        if self._stall_watchdog:
+            self._stall_watchdog.join()
+
+    @property
+    def current_chunk_size(self) -> int:
+        """Size of the next chunks to be read from subprocess output."""
+        if self._adaptive_chunk_sizer:
+            return self._adaptive_chunk_sizer.chunk_size
+        return self.subprocess_data_chunk_size
+
+    def set_encryption_throttle(self, encryption_throttle, max_wait_s: float):
+        """Make chunk encryptions acquire `encryption_throttle` (e.g. a Semaphore shared between sensors) beforehand.
+
+        If it can't be acquired within `max_wait_s`, encryption proceeds anyway, so that a stalled
+        sensor holding it can't starve others."""
+        self._encryption_throttle = encryption_throttle
+        self._encryption_throttle_max_wait_s = max_wait_s
+
+    def set_recording_quality_level(self, level: int) -> int:
+        """Request a degraded recording quality (0 being nominal quality), capped by `max_recording_quality_level`.
+
+        The new level is applied at the next rotation, since the subprocess must be restarted for that
+        (even in gapless mode). Return the level actually requested."""
+        assert level >= 0, level
+        level = min(level, self.max_recording_quality_level)
+        if level != self.recording_quality_level:
+            logger.info(
+                "Switching %s sensor from recording quality level %d to %d at next rotation",
+                self.sensor_name,
+                self.recording_quality_level,
+                level,
+            )
+            self.recording_quality_level = level
+            self._recording_quality_change_pending = True
+        return level
+
+    def get_stream_statistics(self) -> dict:
+        """Return a snapshot of counters regarding the data flowing from subprocesses to encryption streams."""
+        stream_statistics = self._stream_statistics.copy()
+        stream_statistics["observed_byte_rate"] = self.observed_byte_rate
+        stream_statistics["current_chunk_size"] = self.current_chunk_size
+        return stream_statistics
+
+    @property
+    def observed_byte_rate(self):
+        """Smoothed byte rate of subprocess output, or None if unknown (or adaptive chunk sizing is disabled)."""
+        if self._adaptive_chunk_sizer:
+            return self._adaptive_chunk_sizer.byte_rate
+        return None
+
+    def _launch_and_consume_subprocess(self, command_line, cryptainer_encryption_stream):
+        logger.info("Calling {} sensor subprocess command: {}".format(self.sensor_name, " ".join(command_line)))
+        self._recording_quality_change_pending = False  # Command line was built with current quality level
+
+        try:
+            self._subprocess = subprocess.Popen(
+                command_line,
+                bufsize=self.suprocess_buffer_size,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError as exc:  # E.g. program binary not found
+            logger.error("Failure when calling {} sensor subprocess command: {!r}".format(self.sensor_name, exc))
+            self._finalize_cryptainer_encryption_stream(cryptainer_encryption_stream)
+            return  # Skip the setup of threads below, and let self._subprocess be None
+
+        self._subprocess_start_timestamp = time.monotonic()
+
+        previous_subprocess_state = self._subprocess_state
+        self._subprocess_state = subprocess_state = dict(
+            first_data_event=threading.Event(),  # Also set if subprocess ends without output
+            first_data_timestamp=None,  # From time.monotonic()
+            last_data_timestamp=None,
+            ended=False,
+            previous=previous_subprocess_state,
+            next=None,
+        )
+        if previous_subprocess_state is not None:
+            previous_subprocess_state["next"] = subprocess_state
+
+        # Do some cleanup to save memory
+        self._previous_stdio_threads = [thread for thread in self._previous_stdio_threads if thread.is_alive()]
+
+        self._encryption_stream_switch_queue = queue.Queue()
+
+        self._stdout_thread = threading.Thread(
+            target=catch_and_log_exception("Subprocess stdout_reader_thread of sensor %s" % self.sensor_name)(
+                self._consume_subprocess_stdout
+            ),
+            kwargs=dict(
+                fh=self._subprocess.stdout,
+                cryptainer_encryption_stream=cryptainer_encryption_stream,
+                encryption_stream_switch_queue=self._encryption_stream_switch_queue,
+                subprocess_state=subprocess_state,
+            ),
+        )
+        self._stdout_thread.start()
+        self._previous_stdio_threads.append(self._stdout_thread)
+
+        self._stderr_thread = threading.Thread(
+            target=catch_and_log_exception("Subprocess stderr_reader_thread of sensor %s" % self.sensor_name)(
+                self._consume_subprocess_stderr
+            ),
+            kwargs=dict(fh=self._subprocess.stderr),
+        )
+        self._stderr_thread.start()
+        self._previous_stdio_threads.append(self._stderr_thread)
+
+    def _consume_subprocess_stdout(self, fh, cryptainer_encryption_stream, encryption_stream_switch_queue, subprocess_state):
+        stream_offset = 0  # Absolute position in subprocess output
+        segment_offset = 0  # Position in the current cryptainer
+        segment_state = {}  # Scratchpad for segment hooks
+        next_cryptainer_encryption_stream = None
+        stream_statistics = self._stream_statistics
+        adaptive_chunk_sizer = self._adaptive_chunk_sizer
+        read_buffer_size = adaptive_chunk_sizer.max_chunk_size if adaptive_chunk_sizer else self.current_chunk_size
+        read_buffer = memoryview(bytearray(read_buffer_size))
+        chunk_start_time = time.monotonic()
+
+        while True:
+            chunk = self._read_subprocess_chunk(
+                # First output of subprocess is signaled as soon as possible
+                fh, read_buffer[: self.current_chunk_size], partial=not subprocess_state["first_data_event"].is_set()
+            )
+            if not chunk:
+                break  # End of subprocess
+
+            chunk_end_time = time.monotonic()
+            stream_statistics["received_byte_count"] += len(chunk)
+            stream_statistics["last_received_timestamp"] = chunk_end_time
+
+            subprocess_state["last_data_timestamp"] = chunk_end_time
+            if subprocess_state["first_data_timestamp"] is None:
+                subprocess_state["first_data_timestamp"] = chunk_end_time
+                subprocess_state["first_data_event"].set()
+                self._record_subprocess_handoff(subprocess_state["previous"], subprocess_state)
+
+            if adaptive_chunk_sizer:
+                adaptive_chunk_sizer.register_chunk(len(chunk), duration_s=chunk_end_time - chunk_start_time)
+                chunk_start_time = chunk_end_time
+
+            if next_cryptainer_encryption_stream is None:
+                try:
+                    next_cryptainer_encryption_stream = encryption_stream_switch_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+            if next_cryptainer_encryption_stream is not None:
+                cut_offset = self._find_segment_cut_offset(chunk, stream_offset=stream_offset)
+                if cut_offset is not None:
+                    if cut_offset:
+                        self._on_segment_data(chunk[:cut_offset], segment_offset, segment_state=segment_state)
+                        self._index_segment_data(chunk[:cut_offset], segment_offset, cryptainer_encryption_stream)
+                        self._encrypt_subprocess_chunk(chunk[:cut_offset], cryptainer_encryption_stream)
+                    self._on_segment_end(segment_state=segment_state)
+                    self._finalize_cryptainer_encryption_stream(cryptainer_encryption_stream)
+                    self._on_segment_finalized(segment_state=segment_state)
+                    segment_offset = 0
+                    segment_state = {}
+                    cryptainer_encryption_stream = next_cryptainer_encryption_stream
+                    next_cryptainer_encryption_stream = None
+                    stream_offset += cut_offset
+                    chunk = chunk[cut_offset:]
+
+            if chunk:
+                self._on_segment_data(chunk, segment_offset, segment_state=segment_state)
+                self._index_segment_data(chunk, segment_offset, cryptainer_encryption_stream)
+                self._encrypt_subprocess_chunk(chunk, cryptainer_encryption_stream)
+                stream_offset += len(chunk)
+                segment_offset += len(chunk)
+
+        subprocess_state["ended"] = True
+        subprocess_state["first_data_event"].set()  # Don't let anyone wait for data anymore
+        self._record_subprocess_handoff(subprocess_state["previous"], subprocess_state)
+        self._record_subprocess_handoff(subprocess_state, subprocess_state["next"])
+
+        self._on_segment_end(segment_state=segment_state)
+        self._finalize_cryptainer_encryption_stream(cryptainer_encryption_stream)
+        self._on_segment_finalized(segment_state=segment_state)
+        fh.close()
+
+        # Streams which were never switched to still have to be properly closed
+        if next_cryptainer_encryption_stream is not None:
+            self._finalize_cryptainer_encryption_stream(next_cryptainer_encryption_stream)
+        while True:
+            try:
+                self._finalize_cryptainer_encryption_stream(encryption_stream_switch_queue.get_nowait())
+            except queue.Empty:
+                break
+
+    @staticmethod
+    def _read_subprocess_chunk(fh, read_buffer: memoryview, partial=False) -> memoryview:
+        """Fill `read_buffer` from subprocess output, and return the filled part (empty at end of stream).
+
+        With `partial`, return as soon as some data is available."""
+        filled_length = 0
+        buffer_length = len(read_buffer)
+        while filled_length < buffer_length:
+            read_length = fh.readinto1(read_buffer[filled_length:])
+            assert read_length is not None  # We're NOT in non-blocking mode!
+            if not read_length:
+                break  # End of subprocess
+            filled_length += read_length
+            if partial:
+                break
+        return read_buffer[:filled_length]
+
+    def _record_subprocess_handoff(self, previous_subprocess_state, next_subprocess_state):
+        """Measure the overlap between the outputs of two successive subprocesses, once the previous one ended
+        and the next one output data (or ended too), and then unlink their states to free memory."""
+        if previous_subprocess_state is None or next_subprocess_state is None:
+            return
+        with self._subprocess_handoff_lock:
+            if previous_subprocess_state["next"] is not next_subprocess_state:
+                return  # Already handled
+            if not previous_subprocess_state["ended"]:
+                return
+            if next_subprocess_state["first_data_timestamp"] is None and not next_subprocess_state["ended"]:
+                return
+            previous_subprocess_state["next"] = next_subprocess_state["previous"] = None
+
+            previous_last_data_timestamp = previous_subprocess_state["last_data_timestamp"]
+            next_first_data_timestamp = next_subprocess_state["first_data_timestamp"]
+            if previous_last_data_timestamp is None or next_first_data_timestamp is None:
+                return  # One of these subprocesses failed
+
+            overlap_s = previous_last_data_timestamp - next_first_data_timestamp
+            stream_statistics = self._stream_statistics
+            stream_statistics["subprocess_handoff_count"] += 1
+            if overlap_s < 0:
+                stream_statistics["subprocess_handoff_gap_count"] += 1
+            stream_statistics["last_subprocess_handoff_overlap_s"] = overlap_s
+            min_overlap_s = stream_statistics["min_subprocess_handoff_overlap_s"]
+            stream_statistics["min_subprocess_handoff_overlap_s"] = (
+                overlap_s if min_overlap_s is None else min(min_overlap_s, overlap_s)
+            )
+        logger.info("Subprocess handoff of %s sensor had an overlap of %.2fs", self.sensor_name, overlap_s)
+
+    def _consume_subprocess_stderr(self, fh):
+        for line in fh:
+            line_str = line.decode("ascii", "ignore")
+            logger.info("Subprocess stderr: %s" % line_str.rstrip("\n"))
+        fh.close()
+
+    def _encrypt_subprocess_chunk(self, chunk, cryptainer_encryption_stream):
+        logger.debug("Encrypting %s chunk of length %s", self.sensor_name, len(chunk))
+        stream_statistics = self._stream_statistics
+        encryption_throttle = self._encryption_throttle
+        throttle_acquired = False
+
+        if encryption_throttle is not None:
+            wait_start_time = time.monotonic()
+            throttle_acquired = encryption_throttle.acquire(timeout=self._encryption_throttle_max_wait_s)
+            stream_statistics["encryption_throttle_wait_s"] += time.monotonic() - wait_start_time
+            if not throttle_acquired:
+                logger.warning("Encryption throttle timed out for %s sensor, encrypting anyway", self.sensor_name)
+                stream_statistics["encryption_throttle_bypass_count"] += 1
+
+        try:
+            encryption_start_time = time.monotonic()
+            cryptainer_encryption_stream.encrypt_chunk(chunk)
+            encryption_end_time = time.monotonic()
+        finally:
+            if throttle_acquired:
+                encryption_throttle.release()
+
+        if chunk:
+            self._non_empty_cryptainer_encryption_streams.add(cryptainer_encryption_stream)
+        stream_statistics["encrypted_byte_count"] += len(chunk)
+        stream_statistics["encrypted_chunk_count"] += 1
+        stream_statistics["encryption_duration_s"] += encryption_end_time - encryption_start_time
+        stream_statistics["last_chunk_timestamp"] = encryption_end_time
+
+    def _finalize_cryptainer_encryption_stream(self, cryptainer_encryption_stream):
+        cryptainer_name = cryptainer_encryption_stream._cryptainer_filepath.name
+        logger.debug("Finalizing %s cryptainer encryption stream", cryptainer_name)
+        cryptainer_encryption_stream.finalize()  # Even if empty, so that its resources are released
+        logger.debug("Finished finalizing %s cryptainer encryption stream", cryptainer_name)
+        if cryptainer_encryption_stream not in self._non_empty_cryptainer_encryption_streams:
+            logger.info("Deleting empty %s cryptainer of %s sensor", cryptainer_name, self.sensor_name)
+            with catch_and_log_exception("SubprocessStreamRecorderBase._finalize_cryptainer_encryption_stream"):
+                self._cryptainer_storage.delete_cryptainer(cryptainer_name)
+            self._seek_index_builders.pop(cryptainer_encryption_stream, None)
+            self._stream_statistics["empty_segment_count"] += 1
+            return
+        self._non_empty_cryptainer_encryption_streams.remove(cryptainer_encryption_stream)
+        self._store_seek_index(cryptainer_encryption_stream)
+
+    def _index_segment_data(self, chunk, segment_offset, cryptainer_encryption_stream):
+        if not self._seek_indexing:
+            return
+        seek_index_builder = self._seek_index_builders.get(cryptainer_encryption_stream)
+        if seek_index_builder is None:
+            seek_index_builder = create_seek_index_builder(self.record_extension)
+            if seek_index_builder is None:
+                return  # Unsupported record format
+            self._seek_index_builders[cryptainer_encryption_stream] = seek_index_builder
+        seek_index_builder.feed(chunk, segment_offset, timestamp=time.time())
+
+    def _truncate_seek_index(self, cryptainer_encryption_stream, payload_size):
+        """To be called by subclasses which don't record the whole data of a segment, before its finalization."""
+        seek_index_builder = self._seek_index_builders.get(cryptainer_encryption_stream)
+        if seek_index_builder is not None:
+            seek_index_builder.truncate(payload_size)
+
+    def _store_seek_index(self, cryptainer_encryption_stream):
+        seek_index_builder = self._seek_index_builders.pop(cryptainer_encryption_stream, None)
+        if seek_index_builder is None or not seek_index_builder.payload_size:
+            return
+        cryptainer_name = cryptainer_encryption_stream._cryptainer_filepath.name
+        seek_index = seek_index_builder.get_seek_index(cryptainer_name)
+        logger.debug("Storing seek index of %s with %d entries", cryptainer_name, len(seek_index["entries"]))
+        self._cryptainer_storage.enqueue_seek_index_for_encryption(cryptainer_name, seek_index=seek_index)
+        self._stream_statistics["seek_index_count"] += 1
+
+    def _on_segment_data(self, chunk, segment_offset, segment_state: dict):
+        """HOOK called with each piece of data before its encryption, `segment_offset` being its position in
+        the current cryptainer; `segment_state` is a dict private to this segment.
+
+        Beware, `chunk` is only valid during this call."""
+        pass
+
+    def _on_segment_end(self, segment_state: dict):
+        """HOOK called before finalizing the cryptainer of a segment."""
+        pass
+
+    def _on_segment_finalized(self, segment_state: dict):
+        """HOOK called once the cryptainer of a segment is finalized."""
+        pass
+
+    def _find_segment_cut_offset(self, chunk, stream_offset):
+        """Return the offset in `chunk` where the output of subprocess may be switched to the next
+        cryptainer, or None if this can't happen in this chunk.
+
+        By default, switching happens at once; subclasses should override this to cut on a keyframe.
+        """
+        return 0
+
+    def _is_subprocess_running(self):
+        return self._subprocess is not None and self._subprocess.poll() is None
+
+    def get_subprocess_pid(self) -> Optional[int]:
+        """Return the pid of the current subprocess, or None if it's not running."""
+        current_subprocess = self._subprocess
+        if current_subprocess is None or current_subprocess.poll() is not None:
+            return None
+        return current_subprocess.pid
+
+    def rotate_recording(self, rephase_periodic_rotations=False):
+        """Immediately switch to a new cryptainer, like periodic rotations do.
+
+        With `rephase_periodic_rotations`, next periodic rotations get scheduled relatively to this one.
+        Does nothing if the sensor is not running (anymore)."""
+        self._rotate_recording_if_running(rephase_periodic_rotations=rephase_periodic_rotations)
+        self._join_superseded_multitimers()
+
+    def _build_periodic_rotation_multitimer(self):
+        return multitimer.MultiTimer(
+            interval=self._interval_s,
+            function=functools.partial(
+                self._run_periodic_rotation, periodic_rotation_generation=self._periodic_rotation_generation
+            ),
+            runonstart=False,
+        )
+
+    def _run_periodic_rotation(self, periodic_rotation_generation):
+        self._rotate_recording_if_running(periodic_rotation_generation=periodic_rotation_generation)
+
+    def _rephase_periodic_rotations(self):
+        """Restart the period of rotations from now on; must be called under the sensor lock.
+
+        The superseded timer might already be waiting for the sensor lock, so it can't be joined here, but
+        its generation makes it a no-op."""
+        self._multitimer.stop()
+        self._superseded_multitimers.append(self._multitimer)
+        self._periodic_rotation_generation += 1
+        self._multitimer = self._build_periodic_rotation_multitimer()
+        self._multitimer.start()  # It's stopped by stop(), like the original one
+
+    def _join_superseded_multitimers(self):
+        with self._lock:
+            superseded_multitimers, self._superseded_multitimers = self._superseded_multitimers, []
+        for superseded_multitimer in superseded_multitimers:
+            superseded_multitimer.join()
+
+    def _rotate_recording_if_running(
+        self, rephase_periodic_rotations=False, restart_stalled_subprocess=False, periodic_rotation_generation=None
+    ) -> bool:
+        """Same as the periodic _offloaded_run_task(), but the sensor state is checked in the same critical
+        section, so that a concurrent stop() can't slip in between. Return False if the sensor was not running,
+        or if this is a periodic rotation from a superseded timer."""
+        with self._lock:
+            if not self.is_running:
+                return False
+            if periodic_rotation_generation not in (None, self._periodic_rotation_generation):
+                return False
+            self._stalled_subprocess_restart_requested = restart_stalled_subprocess
+            if rephase_periodic_rotations:
+                self._rephase_periodic_rotations()
+            with catch_and_log_exception("SubprocessStreamRecorderBase._rotate_recording_if_running"):
+                from_datetime = self._current_start_time
+                to_datetime = self._current_start_time = get_utc_now_date()
+                payload = self._do_restart_recording()
+                if payload is not None:
+                    self._handle_post_stop_data(payload=payload, from_datetime=from_datetime, to_datetime=to_datetime)
+            return True
+
+    def _check_for_subprocess_stall(self):
+        """Restart the subprocess if its output byte rate, over the watchdog window, fell below the configured floor."""
+        now = time.monotonic()
+        samples = self._stall_watchdog_samples
+        samples.append((now, self._stream_statistics["received_byte_count"]))
+        while len(samples) > 1 and samples[1][0] <= now - self._stall_watchdog_window_s:
+            samples.popleft()
+
+        oldest_timestamp, oldest_received_byte_count = samples[0]
+        observed_duration_s = now - oldest_timestamp
+        if observed_duration_s < self._stall_watchdog_window_s:
+            return  # Not enough history yet, e.g. subprocess was just (re)started
+
+        byte_rate = (samples[-1][1] - oldest_received_byte_count) / observed_duration_s
+        if byte_rate >= self._stall_watchdog_min_byte_rate:
+            return
+
+        stalled_since_timestamp = max(
+            self._stream_statistics["last_received_timestamp"] or oldest_timestamp,
+            self._subprocess_start_timestamp or oldest_timestamp,
+        )
+        stall_duration_s = now - stalled_since_timestamp
+        logger.warning(
+            "Subprocess of %s sensor stalled (%.1f bytes/s over last %ss, no data for %.1fs), restarting it",
+            self.sensor_name,
+            byte_rate,
+            self._stall_watchdog_window_s,
+            stall_duration_s,
+        )
+        self._stream_statistics["stall_count"] += 1
+        self._stream_statistics["stall_total_duration_s"] += stall_duration_s
+        self._stream_statistics["last_stall_duration_s"] = stall_duration_s
+
+        samples.clear()  # Give the new subprocess a full window to deliver data
+        self._restart_stalled_subprocess()
+
+    def _restart_stalled_subprocess(self):
+        self._rotate_recording_if_running(restart_stalled_subprocess=True)
+
+    def _do_restart_recording(self):
+        if self._stalled_subprocess_restart_requested:
+            self._stalled_subprocess_restart_requested = False
+            if self._is_subprocess_running():
+                # No graceful quit, a frozen subprocess would only make us wait for termination timeouts
+                logger.warning("Killing stalled %s subprocess", self.sensor_name)
+                self._kill_subprocess(self._subprocess)
+                self._subprocess.wait(timeout=5)
+            return super()._do_restart_recording()  # Even in gapless mode, a new subprocess is needed
+
+        if not self._is_subprocess_running():
+            return super()._do_restart_recording()
+
+        if self.gapless_rotation and not self._recording_quality_change_pending:
+            logger.info("Rotating %s recording without restarting its subprocess", self.sensor_name)
+            cryptainer_encryption_stream = self._build_cryptainer_encryption_stream()
+            self._encryption_stream_switch_queue.put(cryptainer_encryption_stream)
+            return None  # Payload is directly handled by encryption streams
+
+        if self._overlapping_rotation_window_s is not None:
+            return self._do_overlapping_restart_recording()
+
+        return super()._do_restart_recording()
+
+    def _do_overlapping_restart_recording(self):
+        previous_subprocess = self._subprocess
+        logger.info("Rotating %s recording with overlapping subprocesses", self.sensor_name)
+
+        self._do_start_recording()  # Replaces current subprocess and stdio threads, on success
+
+        if self._subprocess is previous_subprocess:
+            logger.error("Could not launch next %s subprocess, keeping the previous one running", self.sensor_name)
+            return None
+
+        # The previous subprocess is stopped in background, so that the sensor lock isn't held meanwhile
+        retirement_thread = threading.Thread(
+            target=catch_and_log_exception("SubprocessStreamRecorderBase._retire_previous_subprocess")(
+                self._retire_previous_subprocess
+            ),
+            kwargs=dict(previous_subprocess=previous_subprocess, next_subprocess_state=self._subprocess_state),
+            name="%s_subprocess_retirement" % self.sensor_name,
+            daemon=True,
+        )
+        retirement_thread.start()
+        self._subprocess_retirement_threads = [
+            thread for thread in self._subprocess_retirement_threads if thread.is_alive()
+        ] + [retirement_thread]
+        return None  # Payload is directly handled by encryption streams
+
+    def _retire_previous_subprocess(self, previous_subprocess, next_subprocess_state):
+        """Stop `previous_subprocess` once the next one has output data for the overlapping window
+        (or at once if the sensor gets stopped)."""
+        first_data_event = next_subprocess_state["first_data_event"]
+        if (
+            first_data_event.wait(timeout=self.overlapping_rotation_startup_timeout_s)
+            and next_subprocess_state["first_data_timestamp"] is not None
+        ):
+            self._subprocess_retirement_hurry_event.wait(timeout=self._overlapping_rotation_window_s)
+        else:
+            logger.warning(
+                "Next %s subprocess output no data within %ss, stopping the previous one anyway",
+                self.sensor_name,
+                self.overlapping_rotation_startup_timeout_s,
+            )
+        self._terminate_subprocess(previous_subprocess)
+
+    def _terminate_subprocess(self, subprocess_to_terminate):
+        """Like the end of _do_stop_recording(), but for a subprocess which is not the current one anymore."""
+        if subprocess_to_terminate.poll() is not None:
+            return
+        try:
+            self._quit_subprocess(subprocess_to_terminate)
+            subprocess_to_terminate.wait(timeout=10)
+        except Exception as exc:  # E.g. TimeoutExpired if wait() expired
+            logger.warning("Failed normal termination of previous %s subprocess: %r", self.sensor_name, exc)
+            self._kill_subprocess(subprocess_to_terminate)
+            subprocess_to_terminate.wait(timeout=5)
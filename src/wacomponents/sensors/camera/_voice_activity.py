@@ -0,0 +1,175 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+import struct
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+WAV_PCM_FORMAT_TAG = 1
+WAV_RIFF_HEADER_SIZE = 12
+WAV_CHUNK_HEADER_SIZE = 8
+
+
+def parse_wav_stream_header(buffer) -> Optional[tuple]:
+    """Return a tuple (header_size, channel_count, sample_rate, bits_per_sample) if `buffer` contains the whole
+    header of a WAV stream, None if more data is needed, or raise ValueError if this isn't a WAV stream."""
+    if len(buffer) < WAV_RIFF_HEADER_SIZE:
+        return None
+    if buffer[0:4] != b"RIFF" or buffer[8:12] != b"WAVE":
+        raise ValueError("Not a WAV stream")
+    wav_format = None
+    offset = WAV_RIFF_HEADER_SIZE
+    while len(buffer) >= offset + WAV_CHUNK_HEADER_SIZE:
+        chunk_id = bytes(buffer[offset : offset + 4])
+        (chunk_size,) = struct.unpack_from("<I", buffer, offset + 4)
+        offset += WAV_CHUNK_HEADER_SIZE
+        if chunk_id == b"data":
+            if wav_format is None:
+                raise ValueError("Missing format chunk in WAV stream")
+            return (offset,) + wav_format  # Data chunk size is meaningless in streams
+        if len(buffer) < offset + chunk_size:
+            return None
+        if chunk_id == b"fmt ":
+            format_tag, channel_count, sample_rate, _byte_rate, _block_align, bits_per_sample = struct.unpack_from(
+                "<HHIIHH", buffer, offset
+            )
+            if format_tag != WAV_PCM_FORMAT_TAG:
+                raise ValueError("Unsupported WAV format tag %s" % format_tag)
+            wav_format = (channel_count, sample_rate, bits_per_sample)
+        offset += chunk_size + (chunk_size % 2)  # Chunks are word-aligned
+    return None
+
+
+class VoiceActivityGate:
+    """
+    Filters a WAV stream (16 bits PCM, like arecord outputs), so that silent stretches get skipped or collapsed.
+
+    Audio is analyzed by frames of `frame_duration_s`, which are deemed active if their energy exceeds
+    `energy_threshold_dbfs`, or if it exceeds this threshold minus 6dB while their zero-crossing rate
+    exceeds `zcr_threshold` (for unvoiced sounds like fricatives). Activity is prolonged by `hangover_s`,
+    and afterwards only the first `max_silence_s` of each silent stretch is kept (0 to skip them entirely).
+
+    One instance must be used per WAV stream; counters are incremented in the `statistics` dict.
+    """
+
+    def __init__(
+        self,
+        statistics: dict,
+        energy_threshold_dbfs: float = -45,
+        zcr_threshold: float = 0.25,
+        frame_duration_s: float = 0.02,
+        hangover_s: float = 0.5,
+        max_silence_s: float = 0,
+    ):
+        assert frame_duration_s > 0, frame_duration_s
+        assert hangover_s >= 0 and max_silence_s >= 0, (hangover_s, max_silence_s)
+        self._statistics = statistics
+        for counter_name in ("processed_byte_count", "saved_byte_count", "active_frame_count", "skipped_frame_count"):
+            statistics.setdefault(counter_name, 0)
+        statistics.setdefault("cpu_time_s", 0.0)
+        self._energy_threshold_dbfs = energy_threshold_dbfs
+        self._zcr_threshold = zcr_threshold
+        self._frame_duration_s = frame_duration_s
+        self._hangover_s = hangover_s
+        self._max_silence_s = max_silence_s
+
+        self._pending_data = bytearray()  # Header or incomplete frame
+        self._is_pass_through = False
+        self._wav_format = None  # (channel_count, frame_size) once header is parsed
+        self._hangover_frames_left = 0
+        self._silent_run_frame_count = 0
+
+    def filter_chunk(self, chunk) -> bytes:
+        """Return the part of `chunk` (possibly with data held from previous chunks) which must be kept."""
+        cpu_start_time = time.thread_time()
+        try:
+            return self._filter_chunk(chunk)
+        finally:
+            self._statistics["processed_byte_count"] += len(chunk)
+            self._statistics["cpu_time_s"] += time.thread_time() - cpu_start_time
+
+    def flush(self) -> bytes:
+        """Return data still held at the end of the stream (e.g. an incomplete frame)."""
+        remaining_data = bytes(self._pending_data)
+        self._pending_data.clear()
+        return remaining_data
+
+    def _filter_chunk(self, chunk) -> bytes:
+        if self._is_pass_through:
+            return bytes(chunk)
+
+        self._pending_data += chunk
+        kept_header = b""
+
+        if self._wav_format is None:
+            try:
+                wav_header = parse_wav_stream_header(self._pending_data)
+            except ValueError as exc:
+                logger.warning("Disabling voice activity gate on audio stream: %s", exc)
+                self._is_pass_through = True
+                return self.flush()
+            if wav_header is None:
+                return b""  # Wait for the rest of the header
+            header_size, channel_count, sample_rate, bits_per_sample = wav_header
+            if bits_per_sample != 16:
+                logger.warning("Disabling voice activity gate on %d bits audio stream", bits_per_sample)
+                self._is_pass_through = True
+                return self.flush()
+            frame_sample_count = max(2, int(sample_rate * self._frame_duration_s))
+            self._wav_format = (channel_count, frame_sample_count)
+            self._hangover_frame_count = int(self._hangover_s / self._frame_duration_s)
+            self._max_silence_frame_count = int(self._max_silence_s / self._frame_duration_s)
+            kept_header = bytes(self._pending_data[:header_size])
+            del self._pending_data[:header_size]
+
+        return kept_header + self._filter_complete_frames()
+
+    def _filter_complete_frames(self) -> bytes:
+        import numpy  # LAZY loaded
+
+        channel_count, frame_sample_count = self._wav_format
+        frame_size = frame_sample_count * channel_count * 2
+        frame_count = len(self._pending_data) // frame_size
+        if not frame_count:
+            return b""
+
+        frames_data = memoryview(self._pending_data)[: frame_count * frame_size]
+        samples = numpy.frombuffer(frames_data, dtype="<i2").reshape(frame_count, frame_sample_count, channel_count)
+        mono_samples = samples.mean(axis=2, dtype=numpy.float32)
+        rms = numpy.sqrt(numpy.mean(numpy.square(mono_samples), axis=1))
+        energy_dbfs = 20 * numpy.log10(rms / 32768 + 1e-10)
+        signs = numpy.signbit(mono_samples)
+        zero_crossing_rates = numpy.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        active_frames = (energy_dbfs >= self._energy_threshold_dbfs) | (
+            (energy_dbfs >= self._energy_threshold_dbfs - 6) & (zero_crossing_rates >= self._zcr_threshold)
+        )
+
+        kept_ranges = []  # Contiguous (start, end) frame indices
+        statistics = self._statistics
+        for frame_index, is_active in enumerate(active_frames.tolist()):
+            if is_active:
+                statistics["active_frame_count"] += 1
+                self._hangover_frames_left = self._hangover_frame_count
+                self._silent_run_frame_count = 0
+            elif self._hangover_frames_left:
+                self._hangover_frames_left -= 1
+            else:
+                self._silent_run_frame_count += 1
+                if self._silent_run_frame_count > self._max_silence_frame_count:
+                    statistics["skipped_frame_count"] += 1
+                    statistics["saved_byte_count"] += frame_size
+                    continue
+            if kept_ranges and kept_ranges[-1][1] == frame_index:
+                kept_ranges[-1][1] = frame_index + 1
+            else:
+                kept_ranges.append([frame_index, frame_index + 1])
+
+        kept_data = b"".join(frames_data[start * frame_size : end * frame_size] for (start, end) in kept_ranges)
+        del samples, mono_samples, signs  # Views must be released before resizing the bytearray
+        frames_data.release()
+        del self._pending_data[: frame_count * frame_size]
+        return kept_data
@@ -0,0 +1,172 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Registry of the capabilities (version, muxers, codecs, protocols...) of the local ffmpeg binary.
+
+Probing requires several ffmpeg subprocesses, so it's done only once per binary: results are cached
+in memory and in INTERNAL_CACHE_DIR, keyed on the binary path and its modification time.
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+from wacomponents.default_settings import INTERNAL_CACHE_DIR
+from wacryptolib.utilities import load_from_json_file, dump_to_json_file
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_CAPABILITIES_CACHE_FILE = INTERNAL_CACHE_DIR / "ffmpeg_capabilities.json"
+
+_FFMPEG_PROBING_TIMEOUT_S = 20
+
+_ffmpeg_capabilities_memory_cache = {}  # Maps (ffmpeg_path, mtime) to capabilities dict
+_ffmpeg_capabilities_lock = threading.Lock()
+
+
+def _get_ffmpeg_output(ffmpeg_path, *args) -> str:
+    output = subprocess.check_output(
+        [ffmpeg_path, "-hide_banner"] + list(args), stderr=subprocess.STDOUT, timeout=_FFMPEG_PROBING_TIMEOUT_S
+    )
+    return output.decode("ascii", "ignore")
+
+
+def parse_ffmpeg_version(output: str) -> Optional[float]:
+    """Extract the major.minor version of ffmpeg from its "-version" output, or return None."""
+    regex = r"ffmpeg version .?(\d\.\d)"  # E.g. FFMPEG SNAPs contain a "n" before version number
+    match = re.search(regex, output.lower())
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def _parse_ffmpeg_listing(output: str, separator_prefix: str) -> dict:
+    """Parse listings like "-muxers" or "-codecs", which end with lines of "<flags> <name> <description>"."""
+    entries = {}
+    lines = output.splitlines()
+    for idx, line in enumerate(lines):
+        if line.strip().startswith(separator_prefix):
+            lines = lines[idx + 1 :]
+            break
+    else:
+        return entries  # Unrecognized output
+    for line in lines:
+        parts = line.split(None, 2)
+        if len(parts) >= 2:
+            flags, name = parts[0], parts[1]
+            entries[name] = flags
+    return entries
+
+
+def parse_ffmpeg_muxers(output: str) -> list:
+    return sorted(_parse_ffmpeg_listing(output, separator_prefix="--"))
+
+
+def parse_ffmpeg_codecs(output: str) -> dict:
+    """Return a dict mapping codec names to their capability flags (e.g. "DEV.LS")."""
+    return _parse_ffmpeg_listing(output, separator_prefix="---")
+
+
+def parse_ffmpeg_protocols(output: str) -> dict:
+    protocols = {"input": [], "output": []}
+    current_list = None
+    for line in output.splitlines():
+        stripped_line = line.strip()
+        if stripped_line == "Input:":
+            current_list = protocols["input"]
+        elif stripped_line == "Output:":
+            current_list = protocols["output"]
+        elif stripped_line and current_list is not None and line.startswith(" "):
+            current_list.append(stripped_line)
+    return protocols
+
+
+def parse_ffmpeg_avoptions(output: str) -> list:
+    """Extract top-level option names (without leading dash) from an ffmpeg "-h" output."""
+    return sorted(set(re.findall(r"^  -(\w+)\s", output, flags=re.MULTILINE)))
+
+
+def probe_ffmpeg_capabilities(ffmpeg_path: str) -> dict:
+    """Spawn ffmpeg subprocesses to determine its capabilities. Prefer the cached get_ffmpeg_capabilities()."""
+    logger.info("Probing capabilities of ffmpeg binary %s", ffmpeg_path)
+
+    version_output = _get_ffmpeg_output(ffmpeg_path, "-version")
+    capabilities = dict(
+        version=parse_ffmpeg_version(version_output),
+        muxers=[],
+        codecs={},
+        protocols={"input": [], "output": []},
+        rtsp_demuxer_options=[],
+    )
+
+    # These listings are only hints, so their failure doesn't prevent using ffmpeg
+    try:
+        capabilities["muxers"] = parse_ffmpeg_muxers(_get_ffmpeg_output(ffmpeg_path, "-muxers"))
+        capabilities["codecs"] = parse_ffmpeg_codecs(_get_ffmpeg_output(ffmpeg_path, "-codecs"))
+        capabilities["protocols"] = parse_ffmpeg_protocols(_get_ffmpeg_output(ffmpeg_path, "-protocols"))
+        capabilities["rtsp_demuxer_options"] = parse_ffmpeg_avoptions(
+            _get_ffmpeg_output(ffmpeg_path, "-h", "demuxer=rtsp")
+        )
+    except (OSError, subprocess.SubprocessError) as exc:
+        logger.warning("Could not fully probe capabilities of ffmpeg binary %s: %r", ffmpeg_path, exc)
+
+    return capabilities
+
+
+def _load_ffmpeg_capabilities_cache_file(cache_file: Path) -> dict:
+    try:
+        return load_from_json_file(cache_file)
+    except FileNotFoundError:
+        return {}
+    except Exception as exc:  # Corrupted cache file
+        logger.warning("Ignoring unreadable ffmpeg capabilities cache file %s: %r", cache_file, exc)
+        return {}
+
+
+def get_ffmpeg_capabilities(
+    ffmpeg_executable: str = "ffmpeg", cache_file: Path = FFMPEG_CAPABILITIES_CACHE_FILE
+) -> Optional[dict]:
+    """Return the capabilities dict of ffmpeg executable (looked up in PATH), or None if it's not installed.
+
+    No subprocess is spawned, unless the binary was never probed (or was modified since then).
+
+    Raises OSError or subprocess.SubprocessError if the binary can't be probed.
+    """
+    ffmpeg_path = shutil.which(ffmpeg_executable)
+    if not ffmpeg_path:
+        return None
+    ffmpeg_path = os.path.realpath(ffmpeg_path)  # Resolve symlinks, to get the mtime of the actual binary
+    ffmpeg_mtime = os.stat(ffmpeg_path).st_mtime
+
+    memory_cache_key = (ffmpeg_path, ffmpeg_mtime)
+    capabilities = _ffmpeg_capabilities_memory_cache.get(memory_cache_key)
+    if capabilities is not None:
+        return capabilities
+
+    with _ffmpeg_capabilities_lock:
+        capabilities = _ffmpeg_capabilities_memory_cache.get(memory_cache_key)  # In case of concurrent probing
+        if capabilities is not None:
+            return capabilities
+
+        cache_data = _load_ffmpeg_capabilities_cache_file(cache_file)
+        cache_entry = cache_data.get(ffmpeg_path)
+
+        if cache_entry and cache_entry["mtime"] == ffmpeg_mtime:
+            capabilities = cache_entry["capabilities"]
+        else:
+            capabilities = probe_ffmpeg_capabilities(ffmpeg_path)
+            cache_data[ffmpeg_path] = dict(mtime=ffmpeg_mtime, capabilities=capabilities)
+            try:
+                dump_to_json_file(cache_file, cache_data)
+            except OSError as exc:
+                logger.warning("Could not persist ffmpeg capabilities cache file %s: %r", cache_file, exc)
+
+        _ffmpeg_capabilities_memory_cache[memory_cache_key] = capabilities
+        return capabilities
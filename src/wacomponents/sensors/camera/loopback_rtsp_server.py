@@ -0,0 +1,422 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import base64
+import logging
+import queue
+import random
+import socket
+import struct
+import subprocess
+import threading
+import time
+import uuid
+
+from wacryptolib.utilities import catch_and_log_exception
+
+logger = logging.getLogger(__name__)
+
+H264_NAL_TYPE_IDR = 5
+H264_NAL_TYPE_SPS = 7
+H264_NAL_TYPE_PPS = 8
+H264_NAL_TYPE_AUD = 9
+H264_NAL_TYPE_FU_A = 28
+
+RTP_PAYLOAD_TYPE = 96
+RTP_CLOCK_RATE = 90000
+RTP_MAX_PAYLOAD_SIZE = 1400
+
+
+def split_h264_annexb_nal_units(buffer: bytearray) -> list:
+    """Extract the complete NAL units (without start codes) from the beginning of an Annex B H264 `buffer`, and
+    remove them from it; the last NAL unit stays in buffer, since it's only complete once a start code follows."""
+    nal_units = []
+    nal_start = buffer.find(b"\x00\x00\x01")
+    if nal_start < 0:
+        return nal_units
+    nal_start += 3
+    while True:
+        next_start_code = buffer.find(b"\x00\x00\x01", nal_start)
+        if next_start_code < 0:
+            break
+        nal_end = next_start_code
+        if nal_end > nal_start and buffer[nal_end - 1] == 0:
+            nal_end -= 1  # 4-bytes start code
+        nal_units.append(bytes(buffer[nal_start:nal_end]))
+        nal_start = next_start_code + 3
+    del buffer[: nal_start - 3]
+    return nal_units
+
+
+def packetize_h264_nal_unit(nal_unit: bytes) -> list:
+    """Return the RTP payloads (RFC 6184, single NAL unit or FU-A fragments) carrying `nal_unit`."""
+    if len(nal_unit) <= RTP_MAX_PAYLOAD_SIZE:
+        return [nal_unit]
+    nal_header = nal_unit[0]
+    fu_indicator = (nal_header & 0xE0) | H264_NAL_TYPE_FU_A
+    nal_type = nal_header & 0x1F
+    fragment_size = RTP_MAX_PAYLOAD_SIZE - 2
+    fragments = [nal_unit[idx : idx + fragment_size] for idx in range(1, len(nal_unit), fragment_size)]
+    payloads = []
+    for idx, fragment in enumerate(fragments):
+        fu_header = nal_type | (0x80 if idx == 0 else 0) | (0x40 if idx == len(fragments) - 1 else 0)
+        payloads.append(bytes([fu_indicator, fu_header]) + fragment)
+    return payloads
+
+
+class _RtspClientSession:
+    def __init__(self, connection, client_address):
+        self.connection = connection
+        self.client_address = client_address
+        self.session_id = uuid.uuid4().hex[:16]
+        self.write_lock = threading.Lock()
+        self.access_unit_queue = queue.Queue(maxsize=100)  # Items are (arrival_timestamp, frame_index, nal_units)
+        self.is_playing = False
+        self.is_waiting_for_keyframe = True
+        self.is_closed = False
+        self.rtp_channel = 0
+        self.rtp_sequence_number = random.randint(0, 0xFFFF)
+        self.rtp_timestamp_base = random.randint(0, 0xFFFFFFFF)
+        self.rtp_ssrc = random.randint(0, 0xFFFFFFFF)
+
+    def send(self, data: bytes):
+        with self.write_lock:
+            self.connection.sendall(data)
+
+    def close(self):
+        self.is_closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected
+        self.connection.close()
+
+
+class LoopbackRtspServer:
+    """
+    Minimal RTSP server streaming a synthetic H264 video (generated by ffmpeg's lavfi) on localhost, so that
+    RTSP sensors can be tested and benchmarked without cameras or network.
+
+    Only what ffmpeg's RTSP client needs is implemented: a single video track, sent as RTP packets
+    interleaved in the RTSP TCP connection (UDP transport is refused), without authentication.
+
+    Network troubles can be simulated at any time: `jitter_s` is the max random delay added to the sending
+    of each frame, `packet_loss_ratio` the probability of dropping each RTP packet, `freeze()` stops sending
+    frames for a while (keeping connections open), and `disconnect_clients()` closes all client connections.
+    """
+
+    def __init__(
+        self,
+        video_resolution: str = "640x360",
+        video_framerate: int = 25,
+        video_bitrate: str = "1M",
+        keyframe_interval_s: float = 1,
+        stream_path: str = "stream",
+        host: str = "127.0.0.1",
+        port: int = 0,  # Let the system choose a free port
+    ):
+        self._video_resolution = video_resolution
+        self._video_framerate = video_framerate
+        self._video_bitrate = video_bitrate
+        self._keyframe_interval_s = keyframe_interval_s
+        self._stream_path = stream_path
+        self._host = host
+        self._port = port
+
+        self.jitter_s = 0
+        self.packet_loss_ratio = 0
+
+        self._lock = threading.Lock()
+        self._client_sessions = []
+        self._frozen_until_timestamp = None  # From time.monotonic()
+        self._parameter_sets = None  # (SPS, PPS) of the video, once known
+        self._parameter_sets_event = threading.Event()
+        self._server_socket = None
+        self._source_subprocess = None
+        self._threads = []
+        self._server_statistics = dict(
+            client_connection_count=0,
+            disconnected_client_count=0,
+            sent_frame_count=0,
+            frozen_frame_count=0,
+            sent_packet_count=0,
+            dropped_packet_count=0,
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server_socket.getsockname()
+        return "rtsp://%s:%d/%s" % (host, port, self._stream_path)
+
+    def get_server_statistics(self) -> dict:
+        """Return a snapshot of counters regarding clients and sent frames."""
+        with self._lock:
+            return self._server_statistics.copy()
+
+    def _build_source_command_line(self):
+        return [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-re",  # Produce frames at the pace of a live camera
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc2=size=%s:rate=%d" % (self._video_resolution, self._video_framerate),
+            "-vcodec",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-tune",
+            "zerolatency",
+            "-pix_fmt",
+            "yuv420p",
+            "-g",
+            str(max(1, round(self._video_framerate * self._keyframe_interval_s))),
+            "-b:v",
+            self._video_bitrate,
+            "-x264-params",
+            "aud=1:repeat-headers=1",  # Delimit frames, and resend SPS/PPS on each keyframe for late clients
+            "-f",
+            "h264",
+            "pipe:1",
+        ]
+
+    def start(self, startup_timeout_s: float = 10):
+        """Launch the video source and start listening; return once the stream can be described to clients."""
+        self._server_socket = socket.create_server((self._host, self._port))
+        self._source_subprocess = subprocess.Popen(
+            self._build_source_command_line(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE
+        )
+        for target in (self._consume_source_output, self._accept_clients):
+            thread = threading.Thread(
+                target=catch_and_log_exception("LoopbackRtspServer.%s" % target.__name__)(target), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        if not self._parameter_sets_event.wait(timeout=startup_timeout_s):
+            self.stop()
+            raise RuntimeError("No H264 parameter sets received from ffmpeg video source")
+        logger.info("Loopback RTSP server is ready at %s", self.url)
+
+    def stop(self):
+        self._server_socket.close()
+        self.disconnect_clients()
+        if self._source_subprocess.poll() is None:
+            self._source_subprocess.kill()
+        self._source_subprocess.wait()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def freeze(self, duration_s: float):
+        """Stop sending frames to clients for `duration_s`, like a frozen camera."""
+        with self._lock:
+            self._frozen_until_timestamp = time.monotonic() + duration_s
+
+    def disconnect_clients(self):
+        """Abruptly close the connections of all current clients."""
+        with self._lock:
+            client_sessions, self._client_sessions = self._client_sessions, []
+            self._server_statistics["disconnected_client_count"] += len(client_sessions)
+        for client_session in client_sessions:
+            client_session.close()
+
+    def _consume_source_output(self):
+        buffer = bytearray()
+        access_unit = []
+        frame_index = 0
+        sps = None
+        stdout = self._source_subprocess.stdout
+        while True:
+            chunk = stdout.read1(64 * 1024)
+            if not chunk:
+                break  # Source subprocess ended
+            buffer += chunk
+            for nal_unit in split_h264_annexb_nal_units(buffer):
+                nal_type = nal_unit[0] & 0x1F
+                if nal_type == H264_NAL_TYPE_AUD:
+                    if access_unit:
+                        self._broadcast_access_unit(frame_index, access_unit)
+                        frame_index += 1
+                    access_unit = []
+                    continue
+                if nal_type == H264_NAL_TYPE_SPS:
+                    sps = nal_unit
+                elif nal_type == H264_NAL_TYPE_PPS and sps and not self._parameter_sets_event.is_set():
+                    self._parameter_sets = (sps, nal_unit)
+                    self._parameter_sets_event.set()
+                access_unit.append(nal_unit)
+
+    def _broadcast_access_unit(self, frame_index, nal_units):
+        now = time.monotonic()
+        is_keyframe = any((nal_unit[0] & 0x1F) in (H264_NAL_TYPE_SPS, H264_NAL_TYPE_IDR) for nal_unit in nal_units)
+        with self._lock:
+            if self._frozen_until_timestamp is not None and now < self._frozen_until_timestamp:
+                self._server_statistics["frozen_frame_count"] += 1
+                return
+            client_sessions = list(self._client_sessions)
+        for client_session in client_sessions:
+            if not client_session.is_playing:
+                continue
+            if client_session.is_waiting_for_keyframe:
+                if not is_keyframe:
+                    continue
+                client_session.is_waiting_for_keyframe = False
+            try:
+                client_session.access_unit_queue.put_nowait((now, frame_index, nal_units))
+            except queue.Full:
+                logger.warning("Loopback RTSP client %s is too slow, dropping frame", client_session.client_address)
+
+    def _accept_clients(self):
+        while True:
+            try:
+                connection, client_address = self._server_socket.accept()
+            except OSError:
+                break  # Server socket was closed
+            client_session = _RtspClientSession(connection, client_address)
+            with self._lock:
+                self._client_sessions.append(client_session)
+                self._server_statistics["client_connection_count"] += 1
+            logger.info("Loopback RTSP server got connection from %s", client_address)
+            for target in (self._handle_client_requests, self._send_client_frames):
+                threading.Thread(
+                    target=catch_and_log_exception("LoopbackRtspServer.%s" % target.__name__)(target),
+                    args=(client_session,),
+                    daemon=True,
+                ).start()
+
+    def _handle_client_requests(self, client_session):
+        rfile = client_session.connection.makefile("rb")
+        try:
+            while not client_session.is_closed:
+                first_byte = rfile.read(1)
+                if not first_byte:
+                    break  # Client disconnected
+                if first_byte == b"$":  # Interleaved RTCP report from client, ignored
+                    _channel, length = struct.unpack(">BH", rfile.read(3))
+                    rfile.read(length)
+                    continue
+                request_lines = [first_byte + rfile.readline()]
+                while request_lines[-1].strip():
+                    request_lines.append(rfile.readline())
+                headers = {}
+                for header_line in request_lines[1:]:
+                    name, _, value = header_line.decode("ascii").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if "content-length" in headers:
+                    rfile.read(int(headers["content-length"]))  # Request body is ignored
+                method, request_url, _version = request_lines[0].decode("ascii").split()
+                self._handle_client_request(client_session, method, request_url, headers)
+                if method == "TEARDOWN":
+                    break
+        except (OSError, ValueError) as exc:
+            if not client_session.is_closed:
+                logger.info("Loopback RTSP client %s connection broke: %r", client_session.client_address, exc)
+        finally:
+            with self._lock:
+                if client_session in self._client_sessions:
+                    self._client_sessions.remove(client_session)
+            client_session.close()
+            client_session.access_unit_queue.put(None)  # Stop the frame sender thread
+
+    def _handle_client_request(self, client_session, method, request_url, headers):
+        status = "200 OK"
+        response_headers = []
+        body = b""
+
+        if method == "OPTIONS":
+            response_headers.append("Public: OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER")
+        elif method == "DESCRIBE":
+            if request_url.rstrip("/") != self.url:
+                status = "404 Not Found"
+            else:
+                body = self._get_session_description().encode("ascii")
+                response_headers += ["Content-Type: application/sdp", "Content-Base: %s/" % self.url]
+        elif method == "SETUP":
+            transport = headers.get("transport", "")
+            if "RTP/AVP/TCP" not in transport:
+                status = "461 Unsupported Transport"
+            else:
+                response_headers += [
+                    "Transport: RTP/AVP/TCP;unicast;interleaved=%d-%d"
+                    % (client_session.rtp_channel, client_session.rtp_channel + 1),
+                    "Session: %s;timeout=60" % client_session.session_id,
+                ]
+        elif method == "PLAY":
+            response_headers += ["Session: %s" % client_session.session_id, "Range: npt=0.000-"]
+            client_session.is_playing = True
+        elif method not in ("TEARDOWN", "GET_PARAMETER", "SET_PARAMETER"):
+            status = "405 Method Not Allowed"
+
+        response_headers = ["RTSP/1.0 %s" % status, "CSeq: %s" % headers.get("cseq", "0")] + response_headers
+        if body:
+            response_headers.append("Content-Length: %d" % len(body))
+        client_session.send(("\r\n".join(response_headers) + "\r\n\r\n").encode("ascii") + body)
+
+    def _get_session_description(self):
+        sps, pps = self._parameter_sets
+        sprop_parameter_sets = ",".join(base64.b64encode(nal_unit).decode("ascii") for nal_unit in (sps, pps))
+        return "\r\n".join(
+            [
+                "v=0",
+                "o=- 0 0 IN IP4 %s" % self._host,
+                "s=Loopback RTSP stream",
+                "c=IN IP4 0.0.0.0",
+                "t=0 0",
+                "a=control:*",
+                "m=video 0 RTP/AVP %d" % RTP_PAYLOAD_TYPE,
+                "a=rtpmap:%d H264/%d" % (RTP_PAYLOAD_TYPE, RTP_CLOCK_RATE),
+                "a=fmtp:%d packetization-mode=1;profile-level-id=%s;sprop-parameter-sets=%s"
+                % (RTP_PAYLOAD_TYPE, sps[1:4].hex(), sprop_parameter_sets),
+                "a=control:trackID=0",
+                "",
+            ]
+        )
+
+    def _send_client_frames(self, client_session):
+        while True:
+            item = client_session.access_unit_queue.get()
+            if item is None or client_session.is_closed:
+                break
+            arrival_timestamp, frame_index, nal_units = item
+            if self.jitter_s:
+                delay_s = arrival_timestamp + random.uniform(0, self.jitter_s) - time.monotonic()
+                if delay_s > 0:
+                    time.sleep(delay_s)  # Frames are never reordered, only delayed
+            rtp_timestamp = (
+                client_session.rtp_timestamp_base + frame_index * RTP_CLOCK_RATE // self._video_framerate
+            ) & 0xFFFFFFFF
+            payloads = [payload for nal_unit in nal_units for payload in packetize_h264_nal_unit(nal_unit)]
+            interleaved_frames = []
+            dropped_packet_count = 0
+            for idx, payload in enumerate(payloads):
+                sequence_number = client_session.rtp_sequence_number
+                client_session.rtp_sequence_number = (sequence_number + 1) & 0xFFFF  # Lost packets leave gaps
+                if self.packet_loss_ratio and random.random() < self.packet_loss_ratio:
+                    dropped_packet_count += 1
+                    continue
+                is_last_packet = idx == len(payloads) - 1
+                rtp_packet = (
+                    struct.pack(
+                        ">BBHII",
+                        0x80,  # RTP version 2
+                        RTP_PAYLOAD_TYPE | (0x80 if is_last_packet else 0),  # Marker bit ends the frame
+                        sequence_number,
+                        rtp_timestamp,
+                        client_session.rtp_ssrc,
+                    )
+                    + payload
+                )
+                interleaved_frames.append(
+                    b"$" + struct.pack(">BH", client_session.rtp_channel, len(rtp_packet)) + rtp_packet
+                )
+            try:
+                client_session.send(b"".join(interleaved_frames))
+            except OSError:
+                break  # Client disconnected
+            with self._lock:
+                self._server_statistics["sent_frame_count"] += 1
+                self._server_statistics["sent_packet_count"] += len(interleaved_frames)
+                self._server_statistics["dropped_packet_count"] += dropped_packet_count
@@ -2,19 +2,30 @@
 # SPDX-FileCopyrightText: Copyright Prolifik SARL
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import functools
 import io
 import logging
+import queue
 import subprocess
-from subprocess import CalledProcessError, TimeoutExpired
+import threading
+import time
+from subprocess import CalledProcessError
 from typing import Optional
 
 import multitimer
 from PIL import Image
 
 from wacomponents.application.recorder_service import ActivityNotificationType
-from wacomponents.sensors.camera._camera_base import PreviewImageMixin, ActivityNotificationMixin
+from wacomponents.sensors.camera._camera_base import (
+    PreviewImageMixin,
+    ActivityNotificationMixin,
+    EncryptionProcessPoolMixin,
+    LatestWinsTaskWorker,
+)
+from wacomponents.sensors.camera._subprocess_recorder import SubprocessStreamRecorderBase
+from wacomponents.sensors.camera._voice_activity import VoiceActivityGate
 from wacryptolib.cryptainer import CryptainerEncryptionPipeline
-from wacryptolib.sensor import PeriodicSubprocessStreamRecorder, PeriodicEncryptionStreamMixin, PeriodicSensorRestarter
+from wacryptolib.sensor import PeriodicEncryptionStreamMixin, PeriodicSensorRestarter
 from wacryptolib.utilities import synchronized, catch_and_log_exception
 
 logger = logging.getLogger(__name__)
@@ -22,67 +33,48 @@ logger = logging.getLogger(__name__)
 
 def list_pulseaudio_microphone_names():
     """Equivalent to command:  pactl list | grep -A2 'Source #' | grep 'Name:'
+
+    Prefer the cached results of wacomponents.devices.device_inventory.
     """
     import pulsectl
 
-    pulse = pulsectl.Pulse("witness-angel-device")
-    results = pulse.source_list()
+    with pulsectl.Pulse("witness-angel-device") as pulse:  # Closes the connection, else it leaks
+        results = pulse.source_list()
     source_names = [res.name for res in results]
     # We ignore "sink monitors" (e.g. HDMI output monitor) useless for us
     microphone_names = [name for name in source_names if "input" in name.lower()]
-    # print(">>>>>>>>PULSECTL microphone_names IS", microphone_names)
     return microphone_names
 
 
 def is_legacy_rpi_camera_enabled():
+    """Prefer the cached results of wacomponents.devices.device_inventory."""
     try:
         output = subprocess.check_output(["vcgencmd", "get_camera"], text=True)
         return "supported=1 " in output
-    except CalledProcessError:
+    except (CalledProcessError, FileNotFoundError):  # FileNotFoundError if not on a Raspberry Pi
         return False
 
 
-class RaspberryRaspividSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSubprocessStreamRecorder):
+class RaspberryRaspividSensor(
+    PreviewImageMixin, EncryptionProcessPoolMixin, ActivityNotificationMixin, SubprocessStreamRecorderBase
+):
     """
     Records a raw h264 file using legacy (GPU-based) raspivid interface of the Raspberry Pi.
 
     No audio can be recorded through this sensor.
 
-    Records a screenshot before each video clip, if requested (this can be slow).
+    Extracts a screenshot from the beginning of each video clip, if requested.
     """
 
     sensor_name = "rpi_raspivid_camera"
     activity_notification_color = (0, 0, 150)
     record_extension = ".h264"
+    preview_image_stream_format = "h264"
 
     def __init__(self, raspivid_parameters: list, **kwargs):
         super().__init__(**kwargs)
         self._raspivid_parameters = raspivid_parameters
 
-    def _do_generate_preview_image(self, output, width_px, height_px):
-        assert isinstance(output, str), output
-
-        try:
-            snapshot_command_line = [
-                "raspistill",
-                "--nopreview",  # No GUI display
-                "--output",
-                output,
-                "--width",
-                str(width_px),
-                "--height",
-                str(height_px),
-                "--quality",
-                "90",
-                "-v",
-            ]
-            logger.debug(
-                "Taking camera snapshot with command: %s", " ".join(snapshot_command_line)
-            )  # Fixme standardize this
-            subprocess.check_call(snapshot_command_line, timeout=20)
-        except (CalledProcessError, TimeoutExpired) as exc:
-            logger.warning("Couldn't generate screenshot in %s sensor: %s", self.sensor_name, exc)
-
     def _build_subprocess_command_line(self):
 
         raspivid_command_line_base = ["raspivid", "--timeout", "0", "--nopreview", "-v"]  # NO timeout
@@ -109,21 +101,29 @@ class RaspberryRaspividSensor(PreviewImageMixin, ActivityNotificationMixin, Peri
         return raspivid_command_line
 
 
-class RaspberryLibcameraSensor(PreviewImageMixin, PeriodicSubprocessStreamRecorder):
+class RaspberryLibcameraSensor(PreviewImageMixin, EncryptionProcessPoolMixin, SubprocessStreamRecorderBase):
     """
     Records a video file using local camera/audio devices plugged to the Raspberry Pi.
 
     Capture video is stored either as MPEGTS if audio is embedded in it, else as raw H264 stream (without container).
 
-    Records a screenshot before each video clip, if requested (this can be slow).
+    Extracts a screenshot from the beginning of each video clip, if requested.
+
+    Degraded recording quality levels lower the framerate of default video parameters.
     """
 
     sensor_name = "rpi_libcamera"
 
+    DEGRADED_FRAMERATES = ("30", "15", "5")  # Indexed by recording quality level
+
     @property
     def record_extension(self):
         return ".mpegts" if self._alsa_device_name else ".h264"
 
+    @property
+    def preview_image_stream_format(self):
+        return "mpegts" if self._alsa_device_name else "h264"
+
     def __init__(
         self,
         alsa_device_name: Optional[str],
@@ -136,6 +136,12 @@ class RaspberryLibcameraSensor(PreviewImageMixin, PeriodicSubprocessStreamRecord
         self._libcameravid_video_parameters = libcameravid_video_parameters
         self._libcameravid_audio_parameters = libcameravid_audio_parameters
 
+    @property
+    def max_recording_quality_level(self):
+        if self._libcameravid_video_parameters:
+            return 0  # Custom parameters are left untouched
+        return len(self.DEGRADED_FRAMERATES) - 1
+
     def _build_subprocess_command_line(self):
         alsa_device_name = self._alsa_device_name
 
@@ -156,7 +162,7 @@ class RaspberryLibcameraSensor(PreviewImageMixin, PeriodicSubprocessStreamRecord
             libcameravid_video_parameters = [
                 "--flush",  # Push data ASAP
                 "--framerate",
-                "30",
+                self.DEGRADED_FRAMERATES[self.recording_quality_level],
                 # FOR LATER "--autofocus",  # Only used at startup actually, unless we use "–-keypress" trick
             ]
 
@@ -188,7 +194,7 @@ class RaspberryLibcameraSensor(PreviewImageMixin, PeriodicSubprocessStreamRecord
                 libcameravid_audio_parameters = [
                     "--flush",  # Push data ASAP
                     "--framerate",
-                    "30",
+                    self.DEGRADED_FRAMERATES[self.recording_quality_level],
                     # FOR LATER "--autofocus", but only used at startup actually, unless we use "–-keypress" trick
                 ]
 
@@ -200,32 +206,16 @@ class RaspberryLibcameraSensor(PreviewImageMixin, PeriodicSubprocessStreamRecord
         )
         return command
 
-    def _do_generate_preview_image(self, output, width_px, height_px):
-        assert isinstance(output, str), output
-
-        # Launch a subprocess just to capture screenshot
-        try:
-            snapshot_command_line = [
-                "libcamera-jpeg",
-                "--nopreview",  # No GUI display
-                "--output",
-                output,
-                "--width",
-                str(width_px),
-                "--height",
-                str(height_px),
-                "--immediate",  # No preview phase when taking picture
-                # FOR LATER "--autofocus",  # Might be limited by "immediate" mode...
-            ]
-            logger.info("Taking snapshot with command: %s", " ".join(snapshot_command_line))
-            subprocess.check_call(snapshot_command_line, timeout=20)
-        except (CalledProcessError, TimeoutExpired) as exc:
-            logger.warning("Couldn't generate screenshot in %s sensor: %s", self.sensor_name, exc)
 
-
-class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubprocessStreamRecorder):
+class RaspberryAlsaMicrophoneSensor(EncryptionProcessPoolMixin, ActivityNotificationMixin, SubprocessStreamRecorderBase):
     """
     Records an MP3 audio file using ALSA-compatible microphone (USB or HAT) plugged to the Raspberry Pi.
+
+    For uncompressed (WAV) recordings, `voice_activity_gate_parameters` (possibly an empty dict) enables a
+    voice activity gate, with these parameters (see VoiceActivityGate), which skips or collapses
+    silent stretches before encryption.
+
+    Degraded recording quality levels lower the bitrate (or sample rate) of default parameters.
     """
 
     sensor_name = "rpi_microphone"
@@ -233,6 +223,10 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
 
     subprocess_data_chunk_size = int(0.2 * 1024 ** 2)  # MP3 has smaller size than video
 
+    # Indexed by recording quality level
+    DEGRADED_MP3_BITRATES = ("128k", "64k", "32k")
+    DEGRADED_WAV_SAMPLE_RATES = ("22005", "11025", "8000")
+
     def __init__(
         self,
         compress_recording: bool,
@@ -240,6 +234,7 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
         arecord_output_format: str,
         ffmpeg_alsa_parameters: list,
         ffmpeg_alsa_output_format: str,
+        voice_activity_gate_parameters: Optional[dict] = None,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -249,6 +244,12 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
         self._ffmpeg_alsa_output_format = ffmpeg_alsa_output_format
         self._compress_recording = compress_recording
 
+        if voice_activity_gate_parameters is not None and self._get_actual_ouput_format() != "wav":
+            raise ValueError("Voice activity gate requires uncompressed WAV recordings")
+        self._voice_activity_gate_parameters = voice_activity_gate_parameters
+        self._voice_activity_gates = {}  # Maps encryption streams to their gates
+        self._voice_activity_statistics = {}
+
     def _get_actual_ouput_format(self):
         if self._compress_recording:
             return self._ffmpeg_alsa_output_format if self._ffmpeg_alsa_output_format else "mp3"
@@ -259,6 +260,12 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
     def record_extension(self):
         return "." + self._get_actual_ouput_format()
 
+    @property
+    def max_recording_quality_level(self):
+        if self._compress_recording:
+            return 0 if self._ffmpeg_alsa_parameters else len(self.DEGRADED_MP3_BITRATES) - 1
+        return 0 if self._arecord_parameters else len(self.DEGRADED_WAV_SAMPLE_RATES) - 1  # Custom ones are kept
+
     def _build_subprocess_command_line(self):
         if self._compress_recording:
 
@@ -267,7 +274,16 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
             if self._ffmpeg_alsa_parameters:
                 ffmpeg_alsa_parameters = self._ffmpeg_alsa_parameters
             else:
-                ffmpeg_alsa_parameters = ["-i", "default", "-ac", "1", "-acodec", "libmp3lame", "-ab", "128k"]
+                ffmpeg_alsa_parameters = [
+                    "-i",
+                    "default",
+                    "-ac",
+                    "1",
+                    "-acodec",
+                    "libmp3lame",
+                    "-ab",
+                    self.DEGRADED_MP3_BITRATES[self.recording_quality_level],
+                ]
 
             ffmpeg_alsa_final_params = ["-f", self._get_actual_ouput_format(), "pipe:1"]
 
@@ -283,7 +299,7 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
                     "-c",
                     "1",
                     "-r",
-                    "22005",
+                    self.DEGRADED_WAV_SAMPLE_RATES[self.recording_quality_level],
                     "-f",
                     "S16_LE",
                 ]  # If filename is not specified, the standard output is used.
@@ -292,6 +308,31 @@ class RaspberryAlsaMicrophoneSensor(ActivityNotificationMixin, PeriodicSubproces
 
         return command
 
+    def get_voice_activity_statistics(self) -> dict:
+        """Return a snapshot of counters of the voice activity gate (empty if it's disabled)."""
+        return self._voice_activity_statistics.copy()
+
+    def _encrypt_subprocess_chunk(self, chunk, cryptainer_encryption_stream):
+        if self._voice_activity_gate_parameters is None:
+            return super()._encrypt_subprocess_chunk(chunk, cryptainer_encryption_stream)
+
+        voice_activity_gate = self._voice_activity_gates.get(cryptainer_encryption_stream)
+        if voice_activity_gate is None:
+            voice_activity_gate = self._voice_activity_gates[cryptainer_encryption_stream] = VoiceActivityGate(
+                statistics=self._voice_activity_statistics, **self._voice_activity_gate_parameters
+            )
+        kept_data = voice_activity_gate.filter_chunk(chunk)
+        if kept_data:
+            super()._encrypt_subprocess_chunk(kept_data, cryptainer_encryption_stream)
+
+    def _finalize_cryptainer_encryption_stream(self, cryptainer_encryption_stream):
+        voice_activity_gate = self._voice_activity_gates.pop(cryptainer_encryption_stream, None)
+        if voice_activity_gate is not None:
+            remaining_data = voice_activity_gate.flush()
+            if remaining_data:
+                super()._encrypt_subprocess_chunk(remaining_data, cryptainer_encryption_stream)
+        super()._finalize_cryptainer_encryption_stream(cryptainer_encryption_stream)
+
 
 class _CustomPicameraOutputWithEncryptionStream(object):
     """File-like object which pushes data to encryption stream"""
@@ -310,9 +351,108 @@ class _CustomPicameraOutputWithEncryptionStream(object):
             self._encryption_stream.finalize()
 
 
+class _ThreadedCoalescingPicameraOutput(object):
+    """
+    File-like object which coalesces small writes (e.g. H264 NAL units) into big blocks, and hands them
+    to a dedicated encryption thread through a bounded queue, so that picamera's encoder callback
+    doesn't wait for encryption.
+
+    When the queue is full, data keeps being coalesced in memory; only when the pending block exceeds
+    MAX_PENDING_BLOCK_SIZE does the writer block (for at most MAX_BLOCKING_S), after what the block is dropped.
+
+    Counters are updated in the `statistics` dict, which can be shared by successive outputs.
+    """
+
+    COALESCED_BLOCK_SIZE = 256 * 1024
+    MAX_PENDING_BLOCK_SIZE = 16 * 1024**2
+    MAX_QUEUED_BLOCKS = 8
+    MAX_BLOCKING_S = 1
+
+    _FINALIZATION_MARKER = None
+
+    def __init__(self, encryption_stream: CryptainerEncryptionPipeline, statistics: dict):
+        self._encryption_stream = encryption_stream
+        self._statistics = statistics
+        for counter_name in ("blocked_duration_s", "dropped_byte_count", "dropped_block_count", "max_queue_depth"):
+            statistics.setdefault(counter_name, 0)
+        self._pending_block = bytearray()
+        self._block_queue = queue.Queue(maxsize=self.MAX_QUEUED_BLOCKS)
+        self._encryption_thread = threading.Thread(
+            target=self._consume_blocks, name="picamera_encryption_output_thread", daemon=True
+        )
+        self._encryption_thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._block_queue.qsize()
+
+    def write(self, chunk):
+        with catch_and_log_exception("ThreadedCoalescingPicameraOutput.write"):
+            self._pending_block += chunk  # Copies data, picamera might reuse its buffer
+            if len(self._pending_block) >= self.COALESCED_BLOCK_SIZE:
+                self._enqueue_pending_block(force=len(self._pending_block) >= self.MAX_PENDING_BLOCK_SIZE)
+
+    def flush(self):
+        with catch_and_log_exception("ThreadedCoalescingPicameraOutput.flush"):
+            if self._pending_block:
+                self._enqueue_pending_block(force=True)
+            # Beware, this may block, but finalization must not be lost
+            self._block_queue.put(self._FINALIZATION_MARKER)
+
+    def join(self, timeout=None):
+        """Wait for all blocks to be encrypted, and the encryption stream to be finalized after `flush()`.
+
+        Returns False on timeout."""
+        self._encryption_thread.join(timeout=timeout)
+        return not self._encryption_thread.is_alive()
+
+    def _enqueue_pending_block(self, force):
+        block = self._pending_block
+        try:
+            self._block_queue.put_nowait(block)
+        except queue.Full:
+            if not force:
+                return  # Keep coalescing, the encryption thread will catch up
+            start_time = time.monotonic()
+            try:
+                self._block_queue.put(block, timeout=self.MAX_BLOCKING_S)
+            except queue.Full:
+                logger.warning("Encryption of picamera output is too slow, dropping %d bytes of video", len(block))
+                self._statistics["dropped_byte_count"] += len(block)
+                self._statistics["dropped_block_count"] += 1
+            finally:
+                self._statistics["blocked_duration_s"] += time.monotonic() - start_time
+        self._statistics["max_queue_depth"] = max(self._statistics["max_queue_depth"], self._block_queue.qsize())
+        self._pending_block = bytearray()
+
+    def _consume_blocks(self):
+        while True:
+            block = self._block_queue.get()
+            if block is self._FINALIZATION_MARKER:
+                break
+            with catch_and_log_exception("ThreadedCoalescingPicameraOutput._consume_blocks"):
+                self._encryption_stream.encrypt_chunk(block)
+        with catch_and_log_exception("ThreadedCoalescingPicameraOutput._consume_blocks"):
+            self._encryption_stream.finalize()
+
+
 class RaspberryPicameraSensor(
-    PreviewImageMixin, ActivityNotificationMixin, PeriodicEncryptionStreamMixin, PeriodicSensorRestarter
+    PreviewImageMixin,
+    EncryptionProcessPoolMixin,
+    ActivityNotificationMixin,
+    PeriodicEncryptionStreamMixin,
+    PeriodicSensorRestarter,
 ):
+    """
+    Records a video file using the Picamera python library.
+
+    If `live_preview_interval_s` is set, preview images are regularly pushed to activity notification callback.
+    With `live_preview_raw_frames`, these are captured as raw RGB into a reusable buffer, instead of
+    being JPEG-encoded and decoded again, and frames are dropped while the consumer is still busy.
+
+    With `threaded_encryption_output`, video data is encrypted by a dedicated thread, instead of
+    inside picamera's encoder callback (see `get_encryption_output_statistics()`).
+    """
 
     sensor_name = "picamera"
     activity_notification_color = (0, 0, 180)
@@ -333,26 +473,74 @@ class RaspberryPicameraSensor(
 
     _live_image_preview_pusher = None
 
-    def __init__(self, picamera_parameters: Optional[dict], live_preview_interval_s, local_camera_rotation, **kwargs):
+    # Double the resolution of mini LCD; must be a multiple of (32, 16) for raw frames
+    LIVE_PREVIEW_WIDTH_PX = 480
+    LIVE_PREVIEW_HEIGHT_PX = 480
+
+    _live_preview_frame_buffer = None  # Reusable numpy array, for raw frames
+
+    def __init__(
+        self,
+        picamera_parameters: Optional[dict],
+        live_preview_interval_s,
+        local_camera_rotation,
+        live_preview_raw_frames: bool = False,
+        threaded_encryption_output: bool = False,
+        **kwargs
+    ):
         super().__init__(**kwargs)
         assert isinstance(local_camera_rotation, int), local_camera_rotation
         self._local_camera_rotation = local_camera_rotation
         self._picamera_parameters = picamera_parameters or self.default_parameters
 
+        self._threaded_encryption_output = threaded_encryption_output
+        self._encryption_output_statistics = {}
+        self._previous_threaded_outputs = []  # To allow a proper join() at the end
+
+        self._live_preview_worker = LatestWinsTaskWorker(name="picamera_live_preview_worker")
+        self._live_preview_statistics = dict(
+            captured_frame_count=0,
+            dropped_frame_count=0,
+            last_capture_duration_s=None,
+        )
+
         if live_preview_interval_s:
             self._live_image_preview_pusher = multitimer.MultiTimer(
-                interval=live_preview_interval_s, function=self._push_live_preview_image, runonstart=True
+                interval=live_preview_interval_s,
+                function=self._push_raw_live_preview_image
+                if live_preview_raw_frames
+                else self._push_live_preview_image,
+                runonstart=True,
             )
 
+    def get_live_preview_statistics(self) -> dict:
+        return self._live_preview_statistics.copy()
+
+    def get_encryption_output_statistics(self) -> dict:
+        """Return counters of the threaded encryption output, if enabled."""
+        encryption_output_statistics = self._encryption_output_statistics.copy()
+        if isinstance(self._current_buffer, _ThreadedCoalescingPicameraOutput):
+            encryption_output_statistics["queue_depth"] = self._current_buffer.queue_depth
+        return encryption_output_statistics
+
     @property
     def record_extension(self):
         return "." + self._picamera_parameters.get("format", "h264")
 
-    def _do_generate_preview_image(self, output, width_px, height_px):
+    def _capture_video_port_image(self, output, width_px, height_px):
+        """Capture a JPEG image while recording; caller must hold the sensor lock, which serializes captures."""
         assert self._picamera  # We generate previews WHILE recording
         assert isinstance(output, str) or hasattr(output, "write"), repr(output)
         self._picamera.capture(output, use_video_port=True, format="jpeg", resize=(width_px, height_px))
 
+    def _do_generate_preview_image(self, output, width_px, height_px):
+        # Called from the preview image worker thread, so the sensor might have been stopped meanwhile
+        with self._lock:
+            if not self.is_running or not self._picamera:
+                logger.info("Skipping preview image generation, since %s was stopped", self.sensor_name)
+                return
+            self._capture_video_port_image(output, width_px=width_px, height_px=height_px)
+
     @synchronized
     @catch_and_log_exception("RaspberryPicameraSensor._push_live_preview_image")
     def _push_live_preview_image(self):
@@ -360,21 +548,72 @@ class RaspberryPicameraSensor(
         with catch_and_log_exception("RaspberryPicameraSensor._push_live_preview_image"):
             assert self.is_running
             output = io.BytesIO()
-            self._do_generate_preview_image(output, width_px=480, height_px=480)  # Double the resolution of mini LCD
+            self._capture_video_port_image(
+                output, width_px=self.LIVE_PREVIEW_WIDTH_PX, height_px=self.LIVE_PREVIEW_HEIGHT_PX
+            )
             output.seek(0)
             notification_image = Image.open(output, formats=["JPEG"])
             self._activity_notification_callback(
                 notification_type=ActivityNotificationType.IMAGE_PREVIEW, notification_image=notification_image
             )
 
+    @synchronized
+    def _capture_raw_live_preview_frame(self):
+        """Capture an RGB frame into the reusable buffer, and return it (or None if sensor was stopped)."""
+        if not self.is_running or not self._picamera:
+            return None
+
+        if self._live_preview_frame_buffer is None:
+            import numpy  # LAZY loaded
+
+            self._live_preview_frame_buffer = numpy.empty(
+                (self.LIVE_PREVIEW_HEIGHT_PX, self.LIVE_PREVIEW_WIDTH_PX, 3), dtype=numpy.uint8
+            )
+
+        start_time = time.monotonic()
+        self._picamera.capture(
+            self._live_preview_frame_buffer,
+            use_video_port=True,
+            format="rgb",
+            resize=(self.LIVE_PREVIEW_WIDTH_PX, self.LIVE_PREVIEW_HEIGHT_PX),
+        )
+        self._live_preview_statistics["last_capture_duration_s"] = time.monotonic() - start_time
+        self._live_preview_statistics["captured_frame_count"] += 1
+        return self._live_preview_frame_buffer
+
+    @catch_and_log_exception("RaspberryPicameraSensor._push_raw_live_preview_image")
+    def _push_raw_live_preview_image(self):
+        if self._live_preview_worker.has_pending_task:
+            self._live_preview_statistics["dropped_frame_count"] += 1
+            return  # Consumer is slower than our live preview interval
+
+        frame_buffer = self._capture_raw_live_preview_frame()
+        if frame_buffer is None:
+            return
+
+        # Conversion happens outside the sensor lock; this copies RGB data, so buffer can be reused at next tick
+        notification_image = Image.fromarray(frame_buffer)
+        self._live_preview_worker.submit(
+            functools.partial(
+                self._activity_notification_callback,
+                notification_type=ActivityNotificationType.IMAGE_PREVIEW,
+                notification_image=notification_image,
+            )
+        )
+
     def _create_custom_output(self):
         logger.info("Building new cryptainer encryption stream for picamera sensor")
         encryption_stream = self._build_cryptainer_encryption_stream()
+        if self._threaded_encryption_output:
+            self._previous_threaded_outputs = [
+                output for output in self._previous_threaded_outputs if output._encryption_thread.is_alive()
+            ]
+            output = _ThreadedCoalescingPicameraOutput(encryption_stream, statistics=self._encryption_output_statistics)
+            self._previous_threaded_outputs.append(output)
+            return output
         return _CustomPicameraOutputWithEncryptionStream(encryption_stream)
 
     def _do_start_recording(self):  # pragma: no cover
-        self._current_buffer = self._create_custom_output()
-
         init_parameter_names = ["resolution", "framerate"]
         _picamera_parameters = self._picamera_parameters
         picamera_init_parameters = {k: v for (k, v) in _picamera_parameters.items() if k in init_parameter_names}
@@ -385,8 +624,15 @@ class RaspberryPicameraSensor(
         logger.info("Creating Picamera instance for video and image recording")
         self._picamera = picamera.PiCamera(**picamera_init_parameters)  # Might raise e.g. PiCameraMMALError
         self._picamera.rotation = self._local_camera_rotation
-        self._picamera.start_recording(self._current_buffer, **picamera_start_parameters)
-        self._conditionally_regenerate_preview_image()
+
+        # Only created once the camera is open, since threaded outputs own a thread and an encryption stream
+        self._current_buffer = self._create_custom_output()
+        try:
+            self._picamera.start_recording(self._current_buffer, **picamera_start_parameters)
+        except Exception:
+            self._current_buffer.flush()  # Finalizes the encryption stream, and lets threaded output exit
+            raise
+        self._conditionally_regenerate_preview_image()  # Captured from the video port
         if self._live_image_preview_pusher:
             self._live_image_preview_pusher.start()
 
@@ -404,3 +650,9 @@ class RaspberryPicameraSensor(
         new_buffer = self._create_custom_output()
         self._picamera.split_recording(new_buffer)
         self._current_buffer = new_buffer
+
+    def join(self):
+        super().join()
+        for output in self._previous_threaded_outputs:
+            if not output.join(timeout=15):  # Output might never have been flushed, if picamera start failed
+                logger.critical("An encryption output thread of previous %s recording didn't exit" % self.sensor_name)
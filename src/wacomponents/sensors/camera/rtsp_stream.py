@@ -3,13 +3,27 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import logging
-import re
 import subprocess
+import threading
+import time
 from datetime import timezone, datetime
+from typing import Optional
 
 from wacomponents.i18n import tr
-from wacomponents.sensors.camera._camera_base import PreviewImageMixin, ActivityNotificationMixin
-from wacryptolib.sensor import PeriodicSubprocessStreamRecorder
+from wacomponents.sensors.camera._camera_base import (
+    PreviewImageMixin,
+    ActivityNotificationMixin,
+    EncryptionProcessPoolMixin,
+)
+from wacomponents.sensors.camera._media_bitstream import (
+    MPEGTS_PACKET_SIZE,
+    find_mpegts_video_random_access_offset,
+    get_first_mpegts_packet_offset,
+)
+from wacomponents.sensors.camera._subprocess_recorder import SubprocessStreamRecorderBase
+from wacomponents.sensors.camera.ffmpeg_capabilities import get_ffmpeg_capabilities
+from wacryptolib.sensor import SensorManager
+from wacryptolib.utilities import catch_and_log_exception
 
 logger = logging.getLogger(__name__)
 
@@ -20,64 +34,180 @@ def get_utc_now_date():  # FIXME remove this
 
 
 def get_ffmpeg_version() -> tuple:
-    """Returns a pair with version as a float(or None), along with an error message (or None if success)."""
+    """Returns a pair with version as a float(or None), along with an error message (or None if success).
+
+    Relies on the cached ffmpeg capabilities registry, so no subprocess is spawned on the hot path."""
     try:
-        output = subprocess.check_output(["ffmpeg", "-version"], stderr=subprocess.STDOUT)
-    except OSError:
+        ffmpeg_capabilities = get_ffmpeg_capabilities()
+    except (OSError, subprocess.SubprocessError):
         logger.warning("Error while calling ffmpeg to retrieve version", exc_info=True)
-        return None, tr.f(tr._("Ffmpeg module not found, please ensure it is in your PATH"))
+        ffmpeg_capabilities = None
 
-    output = output.decode("ascii", "ignore").lower()
+    if ffmpeg_capabilities is None:
+        return None, tr.f(tr._("Ffmpeg module not found, please ensure it is in your PATH"))
 
-    regex = r"ffmpeg version .?(\d\.\d)"  # E.g. FFMPEG SNAPs contain a "n" before version number
-    match = re.search(regex, output)
+    ffmpeg_version = ffmpeg_capabilities["version"]
 
-    if match is None:
+    if ffmpeg_version is None:
         return None, tr.f(tr._("Ffmpeg module is installed, but beware its version couldn't be determined"))
 
-    ffmpeg_version = match.group(1)
-    return float(ffmpeg_version), None
+    return ffmpeg_version, None
 
 
-class RtspCameraSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSubprocessStreamRecorder):
+class RtspCameraSensor(
+    PreviewImageMixin, EncryptionProcessPoolMixin, ActivityNotificationMixin, SubprocessStreamRecorderBase
+):
     """
     Records an RTSP stream, by default WITHOUT AUDIO (unless ffmpeg_rtsp_parameters override that=.
 
     Automatically extracts a screenshot at the beginning of each recording.
+
+    With `gapless_rotation`, a single RTSP session is kept open, and its MPEGTS output is cut on
+    video keyframes into contiguous cryptainers (the screenshot is then extracted from each segment).
+
+    With `scene_activity_threshold` (a ffmpeg scene score between 0 and 1, e.g. 0.02), keyframes of the video
+    are analyzed by ffmpeg, and the data of each segment is held in memory until some scene change is detected.
+    Segments without activity are then either emptied or truncated to their beginning, according to
+    `inactive_segment_policy` ("drop" or "sample"), before encryption. If scene analysis yields no result,
+    or too much data gets held, segments are fully recorded. Since only MPEGTS output can be truncated
+    anywhere (on packet boundaries), "sample" is the default policy for it, and "drop" the only one allowed otherwise.
+
+    Beware, the scene gate holds up to `scene_gate_max_held_size` bytes (4 MiB by default) of CLEARTEXT data
+    per camera, for as long as a segment shows no activity; this memory adds up across the cameras of a
+    sensor group. Segments whose data exceeds this bound get fully recorded, so the recording interval
+    should be short enough for the bitrate of the camera (e.g. 4 MiB hold 30s of a 1 Mbps stream).
+
+    At degraded recording quality level 1, only video keyframes are recorded (without transcoding);
+    this is not supported with custom `ffmpeg_rtsp_parameters`.
     """
 
     sensor_name = "rtsp_camera"
     activity_notification_color = (0, 150, 0)
 
-    def __init__(self, video_stream_url: str, ffmpeg_rtsp_parameters: list, ffmpeg_rtsp_output_format: str, **kwargs):
+    # In gapless mode, max delay to wait for a keyframe, before cutting the stream anyway
+    GAPLESS_KEYFRAME_WAIT_S = 10
+
+    # Settings for the scene activity gate, if enabled
+    SCENE_ANALYSIS_WIDTH_PX = 64
+    SCENE_GATE_MAX_HELD_SIZE = 4 * 1024**2  # Default value
+    INACTIVE_SEGMENT_SAMPLE_SIZE = 512 * 1024
+    INACTIVE_SEGMENT_POLICIES = ("drop", "sample")
+
+    # First ffmpeg version whose "noise" bitstream filter accepts a packet drop expression
+    KEYFRAMES_ONLY_MIN_FFMPEG_VERSION = 5.1
+
+    _segment_cut_search_start = None
+    _last_scene_score_timestamp = None  # From time.monotonic()
+    _last_scene_activity_timestamp = None
+
+    def __init__(
+        self,
+        video_stream_url: str,
+        ffmpeg_rtsp_parameters: list,
+        ffmpeg_rtsp_output_format: str,
+        gapless_rotation: bool = False,
+        sensor_name: Optional[str] = None,
+        scene_activity_threshold: Optional[float] = None,
+        inactive_segment_policy: Optional[str] = None,
+        scene_gate_max_held_size: Optional[int] = None,
+        **kwargs
+    ):
         super().__init__(**kwargs)
         assert video_stream_url, video_stream_url
+        if sensor_name:
+            self.sensor_name = sensor_name  # Required to distinguish cryptainers of several cameras
+        if gapless_rotation and ffmpeg_rtsp_output_format not in (None, "", "mpegts"):
+            raise ValueError(
+                "Gapless rotation of RTSP stream requires mpegts output format, not %r" % ffmpeg_rtsp_output_format
+            )
         self._video_stream_url = video_stream_url
         self._ffmpeg_rtsp_parameters = ffmpeg_rtsp_parameters
         self._ffmpeg_rtsp_output_format = ffmpeg_rtsp_output_format
+        self.gapless_rotation = gapless_rotation
+
+        can_sample_segments = self._get_actual_ouput_format() == "mpegts"
+        if inactive_segment_policy is None:
+            inactive_segment_policy = "sample" if can_sample_segments else "drop"
+        if inactive_segment_policy not in self.INACTIVE_SEGMENT_POLICIES:
+            raise ValueError("Unknown inactive segment policy %r" % inactive_segment_policy)
+        if inactive_segment_policy == "sample" and not can_sample_segments:
+            raise ValueError(
+                "Inactive segment policy 'sample' requires mpegts output format, not %r"
+                % self._get_actual_ouput_format()
+            )
+        assert scene_activity_threshold is None or 0 < scene_activity_threshold < 1, scene_activity_threshold
+        self._scene_activity_threshold = scene_activity_threshold
+        self._inactive_segment_policy = inactive_segment_policy
+        if scene_gate_max_held_size is None:
+            scene_gate_max_held_size = self.SCENE_GATE_MAX_HELD_SIZE
+        assert scene_gate_max_held_size > 0, scene_gate_max_held_size
+        self._scene_gate_max_held_size = scene_gate_max_held_size
+        self._scene_gate_states = {}  # Maps encryption streams to the data held for them
+        self._stream_statistics.update(
+            scene_gate_active_segment_count=0,
+            scene_gate_inactive_segment_count=0,
+            scene_gate_saved_byte_count=0,
+            last_scene_score=None,
+        )
 
     def _get_actual_ouput_format(self):
+        if self.gapless_rotation:
+            return "mpegts"  # Only this format can be cut anywhere on packet boundaries
         return self._ffmpeg_rtsp_output_format if self._ffmpeg_rtsp_output_format else "mp4"
 
     @property
     def record_extension(self):
         return "." + self._get_actual_ouput_format()
 
+    @property
+    def max_recording_quality_level(self):
+        if self._ffmpeg_rtsp_parameters:
+            return 0  # Custom parameters might not copy the video stream, so they are left untouched
+        ffmpeg_version, _error_message = get_ffmpeg_version()
+        if ffmpeg_version is not None and ffmpeg_version >= self.KEYFRAMES_ONLY_MIN_FFMPEG_VERSION:
+            return 1
+        return 0
+
+    @property
+    def preview_image_stream_format(self):
+        # In gapless mode, a preview image is extracted from each segment, not only once per ffmpeg session
+        return "mpegts" if self.gapless_rotation else None
+
+    def _get_preview_image_ffmpeg_filter(self, width_px, height_px):
+        return "scale=%d:-1,hue=s=0" % width_px  # Keep image ratio!
+
     def _do_generate_preview_image(self, output_path, width_px, height_px):
         pass  # Skipped, since preview image is automatically generated during RTSP capture
 
-    def _build_subprocess_command_line(self):
-        ffmpeg_version, _error_msg = get_ffmpeg_version()
+    @staticmethod
+    def _get_rtsp_socket_timeout_option():
+        """Return the ffmpeg input option setting the RTSP socket timeout, or None if unknown."""
+        try:
+            ffmpeg_capabilities = get_ffmpeg_capabilities()
+        except (OSError, subprocess.SubprocessError):
+            ffmpeg_capabilities = None  # Recording will fail anyway
+
+        if not ffmpeg_capabilities:
+            return None
+
+        rtsp_demuxer_options = ffmpeg_capabilities["rtsp_demuxer_options"]
+        if "stimeout" in rtsp_demuxer_options:
+            return "-stimeout"  # Here, "timeout" would mean "listen timeout"
 
+        ffmpeg_version = ffmpeg_capabilities["version"]
+        if "timeout" in rtsp_demuxer_options or (ffmpeg_version is not None and ffmpeg_version >= 5):
+            return "-timeout"  # This previously meant "listen timeout"
+        if ffmpeg_version is not None:
+            return "-stimeout"
+        return None
+
+    def _build_subprocess_command_line(self):
         additional_input_args = []
         timeout_microseconds = "5000000"
-        if ffmpeg_version is not None:
+        timeout_option = self._get_rtsp_socket_timeout_option()
+        if timeout_option:
             # Force failure if input can't be joined anymore (microseconds!)
-            if ffmpeg_version >= 5:
-                # This previously meant "listen timeout"
-                additional_input_args = ["-timeout", timeout_microseconds]
-            else:
-                additional_input_args = ["-stimeout", timeout_microseconds]
+            additional_input_args = [timeout_option, timeout_microseconds]
 
         executable = [
             "ffmpeg",
@@ -85,6 +215,10 @@ class RtspCameraSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSub
             "-hide_banner",  # Hide useless "library configuration mismatch" stuffs
         ]
 
+        if self._scene_activity_threshold is not None:
+            # Only keyframes get decoded, for scene analysis, since other outputs just copy the stream
+            additional_input_args += ["-skip_frame", "nokey"]
+
         input = additional_input_args + [
             "-rtsp_flags",
             "prefer_tcp",  # Safer alternative to ( "-rtsp_transport", "tcp", )
@@ -99,6 +233,14 @@ class RtspCameraSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSub
 
         if self._ffmpeg_rtsp_parameters:
             codec = self._ffmpeg_rtsp_parameters
+        elif self.gapless_rotation:
+            codec = [
+                "-vcodec",
+                "copy",
+                "-an",  # NO AUDIO FOR NOW, like in non-gapless mode
+                "-map",
+                "0",
+            ]
         else:
             codec = [
                 # "-copytb", "1", (doesn't work for timestamps)
@@ -118,6 +260,9 @@ class RtspCameraSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSub
                 "500",
             ]
 
+        if self.recording_quality_level >= 1:
+            codec = codec + ["-bsf:v", "noise=drop=not(key)"]  # Keyframes only, to save disk space
+
         logs = ["-loglevel", "info"]  # Values: error, warning, info, debug or trace
         video_output = [
             "-f",
@@ -127,13 +272,207 @@ class RtspCameraSensor(PreviewImageMixin, ActivityNotificationMixin, PeriodicSub
         ]
 
         preview_image_output = []
-        if self._preview_image_path:
+        if self._preview_image_path and not self.preview_image_stream_format:
             preview_image_output = [
                 "-frames:v",
                 "1",
                 "-filter:v",
-                "scale=%d:-1,hue=s=0" % self.PREVIEW_IMAGE_WIDTH_PX,  # Keep image ratio!
+                self._get_preview_image_ffmpeg_filter(
+                    width_px=self.PREVIEW_IMAGE_WIDTH_PX, height_px=self.PREVIEW_IMAGE_HEIGHT_PX
+                ),
                 str(self._preview_image_path),
             ]
-        subprocess_command_line = executable + input + codec + logs + video_output + preview_image_output
+        scene_analysis_output = []
+        if self._scene_activity_threshold is not None:
+            scene_analysis_output = [
+                "-map",
+                "0:v:0",
+                "-an",
+                "-filter:v",
+                "scale=%d:-1,format=gray,select=gte(scene\\,0),metadata=print:key=lavfi.scene_score"
+                % self.SCENE_ANALYSIS_WIDTH_PX,
+                "-f",
+                "null",
+                "-",
+            ]
+        subprocess_command_line = (
+            executable + input + codec + logs + video_output + preview_image_output + scene_analysis_output
+        )
         return subprocess_command_line
+
+    def _consume_subprocess_stderr(self, fh):
+        if self._scene_activity_threshold is None:
+            return super()._consume_subprocess_stderr(fh)
+        for line in fh:
+            line_str = line.decode("ascii", "ignore").rstrip("\n")
+            if "lavfi.scene_score=" in line_str:
+                try:
+                    scene_score = float(line_str.rpartition("=")[2])
+                except ValueError:  # E.g. line garbled by interleaved output
+                    logger.warning("Unparseable scene score in subprocess stderr: %s" % line_str)
+                else:
+                    self._register_scene_score(scene_score)
+            elif "Parsed_metadata" not in line_str:  # Skip frame-info lines of scene analysis
+                logger.info("Subprocess stderr: %s" % line_str)
+        fh.close()
+
+    def _register_scene_score(self, scene_score):
+        now = time.monotonic()
+        self._last_scene_score_timestamp = now
+        self._stream_statistics["last_scene_score"] = scene_score
+        if scene_score >= self._scene_activity_threshold:
+            self._last_scene_activity_timestamp = now
+
+    def _encrypt_subprocess_chunk(self, chunk, cryptainer_encryption_stream):
+        if self._scene_activity_threshold is None:
+            return super()._encrypt_subprocess_chunk(chunk, cryptainer_encryption_stream)
+
+        scene_gate_state = self._scene_gate_states.get(cryptainer_encryption_stream)
+        if scene_gate_state is None:
+            scene_gate_state = self._scene_gate_states[cryptainer_encryption_stream] = dict(
+                start_timestamp=time.monotonic(), held_chunks=[], held_size=0, is_open=False
+            )
+
+        if not scene_gate_state["is_open"]:
+            last_scene_activity_timestamp = self._last_scene_activity_timestamp
+            if (
+                last_scene_activity_timestamp is not None
+                and last_scene_activity_timestamp >= scene_gate_state["start_timestamp"]
+            ):
+                logger.info("Scene activity detected in %s segment, recording it", self.sensor_name)
+                self._open_scene_gate(scene_gate_state, cryptainer_encryption_stream)
+            elif scene_gate_state["held_size"] + len(chunk) > self._scene_gate_max_held_size:
+                logger.warning("Too much data held by scene gate of %s sensor, recording segment", self.sensor_name)
+                self._open_scene_gate(scene_gate_state, cryptainer_encryption_stream)
+            else:
+                scene_gate_state["held_chunks"].append(bytes(chunk))  # Chunk buffer gets reused
+                scene_gate_state["held_size"] += len(chunk)
+                return
+
+        super()._encrypt_subprocess_chunk(chunk, cryptainer_encryption_stream)
+
+    def _open_scene_gate(self, scene_gate_state, cryptainer_encryption_stream):
+        scene_gate_state["is_open"] = True
+        for held_chunk in scene_gate_state["held_chunks"]:
+            super()._encrypt_subprocess_chunk(held_chunk, cryptainer_encryption_stream)
+        scene_gate_state["held_chunks"] = []
+
+    def _finalize_cryptainer_encryption_stream(self, cryptainer_encryption_stream):
+        scene_gate_state = self._scene_gate_states.pop(cryptainer_encryption_stream, None)
+        if scene_gate_state is not None:
+            stream_statistics = self._stream_statistics
+            last_scene_score_timestamp = self._last_scene_score_timestamp
+            if scene_gate_state["is_open"]:
+                stream_statistics["scene_gate_active_segment_count"] += 1
+            elif last_scene_score_timestamp is None or last_scene_score_timestamp < scene_gate_state["start_timestamp"]:
+                logger.warning("No scene analysis result for %s segment, recording it anyway", self.sensor_name)
+                self._open_scene_gate(scene_gate_state, cryptainer_encryption_stream)
+                stream_statistics["scene_gate_active_segment_count"] += 1
+            else:
+                kept_data = b""
+                if self._inactive_segment_policy == "sample":
+                    sample_size = self.INACTIVE_SEGMENT_SAMPLE_SIZE
+                    sample_size -= sample_size % MPEGTS_PACKET_SIZE  # Keep whole packets
+                    kept_data = b"".join(scene_gate_state["held_chunks"])[:sample_size]
+                logger.info(
+                    "No scene activity in %s segment, keeping %d bytes out of %d",
+                    self.sensor_name,
+                    len(kept_data),
+                    scene_gate_state["held_size"],
+                )
+                self._truncate_seek_index(cryptainer_encryption_stream, len(kept_data))
+                if kept_data:
+                    super()._encrypt_subprocess_chunk(kept_data, cryptainer_encryption_stream)
+                stream_statistics["scene_gate_inactive_segment_count"] += 1
+                stream_statistics["scene_gate_saved_byte_count"] += scene_gate_state["held_size"] - len(kept_data)
+        super()._finalize_cryptainer_encryption_stream(cryptainer_encryption_stream)
+
+    def _find_segment_cut_offset(self, chunk, stream_offset):
+        if self._segment_cut_search_start is None:
+            self._segment_cut_search_start = time.monotonic()
+
+        cut_offset = find_mpegts_video_random_access_offset(chunk, stream_offset=stream_offset)
+
+        if cut_offset is None and (time.monotonic() - self._segment_cut_search_start) > self.GAPLESS_KEYFRAME_WAIT_S:
+            logger.warning(
+                "No keyframe found in %s stream after %ss, cutting it on a packet boundary",
+                self.sensor_name,
+                self.GAPLESS_KEYFRAME_WAIT_S,
+            )
+            cut_offset = get_first_mpegts_packet_offset(len(chunk), stream_offset=stream_offset)
+
+        if cut_offset is not None:
+            self._segment_cut_search_start = None
+        return cut_offset
+
+
+class RtspCameraSensorGroup(SensorManager):
+    """
+    Manage several RTSP cameras of a same site, as a single sensor.
+
+    Periodic rotations of cameras are staggered across their recording interval, so that they don't
+    all restart ffmpeg and finalize cryptainers at the same instant, and at most `max_concurrent_encryptions`
+    chunks get encrypted at the same time across the group.
+
+    A camera waiting more than `max_encryption_wait_s` for its turn encrypts its chunk anyway, so that
+    a stalled camera can't starve the others.
+    """
+
+    def __init__(
+        self, sensors: list, max_concurrent_encryptions: int = 2, max_encryption_wait_s: float = 5, stagger_rotations=True
+    ):
+        super().__init__(sensors=sensors)
+        assert sensors, sensors
+        assert max_concurrent_encryptions > 0, max_concurrent_encryptions
+        sensor_names = [sensor.sensor_name for sensor in sensors]
+        if len(set(sensor_names)) != len(sensor_names):
+            raise ValueError("RTSP cameras of a group must have distinct sensor names, not %s" % sensor_names)
+
+        self._stagger_rotations = stagger_rotations
+        self._stagger_timers = []
+        self._encryption_throttle = threading.BoundedSemaphore(max_concurrent_encryptions)
+        for sensor in sensors:
+            sensor.set_encryption_throttle(self._encryption_throttle, max_wait_s=max_encryption_wait_s)
+
+    def start(self):
+        success_count = super().start()
+        if self._stagger_rotations:
+            sensor_count = len(self._sensors)
+            for idx, sensor in enumerate(self._sensors[1:], start=1):
+                # The first rotation of this sensor gets advanced, and next ones keep the same phase shift
+                delay_s = sensor._interval_s * idx / sensor_count
+                timer = threading.Timer(
+                    delay_s,
+                    catch_and_log_exception(f"staggered rotation of sensor {sensor.sensor_name}")(sensor.rotate_recording),
+                    kwargs=dict(rephase_periodic_rotations=True),
+                )
+                timer.daemon = True
+                timer.start()
+                self._stagger_timers.append(timer)
+        return success_count
+
+    def stop(self):
+        for timer in self._stagger_timers:
+            timer.cancel()
+        return super().stop()
+
+    def join(self):
+        for timer in self._stagger_timers:
+            timer.join()
+        self._stagger_timers = []
+        return super().join()
+
+    def get_throughput_report(self) -> dict:
+        """Return, for each camera of the group (by sensor name), its stream statistics.
+
+        A "seconds_since_last_chunk" field is added, to easily spot stalled cameras."""
+        now = time.monotonic()
+        throughput_report = {}
+        for sensor in self._sensors:
+            stream_statistics = sensor.get_stream_statistics()
+            last_chunk_timestamp = stream_statistics["last_chunk_timestamp"]
+            stream_statistics["seconds_since_last_chunk"] = (
+                None if last_chunk_timestamp is None else now - last_chunk_timestamp
+            )
+            throughput_report[sensor.sensor_name] = stream_statistics
+        return throughput_report
@@ -0,0 +1,116 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import logging
+from typing import Optional
+
+from wacomponents.sensors.camera._camera_base import ActivityNotificationMixin, EncryptionProcessPoolMixin
+from wacomponents.sensors.camera._media_bitstream import find_mpegts_video_random_access_offset
+from wacomponents.sensors.camera._subprocess_recorder import SubprocessStreamRecorderBase
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticStreamSensor(EncryptionProcessPoolMixin, ActivityNotificationMixin, SubprocessStreamRecorderBase):
+    """
+    Records a synthetic MPEGTS stream, with H264 video (ffmpeg "testsrc2" pattern) and AAC audio (ffmpeg "sine"
+    tone) generated by ffmpeg's lavfi, so that the whole encryption and storage path can be exercised at realistic
+    data rates, without cameras or network.
+
+    Video is encoded at a constant `video_bitrate` (ffmpeg syntax, e.g. "2M"), with a keyframe every
+    `keyframe_interval_s`. Unless `realtime` is False, data is produced at the pace of a live source,
+    else as fast as ffmpeg can encode it (for stress tests).
+
+    Like for RTSP cameras, `gapless_rotation` keeps a single subprocess alive, and cuts its output on keyframes.
+    """
+
+    sensor_name = "synthetic_stream"
+    activity_notification_color = (0, 100, 200)
+    record_extension = ".mpegts"
+
+    subprocess_data_chunk_size = 256 * 1024  # Initial value, since chunk sizing is adaptive by default
+
+    def __init__(
+        self,
+        video_resolution: str = "1280x720",
+        video_framerate: int = 25,
+        video_bitrate: str = "2M",
+        keyframe_interval_s: float = 1,
+        audio_bitrate: Optional[str] = "64k",
+        audio_frequency_hz: int = 440,
+        realtime: bool = True,
+        gapless_rotation: bool = False,
+        sensor_name: Optional[str] = None,
+        **kwargs
+    ):
+        kwargs.setdefault("adaptive_chunk_sizing", True)  # Else low bitrates would delay gapless cuts a lot
+        super().__init__(**kwargs)
+        assert keyframe_interval_s > 0, keyframe_interval_s
+        if sensor_name:
+            self.sensor_name = sensor_name  # Required to distinguish cryptainers of several synthetic sensors
+        self._video_resolution = video_resolution
+        self._video_framerate = video_framerate
+        self._video_bitrate = video_bitrate
+        self._keyframe_interval_s = keyframe_interval_s
+        self._audio_bitrate = audio_bitrate  # None to disable audio
+        self._audio_frequency_hz = audio_frequency_hz
+        self._realtime = realtime
+        self.gapless_rotation = gapless_rotation
+
+    def _build_subprocess_command_line(self):
+        realtime_input_args = ["-re"] if self._realtime else []  # Read inputs at their native frame rate
+
+        input = realtime_input_args + [
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc2=size=%s:rate=%d" % (self._video_resolution, self._video_framerate),
+        ]
+        video_codec = [
+            "-map",
+            "0:v",
+            "-vcodec",
+            "libx264",
+            "-preset",
+            "ultrafast",  # Keep CPU usage low, since we benchmark what comes after ffmpeg
+            "-tune",
+            "zerolatency",
+            "-pix_fmt",
+            "yuv420p",
+            "-g",
+            str(max(1, round(self._video_framerate * self._keyframe_interval_s))),
+            # Constant bitrate, else test patterns would compress way better than real scenes
+            "-b:v",
+            self._video_bitrate,
+            "-minrate",
+            self._video_bitrate,
+            "-maxrate",
+            self._video_bitrate,
+            "-bufsize",
+            self._video_bitrate,
+            "-x264-params",
+            "nal-hrd=cbr",
+        ]
+
+        audio_codec = []
+        if self._audio_bitrate:
+            input += realtime_input_args + [
+                "-f",
+                "lavfi",
+                "-i",
+                "sine=frequency=%d:sample_rate=44100" % self._audio_frequency_hz,
+            ]
+            audio_codec = ["-map", "1:a", "-acodec", "aac", "-b:a", self._audio_bitrate]
+
+        subprocess_command_line = (
+            ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"]
+            + input
+            + video_codec
+            + audio_codec
+            + ["-f", "mpegts", "pipe:1"]
+        )
+        return subprocess_command_line
+
+    def _find_segment_cut_offset(self, chunk, stream_offset):
+        return find_mpegts_video_random_access_offset(chunk, stream_offset=stream_offset)  # Keyframes are frequent
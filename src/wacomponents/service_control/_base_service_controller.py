@@ -43,6 +43,9 @@ class ServiceControllerBase:
     def broadcast_recording_state(self):
         self._send_message("/broadcast_recording_state")
 
+    def invalidate_recording_toolchain(self):
+        self._send_message("/invalidate_recording_toolchain")
+
     def __attempt_cryptainer_decryption(self, cryptainer_filepath):
         # FIXME unused, pb with transfer of passphrases for now...
         self._send_message("/attempt_cryptainer_decryption", cryptainer_filepath)
@@ -0,0 +1,91 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import time
+
+import pytest
+
+from wacomponents.devices.device_inventory import DeviceInventory, probe_spi_displays, probe_video4linux_cameras
+
+
+def test_device_inventory_caching_and_hotplug(tmp_path):
+    dev_path = tmp_path / "dev"
+    dev_path.mkdir()
+    mounts_path = tmp_path / "mounts"
+    mounts_path.write_text("/dev/root / ext4 rw 0 0\n")
+
+    probing_calls = []
+    microphones = ["alsa_input.usb-mic"]
+
+    def probe_microphones():
+        probing_calls.append("microphones")
+        return list(microphones)
+
+    def probe_broken_devices():
+        probing_calls.append("broken")
+        raise OSError("no such tool")
+
+    device_inventory = DeviceInventory(
+        dict(microphones=probe_microphones, broken=probe_broken_devices),
+        hotplug_polling_interval_s=0.1,
+        refresh_interval_s=3600,
+        dev_path=dev_path,
+        mounts_path=mounts_path,
+    )
+
+    # Lookups are lazy then served from memory
+    assert device_inventory.get_inventory() == {}
+    assert device_inventory.get_devices("microphones") == ["alsa_input.usb-mic"]
+    device_inventory.get_devices("microphones").append("tampered")
+    assert device_inventory.get_devices("microphones") == ["alsa_input.usb-mic"]
+    assert device_inventory.get_devices("broken") is None
+    assert probing_calls == ["microphones", "broken"]
+    with pytest.raises(ValueError):
+        device_inventory.get_devices("unknown")
+
+    device_inventory.start()
+    try:
+        time.sleep(0.5)
+        assert device_inventory.get_refresh_count() == 1  # Initial full refresh only
+        assert probing_calls.count("microphones") == 2
+
+        # New device node triggers a refresh
+        microphones.append("alsa_input.usb-other-mic")
+        dev_path.joinpath("snd").mkdir()
+        time.sleep(0.5)
+        assert device_inventory.get_refresh_count() == 2
+        assert device_inventory.get_devices("microphones") == ["alsa_input.usb-mic", "alsa_input.usb-other-mic"]
+
+        # Unrelated device nodes are ignored
+        dev_path.joinpath("tty1").touch()
+        time.sleep(0.5)
+        assert device_inventory.get_refresh_count() == 2
+
+        # New mounted partition triggers a refresh too
+        mounts_path.write_text("/dev/root / ext4 rw 0 0\n/dev/sda1 /media/usbkey vfat rw 0 0\n")
+        time.sleep(0.5)
+        assert device_inventory.get_refresh_count() == 3
+    finally:
+        device_inventory.stop()
+        device_inventory.join()
+
+    assert device_inventory.get_inventory() == dict(
+        microphones=["alsa_input.usb-mic", "alsa_input.usb-other-mic"], broken=None
+    )
+
+
+def test_filesystem_device_probers(tmp_path):
+    dev_path = tmp_path / "dev"
+    dev_path.mkdir()
+    for name in ("spidev0.1", "spidev0.0", "video0"):
+        dev_path.joinpath(name).touch()
+    assert probe_spi_displays(dev_path) == [str(dev_path / "spidev0.0"), str(dev_path / "spidev0.1")]
+    assert probe_spi_displays(tmp_path / "missing") == []
+
+    sysfs_path = tmp_path / "video4linux"
+    sysfs_path.joinpath("video0").mkdir(parents=True)
+    sysfs_path.joinpath("video0", "name").write_text("USB Camera\n")
+    sysfs_path.joinpath("v4l-subdev0").mkdir()
+    assert probe_video4linux_cameras(sysfs_path) == [dict(device_path="/dev/video0", device_name="USB Camera")]
+    assert probe_video4linux_cameras(tmp_path / "missing") == []
@@ -0,0 +1,109 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import collections
+import time
+from datetime import timedelta
+
+from wacomponents import disk_budget_governor
+from wacomponents.disk_budget_governor import DiskBudgetGovernor
+
+MiB = 1024**2
+
+
+class _FakeCryptainerStorage:
+    def __init__(self, cryptainer_sizes):
+        self.cryptainer_sizes = cryptainer_sizes  # Oldest first
+        self.deleted_cryptainer_names = []
+
+    def list_cryptainer_properties(self, with_size, with_age, finished):
+        return [
+            dict(name=name, size=size, age=timedelta(hours=len(self.cryptainer_sizes) - idx))
+            for (idx, (name, size)) in enumerate(self.cryptainer_sizes.items())
+            if name not in self.deleted_cryptainer_names
+        ]
+
+    def delete_cryptainer(self, cryptainer_name):
+        self.deleted_cryptainer_names.append(cryptainer_name)
+
+
+class _FakeSensor:
+    recording_quality_level = 0
+    max_recording_quality_level = 2
+
+    def __init__(self, sensor_name, byte_rate):
+        self.sensor_name = sensor_name
+        self.byte_rate = byte_rate
+        self.encrypted_byte_count = 0
+
+    def set_recording_quality_level(self, level):
+        self.recording_quality_level = min(level, self.max_recording_quality_level)
+        return self.recording_quality_level
+
+    def get_stream_statistics(self):
+        return dict(encrypted_byte_count=self.encrypted_byte_count)
+
+
+def test_disk_budget_governor(monkeypatch):
+    disk_state = dict(free=1000 * MiB)
+    monkeypatch.setattr(
+        disk_budget_governor.shutil,
+        "disk_usage",
+        lambda path: collections.namedtuple("usage", "total used free")(2000 * MiB, None, disk_state["free"]),
+    )
+
+    cryptainer_storage = _FakeCryptainerStorage(
+        {"old.crypt": 2000 * MiB, "mid.crypt": 300 * MiB, "new.crypt": 300 * MiB}
+    )
+    small_sensor = _FakeSensor("microphone", byte_rate=1 * MiB)
+    big_sensor = _FakeSensor("camera", byte_rate=10 * MiB)
+    governor = DiskBudgetGovernor(
+        cryptainer_storage,
+        sensors=[small_sensor, big_sensor],
+        disk_storage_path="/fake/cryptainers",
+        sampling_interval_s=0.01,
+        fill_rate_window_s=10,
+        degraded_quality_horizon_s=200,
+        early_purge_horizon_s=10,
+        min_free_space=100 * MiB,
+        quality_adaptation_interval_s=0,
+    )
+
+    def _record_and_govern(duration_s):
+        time.sleep(duration_s)
+        for sensor in (small_sensor, big_sensor):
+            sensor.encrypted_byte_count += int(sensor.byte_rate * duration_s)
+            disk_state["free"] -= int(sensor.byte_rate * duration_s)
+        governor._offloaded_run_task()
+        return governor.get_disk_budget_report()
+
+    disk_budget_report = _record_and_govern(0)
+    assert disk_budget_report["fill_rate"] is None  # Not enough samples yet
+    assert not disk_budget_report["last_decisions"]
+
+    # Time-to-full is about 900MiB / 11MiB/s, the biggest consumer gets degraded first
+    disk_budget_report = _record_and_govern(0.2)
+    assert 50 < disk_budget_report["time_to_full_s"] < 200
+    assert disk_budget_report["sensor_fill_rates"]["camera"] > disk_budget_report["sensor_fill_rates"]["microphone"]
+    assert disk_budget_report["recording_quality_levels"] == dict(microphone=0, camera=1)
+    assert "degrading recording quality of camera sensor" in disk_budget_report["last_decisions"][-1][1]
+
+    # Filling up much faster, so oldest cryptainers get purged, and quality gets further degraded
+    big_sensor.byte_rate = 400 * MiB
+    disk_budget_report = _record_and_govern(0.2)
+    assert disk_budget_report["time_to_full_s"] < 10
+    assert cryptainer_storage.deleted_cryptainer_names == ["old.crypt"]
+    assert disk_budget_report["purged_cryptainer_count"] == 1
+    assert disk_budget_report["purged_size"] == 2000 * MiB
+    decisions = [decision for (_timestamp, decision) in disk_budget_report["last_decisions"]]
+    assert any(decision.startswith("early purge of 1 oldest cryptainers") for decision in decisions)
+    assert disk_budget_report["recording_quality_levels"] == dict(microphone=0, camera=2)
+
+    # Recording stops filling the disk, so quality is restored step by step
+    small_sensor.byte_rate = big_sensor.byte_rate = 0
+    _record_and_govern(0.01)  # First sample after purge
+    disk_budget_report = _record_and_govern(0.01)
+    assert disk_budget_report["time_to_full_s"] is None
+    assert "restoring recording quality of camera sensor" in disk_budget_report["last_decisions"][-1][1]
+    assert big_sensor.recording_quality_level == 1
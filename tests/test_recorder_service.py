@@ -0,0 +1,49 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from configparser import ConfigParser
+
+from wacomponents.application.recorder_service import WaRecorderService
+
+
+class _FakeSensorsManager:
+    is_running = False
+
+
+class _FakeRecorderService(WaRecorderService):
+    def __init__(self):  # No OSC server
+        self.config = ConfigParser()
+        self.config.read_dict({"usersettings": {"ip_camera_url": "rtsp://a"}, "misc": {"debug": "0"}})
+        self.build_count = 0
+
+    def _build_recording_toolchain(self):
+        self.build_count += 1
+        return dict(sensors_manager=_FakeSensorsManager())
+
+
+def test_recorder_service_recording_toolchain_reuse():
+    service = _FakeRecorderService()
+
+    toolchain = service._recording_toolchain = service._get_up_to_date_recording_toolchain()
+    assert service._get_up_to_date_recording_toolchain() is toolchain
+    assert service.build_count == 1
+
+    service.config.set("usersettings", "ip_camera_url", "rtsp://b")
+    toolchain = service._recording_toolchain = service._get_up_to_date_recording_toolchain()
+    assert service.build_count == 2
+    assert service._get_up_to_date_recording_toolchain() is toolchain
+
+    # Inputs outside of config (e.g. imported keystores) are signaled explicitly
+    service.invalidate_recording_toolchain().result(timeout=10)
+    assert service._recording_toolchain is None
+    toolchain = service._recording_toolchain = service._get_up_to_date_recording_toolchain()
+    assert service.build_count == 3
+
+    # A running toolchain is left untouched, but rebuilt on next recording
+    toolchain["sensors_manager"].is_running = True
+    service.invalidate_recording_toolchain().result(timeout=10)
+    assert service._recording_toolchain is toolchain
+    toolchain["sensors_manager"].is_running = False
+    assert service._get_up_to_date_recording_toolchain() is not toolchain
+    assert service.build_count == 4
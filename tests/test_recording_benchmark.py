@@ -0,0 +1,37 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import json
+import shutil
+
+import pytest
+
+from wacomponents.recording_benchmark import run_recording_toolchain_benchmark
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is required")
+def test_recording_toolchain_benchmark(tmp_path):
+    benchmark_result = run_recording_toolchain_benchmark(
+        duration_s=5,
+        sensor_count=1,
+        recording_interval_s=2,
+        sensor_parameters=dict(video_resolution="320x240", video_bitrate="300k"),
+        use_free_keys_generator=False,
+        monitor_interval_s=0.5,
+        work_dir=tmp_path,
+    )
+    json.dumps(benchmark_result)  # Must be JSON-compatible
+
+    results = benchmark_result["results"]
+    assert results["recording_duration_s"] >= 5
+    assert results["sustained_throughput_mb_s"] > 0
+    assert results["stored_cryptainer_count"] >= 3  # Including tarfiles of monitoring samples
+    assert results["cryptainer_finalization_latency_s"]["count"] >= 2
+    assert not results["toolchain_stop_pending_operations"]
+
+    sensor_result = results["sensors"]["synthetic_stream_0"]
+    assert sensor_result["encrypted_byte_count"] > 0
+    assert sensor_result["subprocess_handoff_count"] >= 1
+    assert sensor_result["subprocess_resource_usage"]["max_rss"] > 0
+    assert results["recorder_resource_usage"]["cpu_time_s"] > 0
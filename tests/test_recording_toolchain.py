@@ -0,0 +1,122 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import time
+
+from wacryptolib.sensor import TaskRunnerStateMachineBase
+
+from wacomponents.recording_toolchain import ConcurrentSensorManager, start_recording_toolchain, stop_recording_toolchain
+
+
+class _SlowStartingSensor(TaskRunnerStateMachineBase):
+    def __init__(self, sensor_name, startup_delay_s, broken=False):
+        super().__init__()
+        self.sensor_name = sensor_name
+        self._startup_delay_s = startup_delay_s
+        self._broken = broken
+
+    def start(self):
+        time.sleep(self._startup_delay_s)
+        if self._broken:
+            raise RuntimeError("Camera not found")
+        super().start()
+
+
+def test_concurrent_sensor_manager_startup():
+    sensors = [
+        _SlowStartingSensor("camera", startup_delay_s=0.5),
+        _SlowStartingSensor("camera", startup_delay_s=0.5),
+        _SlowStartingSensor("microphone", startup_delay_s=0.1),
+        _SlowStartingSensor("gps", startup_delay_s=0.2, broken=True),
+    ]
+    sensors_manager = ConcurrentSensorManager(sensors)
+    toolchain = dict(sensors_manager=sensors_manager, free_keys_generator_worker=None)
+
+    startup_report = start_recording_toolchain(toolchain)
+    assert sensors_manager.is_running
+    assert startup_report["started_sensor_count"] == 3
+    assert startup_report["toolchain_startup_duration_s"] < 0.9  # Not sequential
+
+    sensor_startup_latencies = startup_report["sensor_startup_latencies"]
+    assert sorted(sensor_startup_latencies) == ["camera", "camera#1", "gps", "microphone"]
+    assert sensor_startup_latencies["gps"] is None
+    assert 0.1 <= sensor_startup_latencies["microphone"] < sensor_startup_latencies["camera"]
+
+    assert sensors_manager.stop() == 3  # Broken sensor can't be stopped
+    sensors_manager.join()
+
+
+class _SlowFlushingAggregator:
+    def __init__(self, sensor_name, flush_delay_s):
+        self.sensor_name = sensor_name
+        self._flush_delay_s = flush_delay_s
+        self.flushed = False
+        self.flush_start_time = self.flush_end_time = None
+
+    def flush_payload(self):
+        self.flush_start_time = time.monotonic()
+        time.sleep(self._flush_delay_s)
+        self.flush_end_time = time.monotonic()
+        self.flushed = True
+
+    def finalize_tarfile(self):
+        self.flush_payload()
+
+
+class _FakeCryptainerStorage:
+    def __init__(self):
+        self.idle_state_wait_time = None
+
+    def wait_for_idle_state(self):
+        self.idle_state_wait_time = time.monotonic()
+
+
+def test_stop_recording_toolchain_with_deadline():
+    def _build_toolchain(slowest_flush_delay_s):
+        return dict(
+            sensors_manager=ConcurrentSensorManager([]),
+            data_aggregators=[
+                _SlowFlushingAggregator("camera", flush_delay_s=0.4),
+                _SlowFlushingAggregator("microphone", flush_delay_s=slowest_flush_delay_s),
+                _SlowFlushingAggregator("gps", flush_delay_s=0.4),
+            ],
+            tarfile_aggregators=[_SlowFlushingAggregator(None, flush_delay_s=0.1)],
+            cryptainer_storage=_FakeCryptainerStorage(),
+            free_keys_generator_worker=None,
+        )
+
+    toolchain = _build_toolchain(slowest_flush_delay_s=0.4)
+    toolchain["pre_trigger_storage"] = _FakeCryptainerStorage()
+    toolchain["sensors_manager"].start()
+    stop_report = stop_recording_toolchain(toolchain, deadline_s=5)
+    assert stop_report["pending_operations"] == []
+    assert stop_report["toolchain_stop_duration_s"] < 1  # Not sequential
+    assert stop_report["phase_durations_s"]["flush_data_aggregators"] >= 0.4
+    assert all(aggregator.flushed for aggregator in toolchain["data_aggregators"] + toolchain["tarfile_aggregators"])
+    assert toolchain["cryptainer_storage"].idle_state_wait_time >= toolchain["tarfile_aggregators"][0].flush_end_time
+    assert toolchain["pre_trigger_storage"].idle_state_wait_time  # Pending cryptainers got persisted
+    assert "persist_pre_trigger_cryptainers" in stop_report["phase_durations_s"]
+
+    toolchain = _build_toolchain(slowest_flush_delay_s=2)
+    toolchain["sensors_manager"].start()
+    stop_report = stop_recording_toolchain(toolchain, deadline_s=1)
+    # Next phases wait for the slow aggregator, in background
+    assert stop_report["pending_operations"] == [
+        "data aggregator 'microphone'",
+        "tarfile aggregator #1",
+        "cryptainer encryption jobs",
+    ]
+    assert 1 <= stop_report["toolchain_stop_duration_s"] < 1.5
+    slow_data_aggregator = toolchain["data_aggregators"][1]
+    tarfile_aggregator = toolchain["tarfile_aggregators"][0]
+    assert not slow_data_aggregator.flushed
+    assert tarfile_aggregator.flush_start_time is None
+
+    for _ in range(50):
+        if toolchain["cryptainer_storage"].idle_state_wait_time:
+            break
+        time.sleep(0.1)
+    assert tarfile_aggregator.flush_start_time >= slow_data_aggregator.flush_end_time
+    assert toolchain["cryptainer_storage"].idle_state_wait_time >= tarfile_aggregator.flush_end_time
+
@@ -0,0 +1,71 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+
+from wacomponents.sensors.camera._camera_base import LatestWinsTaskWorker, ActivityNotificationBus
+
+
+def test_latest_wins_task_worker():
+    worker = LatestWinsTaskWorker(name="test_worker")
+    first_task_started = threading.Event()
+    first_task_release = threading.Event()
+    all_done = threading.Event()
+    calls = []
+
+    def _first_task():
+        calls.append("first")
+        first_task_started.set()
+        first_task_release.wait(timeout=10)
+
+    worker.submit(_first_task)
+    assert first_task_started.wait(timeout=10)
+
+    # While first task runs, only the latest pending task survives
+    worker.submit(lambda: calls.append("second"))
+    worker.submit(lambda: calls.append("third"))
+    worker.submit(lambda: (calls.append("fourth"), all_done.set()))
+    assert worker.superseded_task_count == 2
+
+    first_task_release.set()
+    assert all_done.wait(timeout=10)
+    assert calls == ["first", "fourth"]
+
+    # Failing tasks don't kill the worker
+    failing_task_started = threading.Event()
+    last_task_done = threading.Event()
+
+    def _failing_task():
+        failing_task_started.set()
+        raise ZeroDivisionError()
+
+    worker.submit(_failing_task)
+    assert failing_task_started.wait(timeout=10)
+    worker.submit(lambda: (calls.append("fifth"), last_task_done.set()))
+    assert last_task_done.wait(timeout=10)
+    assert calls[-1] == "fifth"
+    assert worker.superseded_task_count == 2
+
+
+def test_activity_notification_bus():
+    bus = ActivityNotificationBus(dispatch_interval_s=0.2)
+    notifications = []
+    bus.register_recording_progress_source("camera", callback=lambda: notifications.append("camera"))
+    bus.register_recording_progress_source("microphone", callback=lambda: notifications.append("microphone"))
+
+    bus.start()
+    for _ in range(1000):
+        bus.post_recording_progress("camera", 1024)
+    bus.post_recording_progress("microphone", 10)
+    time.sleep(0.5)
+    assert sorted(notifications) == ["camera", "microphone"]  # Coalesced
+    assert bus.posted_update_count == 1001
+
+    bus.post_recording_progress("camera", 1024)
+    bus.post_recording_progress("unknown", 1024)  # Ignored
+    bus.stop()
+    bus.join()
+    assert notifications[2:] == ["camera"]  # Delivered on join
+    assert bus.dispatched_notification_count == 3
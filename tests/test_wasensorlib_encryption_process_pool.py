@@ -0,0 +1,120 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import random
+import time
+
+import pytest
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+from wacryptolib.keygen import generate_symkey
+
+from wacomponents.sensors.camera._camera_base import OffloadableCryptainerEncryptionPipeline
+from wacomponents.sensors.camera._encryption_process_pool import EncryptionProcessPool, _ENCRYPT_COMMAND
+
+SIMPLE_CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        ),
+        dict(
+            payload_cipher_algo="CHACHA20_POLY1305",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        ),
+    ]
+)
+
+
+def test_encryption_process_pool(tmp_path):
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=SIMPLE_CRYPTOCONF)
+    encryption_process_pool = EncryptionProcessPool(process_count=2, max_buffers_per_process=2)
+    encryption_process_pool.start()
+
+    try:
+        payloads = {}
+        encryption_streams = {}
+        for idx in range(3):  # More streams than worker processes
+            filename_base = "stream%d.mp4" % idx
+            encryption_streams[filename_base] = cryptainer_storage.create_cryptainer_encryption_stream(
+                filename_base,
+                cryptainer_metadata=None,
+                cryptainer_encryption_stream_class=OffloadableCryptainerEncryptionPipeline,
+                cryptainer_encryption_stream_extra_kwargs=dict(encryption_process_pool=encryption_process_pool),
+            )
+            payloads[filename_base] = b""
+
+        for _ in range(20):  # Interleaved chunks of varying sizes, some exceeding initial buffers
+            filename_base = random.choice(list(encryption_streams))
+            chunk = os.urandom(random.choice([10, 1000, 300 * 1024, 1024**2 + 1]))
+            encryption_streams[filename_base].encrypt_chunk(memoryview(chunk))
+            payloads[filename_base] += chunk
+
+        for encryption_stream in encryption_streams.values():
+            encryption_stream.finalize()
+
+    finally:
+        encryption_process_pool.stop()
+
+    for filename_base, payload in payloads.items():
+        result_payload, _ = cryptainer_storage.decrypt_cryptainer_from_storage(filename_base + ".crypt")
+        assert result_payload == payload
+
+
+def test_encryption_process_pool_failures(tmp_path):
+    payload_cipher_layer_extracts = [
+        dict(cipher_algo="AES_CBC", symkey=generate_symkey(cipher_algo="AES_CBC"), payload_digest_algos=[])
+    ]
+    encryption_process_pool = EncryptionProcessPool(process_count=1, max_buffers_per_process=1)
+    encryption_process_pool.WORKER_LIVENESS_CHECK_INTERVAL_S = 0.1
+    encryption_process_pool.start()
+
+    try:
+        # A chunk buffer that the worker can't attach makes the stream fail, instead of silently losing data
+        payload_pipeline = encryption_process_pool.create_payload_encryption_pipeline(
+            tmp_path / "missing_buffer.payload", payload_cipher_layer_extracts
+        )
+        payload_pipeline.encrypt_chunk(b"abc")
+        payload_pipeline._channel.command_queue.put(
+            (_ENCRYPT_COMMAND, payload_pipeline._stream_id, "nonexistent_buffer", 10)
+        )
+        payload_pipeline.encrypt_chunk(b"def")
+        with pytest.raises(RuntimeError, match="FileNotFoundError"):
+            payload_pipeline.finalize()
+
+        # Other streams are unaffected
+        payload_pipeline = encryption_process_pool.create_payload_encryption_pipeline(
+            tmp_path / "working.payload", payload_cipher_layer_extracts
+        )
+        payload_pipeline.encrypt_chunk(b"abc")
+        payload_pipeline.finalize()
+        assert payload_pipeline.get_payload_integrity_tags()
+
+        # Writers waiting for a buffer don't hang forever if the worker died
+        payload_pipeline = encryption_process_pool.create_payload_encryption_pipeline(
+            tmp_path / "dead_worker.payload", payload_cipher_layer_extracts
+        )
+        payload_pipeline._channel.process.kill()
+        payload_pipeline._channel.process.join()
+        with pytest.raises(RuntimeError, match="is dead"):
+            for _ in range(2):  # Single buffer is never released
+                payload_pipeline.encrypt_chunk(b"abc")
+
+        # Finalization fails fast too, and dead worker gets replaced for next streams
+        start_time = time.monotonic()
+        with pytest.raises(RuntimeError, match="is dead"):
+            payload_pipeline.finalize()
+        assert time.monotonic() - start_time < 5
+        payload_pipeline = encryption_process_pool.create_payload_encryption_pipeline(
+            tmp_path / "respawned_worker.payload", payload_cipher_layer_extracts
+        )
+        assert payload_pipeline._channel.process.is_alive()
+        payload_pipeline.encrypt_chunk(b"abc")
+        payload_pipeline.finalize()
+        assert payload_pipeline.get_payload_integrity_tags()
+
+    finally:
+        encryption_process_pool.stop()
@@ -0,0 +1,99 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import sys
+
+import pytest
+
+from wacomponents.sensors.camera import ffmpeg_capabilities
+from wacomponents.sensors.camera.ffmpeg_capabilities import (
+    get_ffmpeg_capabilities,
+    parse_ffmpeg_version,
+    parse_ffmpeg_muxers,
+    parse_ffmpeg_codecs,
+    parse_ffmpeg_protocols,
+    parse_ffmpeg_avoptions,
+)
+
+FAKE_FFMPEG_SCRIPT = '''\
+#!{python}
+import sys
+with open({calls_log!r}, "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+args = sys.argv[1:]
+if "-version" in args:
+    print("ffmpeg version n4.4.2-0ubuntu0.22.04.1 Copyright (c) 2000-2021 the FFmpeg developers")
+elif "-muxers" in args:
+    print("File formats:\\n D. = Demuxing supported\\n .E = Muxing supported\\n --\\n  E ismv            ISMV/ISMA\\n  E mpegts          MPEG-TS")
+elif "-codecs" in args:
+    print("Codecs:\\n D..... = Decoding supported\\n -------\\n DEV.LS h264                 H.264")
+elif "-protocols" in args:
+    print("Supported file protocols:\\nInput:\\n  file\\n  rtsp\\nOutput:\\n  file\\n  pipe")
+elif "-h" in args:
+    print("RTSP demuxer AVOptions:\\n  -rtsp_flags        <flags>      .D......... set RTSP flags\\n"
+          "     prefer_tcp                   ED......... try RTP via TCP first\\n"
+          "  -stimeout         <int64>      .D......... set socket TCP I/O timeout")
+'''
+
+
+def test_ffmpeg_output_parsers():
+    assert parse_ffmpeg_version("ffmpeg version n5.1.2 Copyright") == 5.1
+    assert parse_ffmpeg_version("ffmpeg version 4.3.6-0+deb11u1+rpt2 Copyright") == 4.3
+    assert parse_ffmpeg_version("whatever") is None
+
+    muxers_output = " Formats:\n D.. = Demuxing supported\n ---\n  E  3g2             3GP2\n  E  mp4             MP4\n"
+    assert parse_ffmpeg_muxers(muxers_output) == ["3g2", "mp4"]
+
+    codecs_output = "Codecs:\n D..... = Decoding supported\n -------\n D.VI.S 012v   Uncompressed\n DEV.LS h264   H.264\n"
+    assert parse_ffmpeg_codecs(codecs_output) == {"012v": "D.VI.S", "h264": "DEV.LS"}
+
+    protocols_output = "Supported file protocols:\nInput:\n  async\n  rtsp\nOutput:\n  file\n"
+    assert parse_ffmpeg_protocols(protocols_output) == {"input": ["async", "rtsp"], "output": ["file"]}
+
+    options_output = "RTSP demuxer AVOptions:\n  -timeout   <int64>  .D... set timeout\n     udp    ED... UDP\n"
+    assert parse_ffmpeg_avoptions(options_output) == ["timeout"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Fake ffmpeg script requires a shebang")
+def test_get_ffmpeg_capabilities_caching(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls_log = tmp_path / "calls.log"
+    fake_ffmpeg = bin_dir / "ffmpeg"
+    fake_ffmpeg.write_text(FAKE_FFMPEG_SCRIPT.format(python=sys.executable, calls_log=str(calls_log)))
+    fake_ffmpeg.chmod(0o755)
+    cache_file = tmp_path / "ffmpeg_capabilities.json"
+
+    monkeypatch.setenv("PATH", str(bin_dir), prepend=os.pathsep)
+    monkeypatch.setattr(ffmpeg_capabilities, "_ffmpeg_capabilities_memory_cache", {})
+
+    def _get_call_count():
+        return len(calls_log.read_text().splitlines()) if calls_log.exists() else 0
+
+    capabilities = get_ffmpeg_capabilities(cache_file=cache_file)
+    assert capabilities["version"] == 4.4
+    assert capabilities["muxers"] == ["ismv", "mpegts"]
+    assert capabilities["codecs"] == {"h264": "DEV.LS"}
+    assert capabilities["protocols"] == {"input": ["file", "rtsp"], "output": ["file", "pipe"]}
+    assert capabilities["rtsp_demuxer_options"] == ["rtsp_flags", "stimeout"]
+    assert cache_file.exists()
+    assert _get_call_count() == 5
+
+    # Memory cache
+    assert get_ffmpeg_capabilities(cache_file=cache_file) == capabilities
+    assert _get_call_count() == 5
+
+    # Disk cache, e.g. after a restart of the service
+    monkeypatch.setattr(ffmpeg_capabilities, "_ffmpeg_capabilities_memory_cache", {})
+    assert get_ffmpeg_capabilities(cache_file=cache_file) == capabilities
+    assert _get_call_count() == 5
+
+    # Upgraded binary gets probed again
+    stat = fake_ffmpeg.stat()
+    os.utime(fake_ffmpeg, (stat.st_atime, stat.st_mtime + 10))
+    assert get_ffmpeg_capabilities(cache_file=cache_file) == capabilities
+    assert _get_call_count() == 10
+
+    assert get_ffmpeg_capabilities("unexisting-ffmpeg-binary", cache_file=cache_file) is None
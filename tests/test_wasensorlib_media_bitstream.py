@@ -0,0 +1,77 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from wacomponents.sensors.camera._media_bitstream import (
+    MPEGTS_PACKET_SIZE,
+    find_mpegts_video_random_access_offset,
+    get_first_mpegts_packet_offset,
+    is_mpegts_video_random_access_packet,
+)
+
+
+def _build_mpegts_packet(
+    payload_unit_start=True, adaptation_field=True, random_access=True, pes_stream_id=0xE0, adaptation_length=1
+):
+    header = bytearray(b"\x47\x00\x00\x10")
+    if payload_unit_start:
+        header[1] |= 0x40
+    packet = bytes(header)
+    if adaptation_field:
+        header[3] = 0x30  # Adaptation field followed by payload
+        adaptation = bytes([0x40 if random_access else 0x00]).ljust(adaptation_length, b"\xff")
+        packet = bytes(header) + bytes([adaptation_length]) + adaptation
+    packet += b"\x00\x00\x01" + bytes([pes_stream_id])
+    return packet.ljust(MPEGTS_PACKET_SIZE, b"\xff")
+
+
+KEYFRAME_PACKET = _build_mpegts_packet()
+PLAIN_PACKET = _build_mpegts_packet(payload_unit_start=False, adaptation_field=False)
+
+
+def test_get_first_mpegts_packet_offset():
+    assert get_first_mpegts_packet_offset(1000, stream_offset=0) == 0
+    assert get_first_mpegts_packet_offset(1000, stream_offset=MPEGTS_PACKET_SIZE * 3) == 0
+    assert get_first_mpegts_packet_offset(1000, stream_offset=10) == MPEGTS_PACKET_SIZE - 10
+    assert get_first_mpegts_packet_offset(MPEGTS_PACKET_SIZE - 10, stream_offset=10) is None
+    assert get_first_mpegts_packet_offset(0, stream_offset=0) is None
+
+
+def test_is_mpegts_video_random_access_packet():
+    assert is_mpegts_video_random_access_packet(KEYFRAME_PACKET, 0)
+    assert is_mpegts_video_random_access_packet(b"junk" + KEYFRAME_PACKET, 4)
+    assert is_mpegts_video_random_access_packet(memoryview(KEYFRAME_PACKET), 0)
+    assert is_mpegts_video_random_access_packet(_build_mpegts_packet(adaptation_length=7), 0)  # With PCR etc.
+
+    assert not is_mpegts_video_random_access_packet(KEYFRAME_PACKET[:-1], 0)  # Truncated packet
+    assert not is_mpegts_video_random_access_packet(b"\x00" + KEYFRAME_PACKET[1:], 0)  # No sync byte
+    assert not is_mpegts_video_random_access_packet(PLAIN_PACKET, 0)
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(payload_unit_start=False), 0)
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(adaptation_field=False), 0)
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(random_access=False), 0)
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(adaptation_length=0), 0)
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(pes_stream_id=0xC0), 0)  # Audio PES
+    assert not is_mpegts_video_random_access_packet(_build_mpegts_packet(pes_stream_id=0xBD), 0)  # Private PES
+
+
+def test_find_mpegts_video_random_access_offset():
+    audio_keyframe_packet = _build_mpegts_packet(pes_stream_id=0xC0)
+    stream = PLAIN_PACKET + audio_keyframe_packet + PLAIN_PACKET + KEYFRAME_PACKET + PLAIN_PACKET
+    keyframe_offset = 3 * MPEGTS_PACKET_SIZE
+
+    assert find_mpegts_video_random_access_offset(stream, stream_offset=0) == keyframe_offset
+    assert find_mpegts_video_random_access_offset(memoryview(stream), stream_offset=0) == keyframe_offset
+    assert find_mpegts_video_random_access_offset(stream[:keyframe_offset], stream_offset=0) is None
+    assert find_mpegts_video_random_access_offset(stream[: keyframe_offset + 100], stream_offset=0) is None
+
+    # Chunks misaligned on packets, whose stream offset tells where packets start
+    for cut in (1, 100, MPEGTS_PACKET_SIZE + 50):
+        chunk = stream[cut:]
+        assert find_mpegts_video_random_access_offset(chunk, stream_offset=cut) == keyframe_offset - cut
+    chunk = stream[keyframe_offset + 1 :]  # Keyframe packet is incomplete in this chunk
+    assert find_mpegts_video_random_access_offset(chunk, stream_offset=keyframe_offset + 1) is None
+
+    # A wrong stream offset means a loss of sync, so nothing is returned
+    assert find_mpegts_video_random_access_offset(stream[1:], stream_offset=0) is None
+    corrupted_stream = PLAIN_PACKET + b"\x00" * MPEGTS_PACKET_SIZE + KEYFRAME_PACKET
+    assert find_mpegts_video_random_access_offset(corrupted_stream, stream_offset=0) is None
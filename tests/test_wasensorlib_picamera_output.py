@@ -0,0 +1,115 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+
+from wacomponents.sensors.camera.raspberrypi_camera_microphone import (
+    RaspberryPicameraSensor,
+    _ThreadedCoalescingPicameraOutput,
+)
+
+
+class _FakeEncryptionStream:
+    def __init__(self):
+        self.encryption_allowed = threading.Event()
+        self.encryption_started = threading.Event()
+        self.chunks = []
+        self.finalized = False
+
+    def encrypt_chunk(self, chunk):
+        self.encryption_started.set()
+        assert self.encryption_allowed.wait(timeout=10)
+        self.chunks.append(bytes(chunk))
+
+    def finalize(self):
+        self.finalized = True
+
+
+class _SmallThreadedCoalescingPicameraOutput(_ThreadedCoalescingPicameraOutput):
+    COALESCED_BLOCK_SIZE = 10
+    MAX_PENDING_BLOCK_SIZE = 40
+    MAX_QUEUED_BLOCKS = 2
+    MAX_BLOCKING_S = 0.2
+
+
+def test_threaded_coalescing_picamera_output():
+    encryption_stream = _FakeEncryptionStream()
+    statistics = {}
+    output = _SmallThreadedCoalescingPicameraOutput(encryption_stream, statistics=statistics)
+    assert statistics == dict(blocked_duration_s=0, dropped_byte_count=0, dropped_block_count=0, max_queue_depth=0)
+
+    # Small writes are coalesced, then the encryption thread gets stuck on the first block
+    for _ in range(5):
+        output.write(b"aa")
+    assert encryption_stream.encryption_started.wait(timeout=10)
+    assert output.queue_depth == 0
+
+    output.write(b"b" * 10)
+    output.write(b"c" * 10)
+    assert output.queue_depth == 2
+    assert statistics["max_queue_depth"] == 2
+
+    # Queue is full, so data is kept in memory without blocking the writer
+    for _ in range(3):
+        output.write(b"d" * 10)
+    assert statistics["blocked_duration_s"] == 0
+    assert statistics["dropped_block_count"] == 0
+
+    # Pending block is too big, so the writer blocks for a while, then drops it
+    output.write(b"d" * 10)
+    assert 0.15 < statistics["blocked_duration_s"] < 5
+    assert statistics["dropped_byte_count"] == 40
+    assert statistics["dropped_block_count"] == 1
+
+    output.write(b"e" * 3)
+    assert not encryption_stream.finalized
+    encryption_stream.encryption_allowed.set()
+    output.flush()  # Short remaining block is enqueued too
+    assert output.join(timeout=10)
+    assert encryption_stream.chunks == [b"a" * 10, b"b" * 10, b"c" * 10, b"e" * 3]
+    assert encryption_stream.finalized
+
+    # Counters are shared by successive outputs
+    next_encryption_stream = _FakeEncryptionStream()
+    next_encryption_stream.encryption_allowed.set()
+    next_output = _SmallThreadedCoalescingPicameraOutput(next_encryption_stream, statistics=statistics)
+    next_output.write(b"f" * 25)
+    next_output.flush()
+    assert next_output.join(timeout=10)
+    assert next_encryption_stream.chunks == [b"f" * 25]
+    assert next_encryption_stream.finalized
+    assert statistics["dropped_byte_count"] == 40
+
+
+class _FakePicamera:
+    def __init__(self, sensor_lock):
+        self._sensor_lock = sensor_lock
+        self.captures = []
+
+    def capture(self, output, **kwargs):
+        assert self._sensor_lock.locked()  # Captures must not overlap with live previews or camera closing
+        self.captures.append(output)
+
+
+def test_picamera_sensor_preview_image_generation_when_stopped():
+    sensor = RaspberryPicameraSensor(
+        picamera_parameters=None,
+        live_preview_interval_s=None,
+        local_camera_rotation=0,
+        preview_image_path=None,
+        cryptainer_storage=None,
+        activity_notification_callback=None,
+        interval_s=10,
+    )
+    fake_picamera = _FakePicamera(sensor._lock)
+
+    # Worker thread might run after the camera was closed, or even after it was reopened
+    sensor._do_generate_preview_image("preview.jpg", width_px=10, height_px=10)
+    sensor._picamera = fake_picamera
+    sensor._do_generate_preview_image("preview.jpg", width_px=10, height_px=10)
+    assert fake_picamera.captures == []  # Sensor is not running
+
+    sensor._runner_is_started = True  # Without launching the camera
+    sensor._do_generate_preview_image("preview.jpg", width_px=10, height_px=10)
+    assert fake_picamera.captures == ["preview.jpg"]
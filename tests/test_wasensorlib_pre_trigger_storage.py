@@ -0,0 +1,86 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera._pre_trigger_storage import PreTriggerCryptainerStorage
+
+CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+def test_pre_trigger_cryptainer_storage(tmp_path):
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=CRYPTOCONF)
+    current_timestamp = [100.0]
+    pre_trigger_storage = PreTriggerCryptainerStorage(
+        cryptainer_storage, pre_trigger_duration_s=0.5, post_trigger_duration_s=0.5, clock=lambda: current_timestamp[0]
+    )
+
+    def _create_stream(name):  # Slow, because of key generation
+        cryptainer_encryption_stream = pre_trigger_storage.create_cryptainer_encryption_stream(
+            name, cryptainer_metadata=None
+        )
+        cryptainer_encryption_stream.encrypt_chunk(b"abc")
+        cryptainer_encryption_stream.encrypt_chunk(name.encode("ascii"))
+        return cryptainer_encryption_stream
+
+    streams_before = [_create_stream("before%d" % idx) for idx in range(5)]
+    streams_after = [_create_stream("after%d" % idx) for idx in range(2)]  # Started at 100.0 too
+
+    for cryptainer_encryption_stream in streams_before:
+        current_timestamp[0] += 0.2
+        cryptainer_encryption_stream.finalize()  # Ends at 100.2, 100.4... 101.0
+    pre_trigger_storage.wait_for_idle_state()
+    assert not list(tmp_path.iterdir())  # Nothing written to disk
+
+    statistics = pre_trigger_storage.get_pre_trigger_statistics()
+    assert statistics["buffered_segment_count"] == 3  # Those which ended in the last 0.5s
+    assert statistics["discarded_segment_count"] == 2
+
+    pre_trigger_storage.trigger(trigger_timestamp=101.0)
+    current_timestamp[0] = 101.6
+    stream_too_late = _create_stream("too_late")  # Started after the post-trigger window
+    for cryptainer_encryption_stream in streams_after + [stream_too_late]:
+        cryptainer_encryption_stream.finalize()
+    pre_trigger_storage.wait_for_idle_state()
+
+    statistics = pre_trigger_storage.get_pre_trigger_statistics()
+    assert statistics["trigger_count"] == 1
+    assert statistics["persisted_segment_count"] == 3 + 2
+    assert statistics["buffered_segment_count"] == 1
+
+    cryptainer_names = cryptainer_storage.list_cryptainer_names(as_sorted_list=True)
+    assert [str(cryptainer_name) for cryptainer_name in cryptainer_names] == [
+        "after0.crypt",
+        "after1.crypt",
+        "before2.crypt",
+        "before3.crypt",
+        "before4.crypt",
+    ]
+    payload, _error_report = cryptainer_storage.decrypt_cryptainer_from_storage("before3.crypt")
+    assert payload == b"abcbefore3"
+
+    # Persisted cryptainers are subject to the purge limits of the underlying storage
+    limited_cryptainer_dir = tmp_path / "limited"
+    limited_cryptainer_dir.mkdir()
+    limited_cryptainer_storage = CryptainerStorage(
+        limited_cryptainer_dir, default_cryptoconf=CRYPTOCONF, max_cryptainer_count=2
+    )
+    pre_trigger_storage = PreTriggerCryptainerStorage(
+        limited_cryptainer_storage, pre_trigger_duration_s=10, post_trigger_duration_s=0, clock=lambda: 100.0
+    )
+    for idx in range(4):
+        pre_trigger_storage.create_cryptainer_encryption_stream("burst%d" % idx, cryptainer_metadata=None).finalize()
+    pre_trigger_storage.trigger()
+    pre_trigger_storage.wait_for_idle_state()
+    assert pre_trigger_storage.get_pre_trigger_statistics()["persisted_segment_count"] == 4
+    cryptainer_names = limited_cryptainer_storage.list_cryptainer_names(as_sorted_list=True)
+    assert [str(cryptainer_name) for cryptainer_name in cryptainer_names] == ["burst2.crypt", "burst3.crypt"]
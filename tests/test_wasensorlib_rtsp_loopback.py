@@ -0,0 +1,117 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import shutil
+import time
+
+import pytest
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera._media_bitstream import MPEGTS_PACKET_SIZE
+from wacomponents.sensors.camera.loopback_rtsp_server import (
+    LoopbackRtspServer,
+    packetize_h264_nal_unit,
+    split_h264_annexb_nal_units,
+)
+from wacomponents.sensors.camera.rtsp_stream import RtspCameraSensor
+
+CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+@pytest.fixture
+def loopback_rtsp_server():
+    if not shutil.which("ffmpeg"):
+        pytest.skip("ffmpeg is required")
+    server = LoopbackRtspServer(video_resolution="320x240", video_bitrate="300k", keyframe_interval_s=0.5)
+    server.start()
+    yield server
+    server.stop()
+
+
+def _wait_for(predicate, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_h264_bitstream_helpers():
+    buffer = bytearray(b"\x00\x00\x00\x01\x09\xf0\x00\x00\x01\x67abc\x00\x00\x01\x68de\x00\x00\x01\x65")
+    assert split_h264_annexb_nal_units(buffer) == [b"\x09\xf0", b"\x67abc", b"\x68de"]
+    assert buffer == b"\x00\x00\x01\x65"  # Last NAL unit may still be incomplete
+
+    assert packetize_h264_nal_unit(b"\x65" + b"x" * 100) == [b"\x65" + b"x" * 100]
+    payloads = packetize_h264_nal_unit(b"\x65" + b"x" * 3000)
+    assert len(payloads) == 3
+    assert [payload[:2] for payload in payloads] == [b"\x7c\x85", b"\x7c\x05", b"\x7c\x45"]  # FU-A start/end bits
+    assert sum(len(payload) - 2 for payload in payloads) == 3000
+
+
+def test_rtsp_camera_sensor_with_loopback_server(tmp_path, loopback_rtsp_server):
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=CRYPTOCONF)
+    sensor = RtspCameraSensor(
+        video_stream_url=loopback_rtsp_server.url,
+        ffmpeg_rtsp_parameters=None,
+        ffmpeg_rtsp_output_format="mpegts",
+        gapless_rotation=True,
+        preview_image_path=None,
+        stall_watchdog_min_byte_rate=1000,
+        stall_watchdog_window_s=2,
+        interval_s=2,
+        cryptainer_storage=cryptainer_storage,
+        activity_notification_callback=lambda **kwargs: None,
+    )
+    loopback_rtsp_server.jitter_s = 0.1
+    loopback_rtsp_server.packet_loss_ratio = 0.001
+    sensor.start()
+    try:
+        assert _wait_for(lambda: sensor.get_stream_statistics()["received_byte_count"], timeout_s=10)
+        time.sleep(3)
+
+        # Camera is frozen longer than the stall watchdog window, so ffmpeg gets restarted
+        loopback_rtsp_server.freeze(3)
+        assert _wait_for(lambda: sensor.get_stream_statistics()["stall_count"] >= 1, timeout_s=10)
+        assert _wait_for(lambda: loopback_rtsp_server.get_server_statistics()["client_connection_count"] >= 2, 10)
+
+        # Camera drops the connection, so ffmpeg ends, and next rotation (or the stall watchdog) reconnects
+        client_connection_count = loopback_rtsp_server.get_server_statistics()["client_connection_count"]
+        disconnection_time = time.monotonic()
+        loopback_rtsp_server.disconnect_clients()
+        assert _wait_for(
+            lambda: loopback_rtsp_server.get_server_statistics()["client_connection_count"] > client_connection_count,
+            timeout_s=10,
+        )
+        reconnection_latency_s = time.monotonic() - disconnection_time
+        assert reconnection_latency_s < 10
+        received_byte_count = sensor.get_stream_statistics()["received_byte_count"]
+        assert _wait_for(
+            lambda: sensor.get_stream_statistics()["received_byte_count"] > received_byte_count, timeout_s=10
+        )
+    finally:
+        sensor.stop()
+        sensor.join()
+    cryptainer_storage.wait_for_idle_state()
+
+    server_statistics = loopback_rtsp_server.get_server_statistics()
+    assert server_statistics["frozen_frame_count"] > 0
+    assert server_statistics["disconnected_client_count"] >= 1
+
+    payloads = [
+        cryptainer_storage.decrypt_cryptainer_from_storage(cryptainer_name)[0]
+        for cryptainer_name in cryptainer_storage.list_cryptainer_names(as_sorted_list=True)
+    ]
+    non_empty_payloads = [payload for payload in payloads if payload]
+    assert len(non_empty_payloads) >= 3
+    for payload in non_empty_payloads:
+        assert payload[0] == 0x47 and len(payload) % MPEGTS_PACKET_SIZE == 0  # Whole MPEGTS packets
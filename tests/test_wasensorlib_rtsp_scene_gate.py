@@ -0,0 +1,104 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import time
+from pathlib import Path
+
+import pytest
+
+from wacomponents.sensors.camera.rtsp_stream import RtspCameraSensor
+
+
+class _FakeEncryptionStream:
+    _cryptainer_filepath = Path("fake_cryptainer.mpegts.crypt")
+
+    def __init__(self):
+        self.payload = io.BytesIO()
+        self.finalized = False
+
+    def encrypt_chunk(self, chunk):
+        self.payload.write(chunk)
+
+    def finalize(self):
+        self.finalized = True
+
+
+class _FakeCryptainerStorage:
+    def __init__(self):
+        self.deleted_cryptainer_names = []
+
+    def delete_cryptainer(self, cryptainer_name):
+        self.deleted_cryptainer_names.append(cryptainer_name)
+
+
+def test_rtsp_camera_sensor_scene_activity_gate():
+    def _build_sensor(inactive_segment_policy, scene_gate_max_held_size=None):
+        sensor = RtspCameraSensor(
+            video_stream_url="rtsp://localhost/stream",
+            ffmpeg_rtsp_parameters=None,
+            ffmpeg_rtsp_output_format=None,
+            gapless_rotation=True,
+            scene_activity_threshold=0.1,
+            inactive_segment_policy=inactive_segment_policy,
+            scene_gate_max_held_size=scene_gate_max_held_size,
+            interval_s=60,
+            cryptainer_storage=_FakeCryptainerStorage(),
+            preview_image_path=None,
+            activity_notification_callback=lambda **kwargs: None,
+        )
+        sensor.INACTIVE_SEGMENT_SAMPLE_SIZE = 200
+        command_line = sensor._build_subprocess_command_line()
+        assert command_line[-3:] == ["-f", "null", "-"]  # Scene analysis output
+        return sensor
+
+    def _record_segment(sensor, scene_scores):
+        encryption_stream = _FakeEncryptionStream()
+        for scene_score in scene_scores:
+            sensor._encrypt_subprocess_chunk(memoryview(b"x" * 188), encryption_stream)
+            if scene_score is not None:
+                sensor._register_scene_score(scene_score)
+        sensor._finalize_cryptainer_encryption_stream(encryption_stream)
+        assert encryption_stream.finalized
+        return encryption_stream.payload.getvalue()
+
+    sensor = _build_sensor(inactive_segment_policy="sample")
+    assert _record_segment(sensor, [None, 0.01, None, 0.02, None]) == b"x" * 188  # Whole mpegts packets
+    assert _record_segment(sensor, [None, None]) == b"x" * 376  # No analysis result, so fail-open
+    time.sleep(0.01)
+    assert _record_segment(sensor, [None, 0.5, None, 0.01]) == b"x" * 188 * 4
+    stream_statistics = sensor.get_stream_statistics()
+    assert stream_statistics["scene_gate_active_segment_count"] == 2
+    assert stream_statistics["scene_gate_inactive_segment_count"] == 1
+    assert stream_statistics["scene_gate_saved_byte_count"] == 188 * 4
+    assert stream_statistics["last_scene_score"] == 0.01
+
+    sensor = _build_sensor(inactive_segment_policy="drop")
+    assert _record_segment(sensor, [0.01, None, None]) == b""
+    assert sensor.get_stream_statistics()["scene_gate_saved_byte_count"] == 188 * 3
+    assert sensor._cryptainer_storage.deleted_cryptainer_names == ["fake_cryptainer.mpegts.crypt"]  # Empty segment
+
+    # Cleartext held in memory is bounded, beyond that segment is recorded anyway
+    sensor = _build_sensor(inactive_segment_policy="drop", scene_gate_max_held_size=400)
+    assert _record_segment(sensor, [0.01, None, None, None]) == b"x" * 188 * 4
+    assert sensor.get_stream_statistics()["scene_gate_active_segment_count"] == 1
+
+    # Garbled scene scores are ignored
+    sensor._consume_subprocess_stderr(io.BytesIO(b"lavfi.scene_score=0.3\nlavfi.scene_score=0.0[h264 @ 0x1]\n"))
+    assert sensor.get_stream_statistics()["last_scene_score"] == 0.3
+
+    # Only mpegts segments can be truncated to a sample
+    sensor_kwargs = dict(
+        video_stream_url="rtsp://localhost/stream",
+        ffmpeg_rtsp_parameters=None,
+        ffmpeg_rtsp_output_format=None,
+        scene_activity_threshold=0.1,
+        interval_s=60,
+        cryptainer_storage=None,
+        preview_image_path=None,
+        activity_notification_callback=lambda **kwargs: None,
+    )
+    assert RtspCameraSensor(**sensor_kwargs)._inactive_segment_policy == "drop"
+    with pytest.raises(ValueError, match="requires mpegts"):
+        RtspCameraSensor(inactive_segment_policy="sample", **sensor_kwargs)
@@ -0,0 +1,122 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import shutil
+import threading
+import time
+import uuid
+
+import pytest
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera.rtsp_stream import RtspCameraSensorGroup
+from wacomponents.sensors.camera.synthetic_stream import SyntheticStreamSensor
+
+CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[
+                dict(
+                    key_cipher_algo="RSA_OAEP",
+                    key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER,
+                    keychain_uid=uuid.UUID(int=5),  # Fixed, so that keypair generation happens only once
+                )
+            ],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+class _ConcurrencyCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.maximum = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.maximum = max(self.maximum, self.current)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.current -= 1
+
+
+class _InstrumentedSyntheticStreamSensor(SyntheticStreamSensor):
+    def __init__(self, encryption_counter, **kwargs):
+        super().__init__(**kwargs)
+        self._encryption_counter = encryption_counter
+        self.rotation_timestamps = []
+
+    def _do_restart_recording(self):
+        self.rotation_timestamps.append(time.monotonic())
+        return super()._do_restart_recording()
+
+    def _build_cryptainer_encryption_stream(self):
+        cryptainer_encryption_stream = super()._build_cryptainer_encryption_stream()
+        encrypt_chunk = cryptainer_encryption_stream.encrypt_chunk
+
+        def _counting_encrypt_chunk(chunk):
+            with self._encryption_counter:
+                time.sleep(0.02)  # Widen the window for concurrent encryptions
+                return encrypt_chunk(chunk)
+
+        cryptainer_encryption_stream.encrypt_chunk = _counting_encrypt_chunk
+        return cryptainer_encryption_stream
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is required")
+def test_rtsp_camera_sensor_group(tmp_path):
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=CRYPTOCONF)
+    encryption_counter = _ConcurrencyCounter()
+    sensors = [
+        _InstrumentedSyntheticStreamSensor(
+            encryption_counter,
+            sensor_name="synthetic_camera_%d" % idx,
+            video_resolution="160x120",
+            video_bitrate="200k",
+            audio_bitrate=None,
+            interval_s=2,
+            cryptainer_storage=cryptainer_storage,
+            activity_notification_callback=lambda **kwargs: None,
+        )
+        for idx in range(2)
+    ]
+
+    with pytest.raises(ValueError, match="distinct sensor names"):
+        RtspCameraSensorGroup(sensors=[sensors[0], sensors[0]])
+
+    # Generate the shared keypair beforehand, so that sensors all start quickly
+    cryptainer_storage.create_cryptainer_encryption_stream("warmup", cryptainer_metadata=None).finalize()
+
+    sensor_group = RtspCameraSensorGroup(sensors=sensors, max_concurrent_encryptions=1, max_encryption_wait_s=5)
+    sensor_group.start()
+    time.sleep(4.5)
+
+    throughput_report = sensor_group.get_throughput_report()
+    assert set(throughput_report) == {"synthetic_camera_0", "synthetic_camera_1"}
+    for stream_statistics in throughput_report.values():
+        assert stream_statistics["encrypted_byte_count"] > 0
+        assert stream_statistics["seconds_since_last_chunk"] < 2
+        assert stream_statistics["encryption_throttle_bypass_count"] == 0
+
+    sensor_group.stop()
+    sensor_group.join()
+
+    # Rotations of the second camera are shifted by half the recording interval, then keep their period
+    first_rotations, second_rotations = [sensor.rotation_timestamps[:2] for sensor in sensors]
+    assert 1.6 < second_rotations[1] - second_rotations[0] < 2.4
+    assert 1.6 < first_rotations[1] - first_rotations[0] < 2.4
+    assert 0.6 < first_rotations[0] - second_rotations[0] < 1.4
+    assert 0.6 < second_rotations[1] - first_rotations[0] < 1.4
+
+    assert encryption_counter.maximum == 1  # Throttle was shared by the group
+
+    # Stopped sensors ignore rotation requests, instead of re-arming their timers
+    rotation_count = len(sensors[1].rotation_timestamps)
+    sensors[1].rotate_recording(rephase_periodic_rotations=True)
+    assert len(sensors[1].rotation_timestamps) == rotation_count
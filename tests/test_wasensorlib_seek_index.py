@@ -0,0 +1,177 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import shutil
+import time
+
+import pytest
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera._media_bitstream import MPEGTS_PACKET_SIZE, is_mpegts_video_random_access_packet
+from wacomponents.sensors.camera._seek_index import (
+    SEEK_INDEX_SUFFIX,
+    SeekIndexedCryptainerStorage,
+    create_seek_index_builder,
+    find_seek_index_entry,
+    get_seek_index_cryptainer_name,
+)
+from wacomponents.sensors.camera.synthetic_stream import SyntheticStreamSensor
+
+CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+def _build_mpegts_packet(is_keyframe):
+    if is_keyframe:  # Adaptation field with random access indicator, then video PES header
+        packet = b"\x47\x41\x00\x30\x01\x40" + b"\x00\x00\x01\xe0"
+    else:
+        packet = b"\x47\x01\x00\x10" + b"\x00\x00\x01\xe0"
+    return packet.ljust(MPEGTS_PACKET_SIZE, b"\xff")
+
+
+def _build_mp4_box(box_type, payload_size):
+    return (8 + payload_size).to_bytes(4, "big") + box_type + b"\x00" * payload_size
+
+
+MP3_FRAME = b"\xff\xfb\x90\x00".ljust(417, b"\x00")  # MPEG1 Layer III, 128kbps, 44100Hz, no padding
+
+SAMPLE_STREAMS = {  # Record extensions mapped to (data, expected entry offsets)
+    ".mpegts": (
+        _build_mpegts_packet(True) + _build_mpegts_packet(False) * 3 + _build_mpegts_packet(True),
+        [0, 4 * MPEGTS_PACKET_SIZE],
+    ),
+    ".h264": (
+        b"\x00\x00\x00\x01\x67SPS\x00\x00\x01\x68PPS\x00\x00\x01\x65IDR\x00\x00\x01\x41P"  # Inline headers
+        + b"\x00\x00\x00\x01\x65IDR\x00\x00\x01\x41P\x00\x00\x00\x01\x67SPS\x00\x00\x01\x65IDR",
+        [1, 28, 41],
+    ),
+    ".mp4": (
+        _build_mp4_box(b"ftyp", 12) + _build_mp4_box(b"moov", 300) + _build_mp4_box(b"moof", 50)
+        + _build_mp4_box(b"mdat", 1000) + _build_mp4_box(b"moof", 50) + _build_mp4_box(b"mdat", 1000),
+        [328, 1394],
+    ),
+    ".mp3": (
+        b"ID3\x04\x00\x00\x00\x00\x00\x05ABCDE" + MP3_FRAME + b"garbage" + MP3_FRAME * 2,
+        [15, 439, 856],
+    ),
+}
+
+
+@pytest.mark.parametrize("record_extension", sorted(SAMPLE_STREAMS))
+@pytest.mark.parametrize("chunk_size", [1, 7, 200, 10000])
+def test_seek_index_builders(record_extension, chunk_size):
+    data, expected_offsets = SAMPLE_STREAMS[record_extension]
+
+    seek_index_builder = create_seek_index_builder(record_extension)
+    seek_index_builder.min_entry_interval_s = 0  # Else entries would depend on chunking
+    start_timestamp = 1700000000.0
+    chunk_count = -(-len(data) // chunk_size)
+    for idx, segment_offset in enumerate(range(0, len(data), chunk_size)):
+        timestamp = start_timestamp + 0.5 * idx / chunk_count  # Whole data is received within 0.5s
+        chunk = memoryview(data)[segment_offset : segment_offset + chunk_size]
+        seek_index_builder.feed(chunk, segment_offset, timestamp)
+
+    seek_index = seek_index_builder.get_seek_index("mycryptainer.crypt")
+    assert seek_index["cryptainer_name"] == "mycryptainer.crypt"
+    assert seek_index["start_timestamp"] == start_timestamp
+    assert seek_index["payload_size"] == len(data)
+    assert [offset for (_time_offset_ms, offset) in seek_index["entries"]] == expected_offsets
+    time_offsets_ms = [time_offset_ms for (time_offset_ms, _offset) in seek_index["entries"]]
+    assert time_offsets_ms == sorted(time_offsets_ms) and all(0 <= t <= 500 for t in time_offsets_ms)
+
+    assert find_seek_index_entry(seek_index, start_timestamp - 1) is None
+    assert find_seek_index_entry(seek_index, start_timestamp + 10) == (
+        start_timestamp + time_offsets_ms[-1] / 1000,
+        expected_offsets[-1],
+    )
+
+    seek_index_builder.truncate(expected_offsets[-1])
+    seek_index = seek_index_builder.get_seek_index("mycryptainer.crypt")
+    assert seek_index["payload_size"] == expected_offsets[-1]
+    assert [offset for (_time_offset_ms, offset) in seek_index["entries"]] == expected_offsets[:-1]
+
+
+def test_seek_index_min_entry_interval():
+    seek_index_builder = create_seek_index_builder(".mp3")
+    for idx in range(10):
+        seek_index_builder.feed(MP3_FRAME, idx * len(MP3_FRAME), timestamp=1700000000 + idx * 0.4)
+    entries = seek_index_builder.get_seek_index("mycryptainer.crypt")["entries"]
+    # Frames are timestamped with the arrival of the previous chunk
+    assert entries == [[0, 0], [1200, 4 * len(MP3_FRAME)], [2400, 7 * len(MP3_FRAME)]]
+
+
+def test_seek_index_unsupported_format():
+    assert create_seek_index_builder(".wav") is None
+    assert create_seek_index_builder(".mp4").get_seek_index("empty.crypt") is None
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is required")
+def test_synthetic_stream_sensor_seek_indexing(tmp_path):
+    sensor_kwargs = dict(cryptainer_storage=CryptainerStorage(tmp_path), activity_notification_callback=None)
+    with pytest.raises(ValueError, match="not supported"):
+        SyntheticStreamSensor(seek_indexing=True, interval_s=2, **sensor_kwargs)
+
+    cryptainer_storage = SeekIndexedCryptainerStorage(tmp_path, default_cryptoconf=CRYPTOCONF)
+    sensor = SyntheticStreamSensor(
+        video_resolution="320x240",
+        video_bitrate="300k",
+        keyframe_interval_s=0.5,
+        gapless_rotation=True,
+        seek_indexing=True,
+        interval_s=2,
+        cryptainer_storage=cryptainer_storage,
+        activity_notification_callback=lambda **kwargs: None,
+    )
+    start_timestamp = time.time()
+    sensor.start()
+    time.sleep(5)
+    sensor.stop()
+    sensor.join()
+    cryptainer_storage.wait_for_idle_state()
+
+    # Sidecars are hidden from listings
+    cryptainer_names = [str(name) for name in cryptainer_storage.list_cryptainer_names(as_sorted_list=True)]
+    assert not any(SEEK_INDEX_SUFFIX in name for name in cryptainer_names)
+    seek_index_file_names = [path.name for path in tmp_path.glob("*" + SEEK_INDEX_SUFFIX + ".crypt")]
+    assert len(seek_index_file_names) >= 2
+    assert sensor.get_stream_statistics()["seek_index_count"] == len(seek_index_file_names)
+    assert cryptainer_storage.get_cryptainer_count() == len(cryptainer_names)
+
+    seek_indexes = [cryptainer_storage.load_seek_index(name) for name in cryptainer_names]
+    seek_indexes = [seek_index for seek_index in seek_indexes if seek_index is not None]
+    assert len(seek_indexes) == len(seek_index_file_names)
+
+    for seek_index in seek_indexes:
+        assert seek_index["media_format"] == "mpegts"
+        assert get_seek_index_cryptainer_name(seek_index["cryptainer_name"]) in seek_index_file_names
+        assert start_timestamp <= seek_index["start_timestamp"] <= time.time()
+
+        payload = cryptainer_storage.decrypt_cryptainer_from_storage(seek_index["cryptainer_name"])[0]
+        assert seek_index["payload_size"] == len(payload)
+        entries = seek_index["entries"]
+        assert entries[0][1] < 10 * MPEGTS_PACKET_SIZE  # Only stream headers may come before first keyframe
+        for _time_offset_ms, offset in entries:
+            assert is_mpegts_video_random_access_packet(payload, offset)
+
+    # Sidecars are counted in the size of their cryptainer, and deleted along with it
+    indexed_cryptainer_name = seek_indexes[0]["cryptainer_name"]
+    cryptainer_sizes = {
+        str(properties["name"]): properties["size"]
+        for properties in cryptainer_storage.list_cryptainer_properties(with_size=True)
+    }
+    assert cryptainer_sizes[indexed_cryptainer_name] > (tmp_path / indexed_cryptainer_name).stat().st_size
+    cryptainer_storage.delete_cryptainer(indexed_cryptainer_name)
+    assert not (tmp_path / get_seek_index_cryptainer_name(indexed_cryptainer_name)).exists()
+
+    purging_cryptainer_storage = SeekIndexedCryptainerStorage(tmp_path, max_cryptainer_count=1)
+    purging_cryptainer_storage.purge_exceeding_cryptainers()
+    assert purging_cryptainer_storage.get_cryptainer_count() == 1
+    assert len(list(tmp_path.glob("*" + SEEK_INDEX_SUFFIX + ".crypt"))) <= 1
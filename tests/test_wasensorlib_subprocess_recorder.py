@@ -0,0 +1,210 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import sys
+import time
+import uuid
+
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera._subprocess_recorder import AdaptiveChunkSizer, SubprocessStreamRecorderBase
+
+FAST_CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[
+                dict(
+                    key_cipher_algo="RSA_OAEP",
+                    key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER,
+                    keychain_uid=uuid.UUID(int=6),  # Fixed, so that keypair generation happens only once
+                )
+            ],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+def _wait_for(predicate, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_adaptive_chunk_sizer():
+    chunk_sizer = AdaptiveChunkSizer(
+        initial_chunk_size=200 * 1024,
+        min_chunk_size=16 * 1024,
+        max_chunk_size=1024 ** 2,
+        target_chunks_per_s=2,
+        smoothing_factor=1,  # No smoothing, for easier testing
+    )
+    assert chunk_sizer.byte_rate is None
+    assert chunk_sizer.chunk_size == 200 * 1024
+
+    chunk_sizer.register_chunk(200 * 1024, duration_s=0)  # Ignored
+    assert chunk_sizer.byte_rate is None
+
+    # Low-bitrate audio-like stream
+    chunk_sizer.register_chunk(200 * 1024, duration_s=10)
+    assert chunk_sizer.byte_rate == 20 * 1024
+    assert chunk_sizer.chunk_size == 16 * 1024  # Min bound
+
+    chunk_sizer.register_chunk(64 * 1024, duration_s=1)
+    assert chunk_sizer.chunk_size == 32 * 1024  # Aligned on pages
+
+    chunk_sizer.register_chunk(100 * 1000, duration_s=1)
+    assert chunk_sizer.chunk_size == 48 * 1024  # Rounded down to page boundary
+
+    # High-bitrate video-like stream
+    chunk_sizer.register_chunk(16 * 1024, duration_s=0.001)
+    assert chunk_sizer.chunk_size == 1024 ** 2  # Max bound
+
+
+def test_adaptive_chunk_sizer_smoothing():
+    chunk_sizer = AdaptiveChunkSizer(
+        initial_chunk_size=64 * 1024,
+        min_chunk_size=4 * 1024,
+        max_chunk_size=1024 ** 2,
+        target_chunks_per_s=1,
+        smoothing_factor=0.5,
+    )
+    chunk_sizer.register_chunk(64 * 1024, duration_s=1)
+    assert chunk_sizer.chunk_size == 64 * 1024
+    chunk_sizer.register_chunk(128 * 1024, duration_s=1)  # Burst is only partially taken into account
+    assert chunk_sizer.byte_rate == 96 * 1024
+    assert chunk_sizer.chunk_size == 96 * 1024
+
+
+class _TickingSensor(SubprocessStreamRecorderBase):
+    sensor_name = "ticking_sensor"
+    record_extension = ".txt"
+    subprocess_data_chunk_size = 1024
+
+    def _build_cryptainer_filename_base(self, from_datetime):
+        # Default names have a 1s resolution, whereas tests rotate faster than that
+        return from_datetime.strftime("%Y%m%d_%H%M%S_%f_") + self.sensor_name + self.record_extension
+
+    def _build_subprocess_command_line(self):
+        return [
+            sys.executable,
+            "-u",
+            "-c",
+            "import time\nwhile True: print('tick', flush=True); time.sleep(0.05)",
+        ]
+
+
+def test_overlapping_subprocess_rotations(tmp_path):
+    def _rotate_and_get_handoff_statistics(overlapping_rotation_window_s):
+        cryptainer_dir = tmp_path / str(overlapping_rotation_window_s)
+        cryptainer_dir.mkdir()
+        cryptainer_storage = CryptainerStorage(cryptainer_dir, default_cryptoconf=FAST_CRYPTOCONF)
+        sensor = _TickingSensor(
+            interval_s=3600,  # Rotations are triggered manually
+            cryptainer_storage=cryptainer_storage,
+            overlapping_rotation_window_s=overlapping_rotation_window_s,
+        )
+        sensor.start()
+        try:
+            assert _wait_for(lambda: sensor.get_stream_statistics()["received_byte_count"], timeout_s=10)
+            rotation_start_time = time.monotonic()
+            sensor.rotate_recording()
+            rotation_duration_s = time.monotonic() - rotation_start_time
+            assert _wait_for(lambda: sensor.get_stream_statistics()["subprocess_handoff_count"] == 1, timeout_s=10)
+        finally:
+            sensor.stop()
+            sensor.join()
+        cryptainer_storage.wait_for_idle_state()
+        assert cryptainer_storage.get_cryptainer_count() == 2
+        return rotation_duration_s, sensor.get_stream_statistics()
+
+    _rotation_duration_s, stream_statistics = _rotate_and_get_handoff_statistics(overlapping_rotation_window_s=None)
+    assert stream_statistics["subprocess_handoff_gap_count"] == 1
+    assert stream_statistics["last_subprocess_handoff_overlap_s"] < 0
+
+    rotation_duration_s, stream_statistics = _rotate_and_get_handoff_statistics(overlapping_rotation_window_s=1)
+    assert rotation_duration_s < 1  # Previous subprocess is stopped in background, after the overlapping window
+    assert stream_statistics["subprocess_handoff_gap_count"] == 0
+    assert stream_statistics["last_subprocess_handoff_overlap_s"] >= 0.8
+
+
+def test_stall_watchdog_restarts_silent_subprocess(tmp_path):
+    class _FreezingSensor(_TickingSensor):
+        sensor_name = "freezing_sensor"
+        stall_watchdog_check_interval_s = 0.1
+        launch_count = 0
+
+        def _build_subprocess_command_line(self):
+            self.launch_count += 1
+            return [  # Outputs data for a moment, then goes silent without exiting
+                sys.executable,
+                "-u",
+                "-c",
+                "import time\nfor _ in range(10): print('tick', flush=True); time.sleep(0.05)\ntime.sleep(3600)",
+            ]
+
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=FAST_CRYPTOCONF)
+    sensor = _FreezingSensor(
+        interval_s=3600,  # No periodic rotation during test
+        cryptainer_storage=cryptainer_storage,
+        stall_watchdog_min_byte_rate=20,
+        stall_watchdog_window_s=0.5,
+    )
+    sensor.start()
+    try:
+        assert _wait_for(lambda: sensor.get_stream_statistics()["stall_count"] >= 2, timeout_s=30)
+    finally:
+        sensor.stop()
+        sensor.join()
+    cryptainer_storage.wait_for_idle_state()
+
+    stream_statistics = sensor.get_stream_statistics()
+    assert sensor.launch_count >= stream_statistics["stall_count"] + 1  # Subprocess got relaunched after each stall
+    assert 0 < stream_statistics["last_stall_duration_s"] < 5
+    assert stream_statistics["stall_total_duration_s"] >= stream_statistics["last_stall_duration_s"]
+    assert stream_statistics["received_byte_count"] >= 2 * 10 * len(b"tick\n")  # New subprocesses output data too
+    # Stalled recordings were kept too, only a last subprocess stopped before any output may leave an empty segment
+    assert stream_statistics["empty_segment_count"] <= 1
+    assert cryptainer_storage.get_cryptainer_count() == sensor.launch_count - stream_statistics["empty_segment_count"]
+
+
+
+def test_rephased_periodic_rotations(tmp_path):
+    class _RotationRecordingSensor(_TickingSensor):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.rotation_timestamps = []
+
+        def _do_restart_recording(self):
+            self.rotation_timestamps.append(time.monotonic())
+            return super()._do_restart_recording()
+
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=FAST_CRYPTOCONF)
+    sensor = _RotationRecordingSensor(interval_s=1, cryptainer_storage=cryptainer_storage)
+    sensor.start()
+    try:
+        time.sleep(0.6)
+        superseded_multitimer = sensor._multitimer
+        rephasing_timestamp = time.monotonic()
+        sensor.rotate_recording(rephase_periodic_rotations=True)
+        # Superseded timer might have fired just before, and only get the sensor lock now
+        superseded_multitimer._function()
+        time.sleep(1.2)
+    finally:
+        sensor.stop()
+        sensor.join()
+    cryptainer_storage.wait_for_idle_state()
+
+    rotation_offsets_s = [
+        timestamp - rephasing_timestamp
+        for timestamp in sensor.rotation_timestamps
+        if timestamp >= rephasing_timestamp  # Start of recording might use a restart too
+    ]
+    assert len(rotation_offsets_s) == 2, rotation_offsets_s
+    assert rotation_offsets_s[0] < 0.2
+    assert 0.8 < rotation_offsets_s[1] < 1.2  # Period restarted from the rephasing rotation
@@ -0,0 +1,61 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import shutil
+import time
+
+import pytest
+from wacryptolib.cryptainer import CryptainerStorage, LOCAL_KEYFACTORY_TRUSTEE_MARKER
+
+from wacomponents.sensors.camera._media_bitstream import MPEGTS_PACKET_SIZE
+from wacomponents.sensors.camera.synthetic_stream import SyntheticStreamSensor
+
+CRYPTOCONF = dict(
+    payload_cipher_layers=[
+        dict(
+            payload_cipher_algo="AES_CBC",
+            key_cipher_layers=[dict(key_cipher_algo="RSA_OAEP", key_cipher_trustee=LOCAL_KEYFACTORY_TRUSTEE_MARKER)],
+            payload_signatures=[],
+        )
+    ]
+)
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is required")
+@pytest.mark.parametrize("gapless_rotation", [False, True])
+def test_synthetic_stream_sensor(tmp_path, gapless_rotation):
+    cryptainer_storage = CryptainerStorage(tmp_path, default_cryptoconf=CRYPTOCONF)
+    sensor = SyntheticStreamSensor(
+        video_resolution="320x240",
+        video_bitrate="400k",
+        keyframe_interval_s=0.5,
+        gapless_rotation=gapless_rotation,
+        interval_s=2,
+        cryptainer_storage=cryptainer_storage,
+        activity_notification_callback=lambda **kwargs: None,
+    )
+    assert sensor.record_extension == ".mpegts"
+
+    start_time = time.monotonic()
+    sensor.start()
+    time.sleep(5)
+    sensor.stop()
+    sensor.join()
+    recording_duration_s = time.monotonic() - start_time
+    cryptainer_storage.wait_for_idle_state()
+
+    payloads = [
+        cryptainer_storage.decrypt_cryptainer_from_storage(cryptainer_name)[0]
+        for cryptainer_name in cryptainer_storage.list_cryptainer_names(as_sorted_list=True)
+    ]
+    if gapless_rotation and not payloads[-1]:
+        payloads.pop()  # Rotation was requested just before stop, so no keyframe came for the last segment
+    assert len(payloads) >= 2
+    for payload in payloads:
+        assert payload[0] == 0x47 and len(payload) % MPEGTS_PACKET_SIZE == 0  # Whole MPEGTS packets
+    total_payload_size = sum(len(payload) for payload in payloads)
+
+    expected_payload_size = (400 + 64) * 1000 / 8 * recording_duration_s
+    assert 0.5 * expected_payload_size < total_payload_size < 1.5 * expected_payload_size  # Realtime pacing
+    assert sensor.get_stream_statistics()["encrypted_byte_count"] == total_payload_size
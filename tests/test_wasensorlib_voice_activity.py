@@ -0,0 +1,70 @@
+# This file is part of Witness Angel Components
+# SPDX-FileCopyrightText: Copyright Prolifik SARL
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import wave
+
+import numpy
+import pytest
+
+from wacomponents.sensors.camera._voice_activity import VoiceActivityGate, parse_wav_stream_header
+
+SAMPLE_RATE = 8000
+
+
+def _build_wav_data(samples, channel_count=1):
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, "wb") as wav_file:
+        wav_file.setnchannels(channel_count)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(numpy.repeat(samples, channel_count).astype("<i2").tobytes())
+    return wav_buffer.getvalue()
+
+
+def _filter_by_chunks(voice_activity_gate, data, chunk_size):
+    kept_data = b"".join(
+        voice_activity_gate.filter_chunk(memoryview(data[idx : idx + chunk_size]))
+        for idx in range(0, len(data), chunk_size)
+    )
+    return kept_data + voice_activity_gate.flush()
+
+
+def test_parse_wav_stream_header():
+    wav_data = _build_wav_data(numpy.zeros(10), channel_count=2)
+    assert parse_wav_stream_header(wav_data[:20]) is None
+    assert parse_wav_stream_header(wav_data) == (44, 2, SAMPLE_RATE, 16)
+    with pytest.raises(ValueError):
+        parse_wav_stream_header(b"ID3" + wav_data)
+
+
+@pytest.mark.parametrize("channel_count", [1, 2])
+def test_voice_activity_gate(channel_count):
+    time_s = numpy.arange(SAMPLE_RATE) / SAMPLE_RATE
+    silence = numpy.random.RandomState(42).normal(0, 3, size=SAMPLE_RATE)  # 1s of background hiss
+    tone = 8000 * numpy.sin(2 * numpy.pi * 440 * time_s)  # 1s of loud sound
+    samples = numpy.concatenate([silence, tone, silence, silence])
+    wav_data = _build_wav_data(samples, channel_count=channel_count)
+    header_size = 44
+    second_size = SAMPLE_RATE * 2 * channel_count
+
+    statistics = {}
+    voice_activity_gate = VoiceActivityGate(statistics, frame_duration_s=0.02, hangover_s=0.5, max_silence_s=0)
+    kept_data = _filter_by_chunks(voice_activity_gate, wav_data, chunk_size=1000)
+    assert kept_data[:header_size] == wav_data[:header_size]
+    assert len(kept_data) == header_size + int(1.5 * second_size)  # Loud sound and its hangover
+    assert kept_data[header_size : header_size + second_size] == wav_data[header_size + second_size :][:second_size]
+    assert statistics["active_frame_count"] == 50
+    assert statistics["skipped_frame_count"] == 50 + 75
+    assert statistics["saved_byte_count"] == len(wav_data) - len(kept_data)
+    assert statistics["processed_byte_count"] == len(wav_data)
+    assert statistics["cpu_time_s"] > 0
+
+    statistics = {}
+    voice_activity_gate = VoiceActivityGate(statistics, frame_duration_s=0.02, hangover_s=0, max_silence_s=0.2)
+    kept_data = _filter_by_chunks(voice_activity_gate, wav_data, chunk_size=3333)
+    assert len(kept_data) == header_size + int(1.4 * second_size)  # Silent stretches are collapsed
+
+    voice_activity_gate = VoiceActivityGate({})
+    assert _filter_by_chunks(voice_activity_gate, b"ID3 not a wav" * 10, chunk_size=7) == b"ID3 not a wav" * 10